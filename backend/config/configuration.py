@@ -48,10 +48,141 @@ CLOUDINARY_API_SECRET = os.getenv('CLOUDINARY_API_SECRET')
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
 REDIS_DB = int(os.getenv('REDIS_DB', 0))
+ANALYSIS_CACHE_TTL_SECONDS = int(os.getenv('ANALYSIS_CACHE_TTL_SECONDS', 604800))  # 7 days
+
+# --- In-Process Cache Tier ---
+# Per-worker LRU in front of Redis for hot analyses and user profiles; entries
+# are dropped on other workers' writes (Redis pub/sub) and after a short TTL
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 1024))
+LOCAL_CACHE_MAX_BYTES = int(os.getenv('LOCAL_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+LOCAL_CACHE_TTL_SECONDS = int(os.getenv('LOCAL_CACHE_TTL_SECONDS', 60))
+CACHE_INVALIDATION_CHANNEL = os.getenv('CACHE_INVALIDATION_CHANNEL', 'cache_invalidation')
+PROFILE_CACHE_TTL_SECONDS = int(os.getenv('PROFILE_CACHE_TTL_SECONDS', 3600))
+
+# --- Single-Flight Coalescing ---
+# Identical concurrent cache misses wait for one leader instead of all calling Gemini
+SINGLE_FLIGHT_LEASE_SECONDS = int(os.getenv('SINGLE_FLIGHT_LEASE_SECONDS', 60))
+SINGLE_FLIGHT_WAIT_SECONDS = int(os.getenv('SINGLE_FLIGHT_WAIT_SECONDS', 45))
+
+# --- Near-Duplicate Image Cache ---
+# Photos whose 64-bit pHash differs by at most this many bits (0-7: the index
+# finds matches through eight 8-bit bands) share a cached extraction
+PHASH_ENABLED = os.getenv('PHASH_ENABLED', 'True').lower() == 'true'
+PHASH_MAX_DISTANCE = int(os.getenv('PHASH_MAX_DISTANCE', 6))
+
+# --- Negative Cache ---
+# Images the model could not read are remembered so resubmitting the same photo
+# returns the stored failure without an upload or a Gemini call. Each unreadable
+# submission within the strike window is a strike against the user and doubles
+# the TTL of the entries they create (up to the maximum); after enough strikes
+# near-duplicates of their junk images are turned away too
+NEGATIVE_CACHE_ENABLED = os.getenv('NEGATIVE_CACHE_ENABLED', 'True').lower() == 'true'
+NEGATIVE_CACHE_TTL_SECONDS = int(os.getenv('NEGATIVE_CACHE_TTL_SECONDS', 300))
+NEGATIVE_CACHE_MAX_TTL_SECONDS = int(os.getenv('NEGATIVE_CACHE_MAX_TTL_SECONDS', 86400))
+NEGATIVE_CACHE_STRIKE_WINDOW_SECONDS = int(os.getenv('NEGATIVE_CACHE_STRIKE_WINDOW_SECONDS', 3600))
+NEGATIVE_CACHE_PHASH_STRIKES = int(os.getenv('NEGATIVE_CACHE_PHASH_STRIKES', 3))
+# Tighter than PHASH_MAX_DISTANCE: a sharper retake of a blurry label must still get through
+NEGATIVE_CACHE_PHASH_MAX_DISTANCE = int(os.getenv('NEGATIVE_CACHE_PHASH_MAX_DISTANCE', 3))
+
+# --- Barcode Fast Path ---
+# Photos showing the EAN/UPC barcode of a product in the Product table skip the
+# Gemini vision call and go straight to scoring. Products are learned from
+# successful extractions and can be bulk-imported with `manage.py import_products`,
+# which also reports the share of scans the fast path served (kept per day in Redis)
+BARCODE_FAST_PATH_ENABLED = os.getenv('BARCODE_FAST_PATH_ENABLED', 'True').lower() == 'true'
+BARCODE_STATS_RETENTION_DAYS = int(os.getenv('BARCODE_STATS_RETENTION_DAYS', 30))
+
+# --- Analysis Job Queue ---
+# 'redis' queues jobs for `manage.py run_analysis_worker`; 'inprocess' runs them
+# on a thread pool inside the web process (local development without a worker)
+ANALYSIS_JOB_BACKEND = os.getenv('ANALYSIS_JOB_BACKEND', 'redis')
+ANALYSIS_JOB_QUEUE_KEY = os.getenv('ANALYSIS_JOB_QUEUE_KEY', 'analysis_jobs:queue')
+ANALYSIS_JOB_INPROCESS_WORKERS = int(os.getenv('ANALYSIS_JOB_INPROCESS_WORKERS', 2))
+# A worker holds a claimed job this long; after that (worker killed by OOM or a
+# deploy) the job is queued again, up to the attempt limit, then failed. Jobs
+# turned away by Gemini admission control are queued again after Retry-After,
+# within the same attempt limit
+ANALYSIS_JOB_LEASE_SECONDS = int(os.getenv('ANALYSIS_JOB_LEASE_SECONDS', 300))
+ANALYSIS_JOB_MAX_ATTEMPTS = int(os.getenv('ANALYSIS_JOB_MAX_ATTEMPTS', 5))
+
+# --- Cloudinary Asset Deletion ---
+# Deleted analyses queue their images in an outbox that `manage.py drain_asset_deletions`
+# removes in batches (the bulk delete API takes at most 100 ids per call). Failed
+# batches are retried with exponential backoff up to the attempt limit.
+# 'log' only logs the ids (local development without Cloudinary credentials)
+ASSET_DELETION_BACKEND = os.getenv('ASSET_DELETION_BACKEND', 'cloudinary')
+ASSET_DELETION_BATCH_SIZE = int(os.getenv('ASSET_DELETION_BATCH_SIZE', 100))
+ASSET_DELETION_MAX_ATTEMPTS = int(os.getenv('ASSET_DELETION_MAX_ATTEMPTS', 8))
+ASSET_DELETION_RETRY_BASE_SECONDS = int(os.getenv('ASSET_DELETION_RETRY_BASE_SECONDS', 30))
+ASSET_DELETION_RETRY_MAX_SECONDS = int(os.getenv('ASSET_DELETION_RETRY_MAX_SECONDS', 3600))
+# A drainer holds its batch this long before another drainer may pick it up
+ASSET_DELETION_LEASE_SECONDS = int(os.getenv('ASSET_DELETION_LEASE_SECONDS', 300))
+
+# --- Metrics ---
+# Bearer token required to scrape /metrics; leave unset to allow any client
+# (e.g. when the path is only reachable from the monitoring network)
+METRICS_AUTH_TOKEN = os.getenv('METRICS_AUTH_TOKEN')
+
+# --- Batch Analysis ---
+# Images accepted per batch request, and how many are analyzed concurrently
+BATCH_MAX_IMAGES = int(os.getenv('BATCH_MAX_IMAGES', 20))
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', 4))
 
 # --- AI Service Configuration ---
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
+# --- Gemini Context Caching ---
+# The static extraction and scoring instructions are registered once as cached
+# content shared by every worker; requests then send only the profile,
+# ingredients or image. The TTL is extended when less than the refresh margin
+# is left. If the cache cannot be created calls use the inline prompt and
+# creation is retried after GEMINI_CONTEXT_CACHE_RETRY_SECONDS.
+# Off by default: the current instructions (~1k tokens) are below the minimum
+# gemini-2.0-flash will cache (4,096 tokens), so creation is always refused.
+# Enable it once the static instructions grow past the model's minimum
+GEMINI_CONTEXT_CACHE_ENABLED = os.getenv('GEMINI_CONTEXT_CACHE_ENABLED', 'False').lower() == 'true'
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv('GEMINI_CONTEXT_CACHE_TTL_SECONDS', 3600))
+GEMINI_CONTEXT_CACHE_REFRESH_SECONDS = int(os.getenv('GEMINI_CONTEXT_CACHE_REFRESH_SECONDS', 600))
+GEMINI_CONTEXT_CACHE_RETRY_SECONDS = int(os.getenv('GEMINI_CONTEXT_CACHE_RETRY_SECONDS', 300))
+
+# --- Gemini Admission Control ---
+# Shared by every worker through Redis: calls per second (token bucket with a
+# burst allowance) and calls in flight are capped to stay inside the quota;
+# callers beyond that wait in a bounded, per-user fair queue and get
+# 503 + Retry-After once it is full or they have waited the full budget
+GEMINI_ADMISSION_ENABLED = os.getenv('GEMINI_ADMISSION_ENABLED', 'True').lower() == 'true'
+GEMINI_RATE_PER_SECOND = float(os.getenv('GEMINI_RATE_PER_SECOND', 5))
+GEMINI_BURST = int(os.getenv('GEMINI_BURST', 10))
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', 16))
+GEMINI_QUEUE_MAX = int(os.getenv('GEMINI_QUEUE_MAX', 64))
+GEMINI_QUEUE_MAX_PER_USER = int(os.getenv('GEMINI_QUEUE_MAX_PER_USER', 4))
+GEMINI_QUEUE_WAIT_SECONDS = int(os.getenv('GEMINI_QUEUE_WAIT_SECONDS', 20))
+GEMINI_SLOT_LEASE_SECONDS = int(os.getenv('GEMINI_SLOT_LEASE_SECONDS', 120))
+
+# --- Gemini Resilience ---
+# Each attempt gets its own timeout inside an overall deadline. Timeouts, 429s,
+# 5xx and connection errors are retried with full-jitter exponential backoff.
+# After enough consecutive upstream failures the breaker (shared through Redis)
+# opens and calls fail fast with 503 until a probe succeeds.
+GEMINI_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv('GEMINI_ATTEMPT_TIMEOUT_SECONDS', 20))
+GEMINI_DEADLINE_SECONDS = float(os.getenv('GEMINI_DEADLINE_SECONDS', 45))
+GEMINI_MAX_ATTEMPTS = int(os.getenv('GEMINI_MAX_ATTEMPTS', 3))
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv('GEMINI_RETRY_BASE_SECONDS', 0.5))
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv('GEMINI_RETRY_MAX_SECONDS', 4))
+# Optional: send a second, identical request when the first is slower than this
+# percentile of recent latencies (the first answer wins)
+GEMINI_HEDGE_ENABLED = os.getenv('GEMINI_HEDGE_ENABLED', 'False').lower() == 'true'
+GEMINI_HEDGE_PERCENTILE = float(os.getenv('GEMINI_HEDGE_PERCENTILE', 95))
+GEMINI_BREAKER_FAILURE_THRESHOLD = int(os.getenv('GEMINI_BREAKER_FAILURE_THRESHOLD', 5))
+GEMINI_BREAKER_COOLDOWN_SECONDS = int(os.getenv('GEMINI_BREAKER_COOLDOWN_SECONDS', 30))
+
+# --- Image Preprocessing ---
+# Label photos are downscaled and re-encoded once, then sent to both Gemini and Cloudinary
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', 1600))  # longest edge, px
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', 400 * 1024))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', 85))
+IMAGE_GRAYSCALE = os.getenv('IMAGE_GRAYSCALE', 'False').lower() == 'true'
+
 # --- JWT Configuration ---
 ACCESS_TOKEN_LIFETIME_MINUTES = 15
 REFRESH_TOKEN_LIFETIME_DAYS = 7
@@ -0,0 +1,17 @@
+# Loaded automatically by gunicorn from the working directory.
+import os
+import shutil
+
+
+def on_starting(server):
+    # Prometheus multiprocess files from a previous run would be summed into /metrics
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,74 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from ingredient_analysis_app.utils.metrics import REQUEST_SECONDS
+
+
+class AsyncCapableWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise that also runs natively under ASGI.
+
+    WhiteNoise 6.5 is sync-only; one sync middleware makes Django run the
+    rest of the stack, async views included, through the single
+    thread-sensitive executor, so async analyses would be serialized.
+    Static files are still served by WhiteNoise; everything else is
+    awaited straight through.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve, thread_sensitive=False)(static_file, request)
+        return await self.get_response(request)
+
+
+class RequestMetricsMiddleware:
+    """
+    Per-endpoint request latency histogram. Endpoints are labelled by URL
+    route pattern, not path, so ids do not create new series. For streamed
+    responses this is the time to the first byte, not to the end of the stream.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+    @staticmethod
+    def _observe(request, response, start):
+        match = getattr(request, 'resolver_match', None)
+        REQUEST_SECONDS.labels(
+            match.route if match else 'unmatched', request.method, str(response.status_code)
+        ).observe(time.perf_counter() - start)
@@ -5,6 +5,7 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.views.static import serve
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
+from ingredient_analysis_app.view.metrics_views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -14,6 +15,9 @@ urlpatterns = [
     path('api/v1/medical/', include('medical_history.urls.api_urls')),
     path('api/v1/analysis/', include('ingredient_analysis_app.urls.api_urls')),
 
+    # Prometheus scrape endpoint
+    path('metrics', metrics_view, name='metrics'),
+
     # API Documentation
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'),
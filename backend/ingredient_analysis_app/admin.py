@@ -1,4 +1,7 @@
 from django.contrib import admin
-from .models import IngredientAnalysis
+from .models import IngredientAnalysis, AnalysisJob, PendingAssetDeletion, Product
 # Register your models here.
 admin.site.register(IngredientAnalysis)
+admin.site.register(AnalysisJob)
+admin.site.register(PendingAssetDeletion)
+admin.site.register(Product)
@@ -0,0 +1,240 @@
+"""
+Local stand-ins for the analyze pipeline's external services, shared by the
+benchmark commands: a scratch database, in-memory (or local) Redis, a fake
+Cloudinary uploader and a record/replay Gemini model.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import cloudinary
+import fakeredis
+from google.genai import types
+import numpy as np
+from django.db import connection
+from PIL import Image
+
+from ..service.ai_service import ai_service
+from ..utils import cache_utils
+
+WORDS = (
+    "sugar palm oil emulsifier sodium preservative acidity regulator flavour colour "
+    "sweetener protein fibre glucose syrup allergen sesame soy wheat gluten milk "
+    "blood pressure diabetes intake moderate daily limit recommended avoid caution"
+).split()
+
+
+def noise_jpeg(seed, size=(128, 96)):
+    """Deterministic JPEG bytes that no two seeds share (and pHash never matches)"""
+    pixels = np.random.default_rng(seed).integers(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=80)
+    return buffer.getvalue()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def content_key(contents):
+    """Stable key for a generate_content request: the prompt text plus any image bytes"""
+    digest = hashlib.sha256()
+    for part in contents if isinstance(contents, list) else [contents]:
+        digest.update(part.inline_data.data if isinstance(part, types.Part) else part.encode())
+    return digest.hexdigest()
+
+
+def synthetic_response(contents):
+    """
+    Deterministic model output for a request with no recording: a distinct
+    ingredient per image (so scoring is a cache miss per image) and a full
+    scoring answer of realistic size.
+    """
+    key = content_key(contents)
+    if isinstance(contents, list):
+        return json.dumps({"no_valid_ingredients": False,
+                           "ingredients": ["Sugar", "Palm Oil", f"Additive {key[:8]}"]})
+    rng = random.Random(key)
+
+    def sentence(words):
+        return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+    return json.dumps({
+        "no_valid_ingredients": False,
+        "analysis_summary": {
+            "safety_score": rng.randint(0, 100),
+            "safety_level": rng.choice(["safe", "caution", "danger"]),
+            "should_use": rng.random() < 0.5,
+            "main_verdict": sentence(25),
+            "detailed_explanation": " ".join(sentence(20) for _ in range(5)),
+            "nutritional_highlights": sentence(12),
+            "concern_count": rng.randint(0, 5),
+        },
+        "ingredient_groups": [{
+            "group_name": sentence(3),
+            "ingredients": [{
+                "name": sentence(2), "purpose": sentence(8),
+                "status": rng.choice(["safe", "caution", "danger"]),
+                "concern_level": rng.choice(["low", "medium", "high"]),
+                "user_specific_risk": rng.random() < 0.3,
+                "quick_summary": sentence(12), "why_flagged": None,
+            } for _ in range(rng.randint(2, 4))]
+        } for _ in range(rng.randint(3, 5))],
+        "health_alerts": [],
+        "recommendation": {"verdict": "caution", "confidence": "medium",
+                           "reason": sentence(12), "safe_to_try": True},
+        "alternatives": [],
+        "key_advice": sentence(15),
+    })
+
+
+class ReplayModel:
+    """
+    Gemini stand-in. Answers from a recording (content key -> response
+    text) when it has one and synthesizes an answer otherwise, after a
+    configurable latency. With `upstream` set it records instead: each call
+    goes to the real model and its answer is kept for save().
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, recording=None, upstream=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.recording = dict(recording or {})
+        self.upstream = upstream
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.replayed = 0
+        self.in_flight = 0
+        self.peak = 0
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        return cls(recording=json.loads(Path(path).read_text()), **kwargs)
+
+    def save(self, path):
+        Path(path).write_text(json.dumps(self.recording, indent=1, sort_keys=True))
+
+    def _delay(self):
+        with self.lock:
+            return max(0.0, self.latency * (1 + self.rng.uniform(-self.jitter, self.jitter)))
+
+    def _enter(self):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def _exit(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def _answer(self, contents, config=None):
+        key = content_key(contents)
+        if self.upstream is not None:
+            text = self.upstream.generate_content(contents, config=config).text
+            with self.lock:
+                self.recording[key] = text
+            return SimpleNamespace(text=text)
+        if key in self.recording:
+            with self.lock:
+                self.replayed += 1
+            return SimpleNamespace(text=self.recording[key])
+        return SimpleNamespace(text=synthetic_response(contents))
+
+    def generate_content(self, contents, config=None):
+        self._enter()
+        try:
+            if self.upstream is None:
+                time.sleep(self._delay())
+            return self._answer(contents, config)
+        finally:
+            self._exit()
+
+    def generate_content_stream(self, contents, config=None):
+        return iter([self.generate_content(contents, config)])
+
+    async def generate_content_async(self, contents, config=None):
+        self._enter()
+        try:
+            if self.upstream is None:
+                await asyncio.sleep(self._delay())
+                return self._answer(contents)
+            return await asyncio.to_thread(self._answer, contents, config)
+        finally:
+            self._exit()
+
+
+@contextmanager
+def scratch_database():
+    """
+    Create a throwaway copy of the configured database and point the app at it.
+    SQLite gets a file in WAL mode rather than Django's shared in-memory test
+    database, so concurrent writers wait on each other instead of failing
+    with "database table is locked".
+    """
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+        test_settings['NAME'] = str(Path(connection.settings_dict['NAME']).with_name('loadtest.sqlite3'))
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+    try:
+        yield
+    finally:
+        test_name = connection.settings_dict['NAME']
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if connection.vendor == 'sqlite':
+            for suffix in ('-wal', '-shm'):
+                Path(f'{test_name}{suffix}').unlink(missing_ok=True)
+
+
+@contextmanager
+def local_stand_ins(model, local_redis=False, upload_latency=0.0):
+    """
+    Route Redis, Cloudinary and Gemini to local stand-ins for the duration.
+    With local_redis the configured Redis is used as-is (point REDIS_DB at a
+    scratch database: entries left by an earlier run turn misses into hits).
+    """
+    uploads = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    def upload(image_file):
+        time.sleep(upload_latency)
+        with lock:
+            public_id = f"loadtest/{next(uploads)}"
+        return {'url': f"https://res.cloudinary.invalid/{public_id}.jpg", 'public_id': public_id}
+
+    with ExitStack() as stack:
+        if not local_redis:
+            server = fakeredis.FakeServer()
+            stack.enter_context(mock.patch.object(
+                cache_utils, 'redis_client',
+                fakeredis.FakeStrictRedis(server=server, decode_responses=True)))
+            stack.enter_context(mock.patch.object(
+                cache_utils, 'binary_redis_client', fakeredis.FakeStrictRedis(server=server)))
+            stack.enter_context(mock.patch.object(
+                cache_utils, 'get_async_redis_client',
+                lambda: fakeredis.FakeAsyncRedis(server=server)))
+        # Saved analyses build their image URL from the Cloudinary config
+        stack.enter_context(mock.patch.object(
+            cloudinary.config(), 'cloud_name', cloudinary.config().cloud_name or 'loadtest',
+            create=True))
+        stack.enter_context(mock.patch('cloudinary.uploader.upload', side_effect=upload))
+        stack.enter_context(mock.patch('cloudinary.api.delete_resources', side_effect=lambda ids: {
+            'deleted': {public_id: 'deleted' for public_id in ids}}))
+        stack.enter_context(mock.patch.object(ai_service, 'model', model))
+        # Keep every call on the stand-in model instead of a real cached-content model
+        stack.enter_context(mock.patch.object(ai_service.extraction_cache, 'enabled', False))
+        stack.enter_context(mock.patch.object(ai_service.scoring_cache, 'enabled', False))
+        yield
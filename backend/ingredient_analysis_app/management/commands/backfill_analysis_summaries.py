@@ -0,0 +1,47 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from ...models import IngredientAnalysis
+
+
+class Command(BaseCommand):
+    help = ("Fill the summary columns (safety score and level, verdict, concern count, "
+            "main verdict) of analyses saved before they existed")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute every row, not only rows with empty summary columns')
+
+    def handle(self, *args, **options):
+        queryset = IngredientAnalysis.objects.order_by('pk')
+        if not options['all']:
+            queryset = queryset.filter(Q(safety_score__isnull=True) & Q(verdict=''))
+
+        updated = skipped = 0
+        last_pk = 0
+        while True:
+            # Keyset batches: rows that stay empty (unparseable) are not revisited
+            batch = list(queryset.filter(pk__gt=last_pk).only('pk', 'result')[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            changed = []
+            for analysis in batch:
+                try:
+                    result = json.loads(analysis.result)
+                except (TypeError, ValueError):
+                    result = None
+                if not isinstance(result, dict):
+                    skipped += 1
+                    continue
+                for field, value in IngredientAnalysis.summary_fields(result).items():
+                    setattr(analysis, field, value)
+                changed.append(analysis)
+            IngredientAnalysis.objects.bulk_update(changed, IngredientAnalysis.SUMMARY_FIELDS)
+            updated += len(changed)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Backfilled {updated} analyses ({skipped} with unreadable results skipped)"))
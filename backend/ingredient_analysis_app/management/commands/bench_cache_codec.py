@@ -0,0 +1,126 @@
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...utils.cache_codec import encode_value, decode_value
+from ...utils.cache_utils import binary_redis_client
+
+WORDS = (
+    "sugar palm oil emulsifier sodium preservative acidity regulator flavour colour "
+    "sweetener protein fibre glucose syrup allergen sesame soy wheat gluten milk "
+    "blood pressure diabetes intake moderate daily limit recommended avoid caution "
+    "contains added processed natural synthetic may trigger reaction sensitive users"
+).split()
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def synthetic_analysis(rng):
+    """An analysis shaped like the scoring prompt's JSON structure, 5-15 KB of JSON"""
+    status = ["safe", "caution", "danger"]
+    return {
+        "no_valid_ingredients": False,
+        "analysis_summary": {
+            "safety_score": rng.randint(0, 100),
+            "safety_level": rng.choice(status),
+            "should_use": rng.random() < 0.5,
+            "main_verdict": sentence(rng, 30),
+            "detailed_explanation": " ".join(sentence(rng, 20) for _ in range(6)),
+            "nutritional_highlights": sentence(rng, 15),
+            "concern_count": rng.randint(0, 6),
+        },
+        "ingredient_groups": [{
+            "group_name": sentence(rng, 3),
+            "ingredients": [{
+                "name": sentence(rng, 3),
+                "purpose": sentence(rng, 8),
+                "status": rng.choice(status),
+                "concern_level": rng.choice(["low", "medium", "high"]),
+                "user_specific_risk": rng.random() < 0.3,
+                "quick_summary": sentence(rng, 12),
+                "why_flagged": sentence(rng, 12) if rng.random() < 0.4 else None,
+            } for _ in range(rng.randint(2, 5))]
+        } for _ in range(rng.randint(3, 7))],
+        "health_alerts": [{
+            "type": rng.choice(["allergy_match", "condition_risk", "interaction_warning"]),
+            "severity": rng.choice(["low", "medium", "high"]),
+            "message": sentence(rng, 12),
+            "ingredient": sentence(rng, 2),
+            "action": sentence(rng, 12),
+        } for _ in range(rng.randint(0, 4))],
+        "recommendation": {
+            "verdict": rng.choice(["recommend", "caution", "avoid"]),
+            "confidence": rng.choice(["high", "medium", "low"]),
+            "reason": sentence(rng, 15),
+            "safe_to_try": rng.random() < 0.5,
+        },
+        "alternatives": [{
+            "name": sentence(rng, 3), "why": sentence(rng, 12), "benefit": sentence(rng, 8)
+        } for _ in range(3)],
+        "key_advice": sentence(rng, 20),
+        "metadata": {"status": "completed"},
+    }
+
+
+def timed(func, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(arg)
+    return (time.perf_counter() - start) / repeat * 1e6, result
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the binary cache codec against the previous JSON-text format: "
+            "bytes per entry and encode/decode time")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from-redis', action='store_true',
+                            help='Sample real ingredient_analysis:* entries from REDIS_HOST')
+        parser.add_argument('--samples', type=int, default=200)
+        parser.add_argument('--repeat', type=int, default=20, help='Timing repetitions per entry')
+        parser.add_argument('--seed', type=int, default=3)
+
+    def handle(self, *args, **options):
+        if options['from_redis']:
+            values = []
+            for key in binary_redis_client.scan_iter('ingredient_analysis:*', count=500):
+                data = binary_redis_client.get(key)
+                if data is not None:
+                    values.append(decode_value(data))
+                if len(values) >= options['samples']:
+                    break
+        else:
+            rng = random.Random(options['seed'])
+            values = [synthetic_analysis(rng) for _ in range(options['samples'])]
+        if not values:
+            self.stdout.write(self.style.WARNING("No entries to benchmark"))
+            return
+
+        repeat = options['repeat']
+        rows = []
+        for value in values:
+            # Previous format: json.dumps text, decoded to str by the client before json.loads
+            legacy_encode, legacy = timed(lambda v: json.dumps(v).encode(), value, repeat)
+            legacy_decode, _ = timed(lambda d: json.loads(d.decode()), legacy, repeat)
+            codec_encode, encoded = timed(encode_value, value, repeat)
+            codec_decode, decoded = timed(decode_value, encoded, repeat)
+            assert decoded == value
+            rows.append((len(legacy), len(encoded), legacy_encode, legacy_decode,
+                         codec_encode, codec_decode))
+
+        def median(column):
+            return statistics.median(row[column] for row in rows)
+
+        legacy_total = sum(row[0] for row in rows)
+        codec_total = sum(row[1] for row in rows)
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(rows)} {'Redis' if options['from_redis'] else 'synthetic'} entries\n"
+            f"  bytes per entry (median): {median(0):,.0f} JSON text -> {median(1):,.0f} codec "
+            f"({codec_total / legacy_total:.1%} of total)\n"
+            f"  encode (median):          {median(2):.0f} us -> {median(4):.0f} us\n"
+            f"  decode (median):          {median(3):.0f} us -> {median(5):.0f} us"))
@@ -0,0 +1,121 @@
+import datetime
+import json
+import statistics
+import time
+from contextlib import ExitStack
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.utils import timezone
+from rest_framework.pagination import Cursor
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from ...models import IngredientAnalysis
+from ...utils.api_utils import HistoryCursorPagination
+from ..benchmarking import ReplayModel, local_stand_ins, scratch_database
+
+CATEGORIES = ('food', 'cosmetics', 'medicine')
+RESULT = json.dumps({"analysis_summary": {"safety_score": 70, "safety_level": "caution"},
+                     "recommendation": {"verdict": "caution"}})
+FEED_URL = '/api/v1/analysis/history/feed/'
+LIST_URL = '/api/v1/analysis/history/'
+
+
+class Command(BaseCommand):
+    help = ("Benchmark deep history pages at scale: page-number (COUNT + OFFSET) list vs "
+            "cursor-paginated feed on the (user, -timestamp, -id) index")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Analyses in the table')
+        parser.add_argument('--users', type=int, default=4, help='Users the rows are spread over')
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--depths', default='1,10,100,1000,5000,10000',
+                            help='Comma-separated page numbers to time')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed-batch', type=int, default=20_000)
+
+    def handle(self, *args, **options):
+        # Rows carry a short result; the list defers it either way
+        with scratch_database(), local_stand_ins(ReplayModel()):
+            users = self._seed(options)
+            user = users[0]
+            client = Client()
+            headers = {'Authorization': f"Bearer {RefreshToken.for_user(user).access_token}"}
+            user_rows = IngredientAnalysis.objects.filter(user=user).count()
+            size = options['page_size']
+
+            self.stdout.write(f"{options['rows']:,} rows, {user_rows:,} for the timed user, "
+                              f"page size {size}\n")
+            self.stdout.write(f"{'page':>8} {'depth (rows)':>13} {'page-number':>13} {'cursor':>10}")
+            for page in (int(value) for value in options['depths'].split(',')):
+                if (page - 1) * size >= user_rows:
+                    continue
+                cursor_url = self._cursor_url(user, (page - 1) * size, size)
+                list_ms = self._time(client, f"{LIST_URL}?page={page}&page_size={size}",
+                                     headers, options['repeat'])
+                feed_ms = self._time(client, cursor_url, headers, options['repeat'])
+                self.stdout.write(f"{page:>8} {(page - 1) * size:>13,} {list_ms:>10.1f} ms "
+                                  f"{feed_ms:>7.1f} ms")
+
+            with connection.cursor() as cursor:
+                sql, params = self._seek_query(user, timezone.now()).query.sql_with_params()
+                if connection.vendor == 'sqlite':
+                    cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                    plan = '; '.join(row[-1] for row in cursor.fetchall())
+                    self.stdout.write(f"\nFeed query plan: {plan}")
+        self.stdout.write(self.style.SUCCESS("Done"))
+
+    @staticmethod
+    def _seed(options):
+        users = [User.objects.create_user(f'bench-history-{index}', password='bench-pass-123')
+                 for index in range(options['users'])]
+        timestamp_field = IngredientAnalysis._meta.get_field('timestamp')
+        start = timezone.now() - datetime.timedelta(days=365 * 3)
+        batch = options['seed_batch']
+        with ExitStack() as stack:
+            # Spread timestamps over three years instead of "now" for every row
+            stack.enter_context(mock.patch.object(timestamp_field, 'auto_now_add', False))
+            for offset in range(0, options['rows'], batch):
+                IngredientAnalysis.objects.bulk_create([
+                    IngredientAnalysis(
+                        user=users[row % len(users)],
+                        category=CATEGORIES[row % len(CATEGORIES)],
+                        image=IngredientAnalysis.image_reference(f'bench/{row}'),
+                        result=RESULT,
+                        timestamp=start + datetime.timedelta(seconds=row * 90),
+                        safety_score=70, safety_level='caution', verdict='caution',
+                        concern_count=1, main_verdict='Moderate sugar.')
+                    for row in range(offset, min(offset + batch, options['rows']))
+                ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        return users
+
+    @staticmethod
+    def _seek_query(user, position):
+        return IngredientAnalysis.objects.filter(
+            user=user, timestamp__lt=position).defer('result').order_by('-timestamp', '-id')[:20]
+
+    @staticmethod
+    def _cursor_url(user, depth, size):
+        """Feed URL whose cursor points just past the first `depth` rows, as `next` would"""
+        paginator = HistoryCursorPagination()
+        paginator.base_url = f"{FEED_URL}?page_size={size}"
+        if depth == 0:
+            return paginator.base_url
+        last_seen = IngredientAnalysis.objects.filter(user=user).order_by(
+            '-timestamp', '-id').values_list('timestamp', flat=True)[depth - 1]
+        return paginator.encode_cursor(Cursor(offset=0, reverse=False, position=str(last_seen)))
+
+    @staticmethod
+    def _time(client, url, headers, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.get(url, headers=headers)
+            timings.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 200, response.content[:200]
+        return statistics.median(timings)
@@ -0,0 +1,106 @@
+import io
+import math
+import statistics
+import time
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from PIL import Image, ImageDraw
+
+from ...utils.image_utils import (
+    prepare_image, EXIF_ORIENTATION_TAG, IMAGE_MAX_DIMENSION
+)
+
+
+def synthetic_label_photo(seed, width=4032, height=3024, rotated=False):
+    """12-MP phone-style JPEG of an ingredient panel, with sensor noise"""
+    rng = np.random.default_rng(seed)
+    img = Image.new('RGB', (width, height), (236, 232, 224))
+    draw = ImageDraw.Draw(img)
+    for row in range(40):
+        y = 200 + row * 65
+        x = 150
+        while x < width - 300:
+            word = int(rng.integers(60, 260))
+            draw.rectangle([x, y, x + word, y + 34], fill=(30, 30, 30))
+            x += word + int(rng.integers(25, 45))
+    noise = rng.normal(0, 9, (height, width, 3))
+    pixels = np.clip(np.asarray(img, dtype=np.float32) + noise, 0, 255).astype(np.uint8)
+    photo = Image.fromarray(pixels)
+
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    if rotated:
+        # Stored sideways like a portrait shot, with the orientation in EXIF
+        photo = photo.transpose(Image.Transpose.ROTATE_90)
+        exif[EXIF_ORIENTATION_TAG] = 6
+    photo.save(buffer, format='JPEG', quality=92, exif=exif)
+    return buffer.getvalue()
+
+
+class Command(BaseCommand):
+    help = ("Benchmark label-photo preprocessing: bytes sent to Gemini + Cloudinary, "
+            "decode time and estimated end-to-end latency before/after")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', help='Directory of sample label photos')
+        parser.add_argument('--count', type=int, default=6,
+                            help='Synthetic 12-MP photos to generate when no directory is given')
+        parser.add_argument('--uplink-mbps', type=float, default=20.0,
+                            help='Server uplink bandwidth used to estimate transfer time')
+        parser.add_argument('--grayscale', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['images']:
+            samples = [(path.name, path.read_bytes())
+                       for path in sorted(Path(options['images']).iterdir()) if path.is_file()]
+        else:
+            samples = [(f"synthetic-{i}.jpg", synthetic_label_photo(i, rotated=i % 2 == 1))
+                       for i in range(options['count'])]
+
+        bytes_per_second = options['uplink_mbps'] * 1_000_000 / 8
+        rows = []
+        for name, data in samples:
+            start = time.perf_counter()
+            with Image.open(io.BytesIO(data)) as img:
+                img.load()
+                original_size = img.size
+            full_decode = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with Image.open(io.BytesIO(data)) as img:
+                scale = min(1.0, IMAGE_MAX_DIMENSION / max(img.size))
+                img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+                img.load()
+            draft_decode = time.perf_counter() - start
+
+            start = time.perf_counter()
+            prepared = prepare_image(io.BytesIO(data), grayscale=options['grayscale'])
+            prepare_time = time.perf_counter() - start
+
+            # Each analysis ships the image twice: Cloudinary upload and Gemini request
+            before = full_decode + 2 * len(data) / bytes_per_second
+            after = prepare_time + 2 * len(prepared.data) / bytes_per_second
+            rows.append((name, len(data), len(prepared.data), full_decode,
+                         draft_decode, prepare_time, before, after))
+            self.stdout.write(
+                f"{name}: {original_size[0]}x{original_size[1]} -> "
+                f"{prepared.size[0]}x{prepared.size[1]}, "
+                f"{len(data) / 1024:.0f} KB -> {len(prepared.data) / 1024:.0f} KB, "
+                f"decode {full_decode * 1000:.0f} ms -> draft {draft_decode * 1000:.0f} ms "
+                f"(prepare total {prepare_time * 1000:.0f} ms), "
+                f"e2e {before * 1000:.0f} ms -> {after * 1000:.0f} ms")
+
+        sent_before = sum(2 * row[1] for row in rows)
+        sent_after = sum(2 * row[2] for row in rows)
+        self.stdout.write(self.style.SUCCESS(
+            f"\n{len(rows)} images @ {options['uplink_mbps']:g} Mbps uplink\n"
+            f"  bytes sent:      {sent_before / 1e6:.1f} MB -> {sent_after / 1e6:.2f} MB "
+            f"({sent_after / sent_before:.1%})\n"
+            f"  median decode:   {statistics.median(r[3] for r in rows) * 1000:.0f} ms full -> "
+            f"{statistics.median(r[4] for r in rows) * 1000:.0f} ms draft mode\n"
+            f"  median prepare:  {statistics.median(r[5] for r in rows) * 1000:.0f} ms "
+            f"(draft decode + EXIF transpose + resize + encode)\n"
+            f"  median e2e:      {statistics.median(r[6] for r in rows) * 1000:.0f} ms -> "
+            f"{statistics.median(r[7] for r in rows) * 1000:.0f} ms (processing + estimated transfer)"))
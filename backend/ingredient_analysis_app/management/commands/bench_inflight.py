@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import io
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest import mock
+
+import fakeredis
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client
+from PIL import Image
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from ...service import ingredient_service
+from ...service.ai_service import ai_service
+from ...utils import cache_utils
+
+SCORING_RESULT = {
+    "no_valid_ingredients": False,
+    "analysis_summary": {"safety_score": 80, "safety_level": "safe"},
+    "ingredient_groups": [],
+    "health_alerts": [],
+    "key_advice": "Fine in moderation.",
+}
+
+
+class SlowStubModel:
+    """Gemini stand-in with a fixed latency that records peak concurrent calls"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def _enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def _exit(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    @staticmethod
+    def _response(contents):
+        if isinstance(contents, list):
+            # A distinct ingredient per image keeps scoring from hitting the cache
+            token = hashlib.sha256(contents[1].inline_data.data).hexdigest()[:8]
+            return SimpleNamespace(text=json.dumps(
+                {"no_valid_ingredients": False, "ingredients": ["Sugar", f"Additive {token}"]}))
+        return SimpleNamespace(text=json.dumps(SCORING_RESULT))
+
+    def generate_content(self, contents, config=None):
+        self._enter()
+        try:
+            time.sleep(self.latency)
+        finally:
+            self._exit()
+        return self._response(contents)
+
+    async def generate_content_async(self, contents, config=None):
+        self._enter()
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self._exit()
+        return self._response(contents)
+
+
+def noise_jpeg(seed):
+    pixels = np.random.default_rng(seed).integers(0, 255, (96, 128, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=80)
+    return buffer.getvalue()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class Command(BaseCommand):
+    help = ("Load test: max concurrent in-flight analyses per worker for the sync "
+            "WSGI endpoint vs the native async ASGI endpoint, with a stubbed slow model")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Simultaneous analyze requests fired at each deployment')
+        parser.add_argument('--latency', type=float, default=0.25,
+                            help='Seconds the stub model takes per call (two calls per analysis)')
+        parser.add_argument('--wsgi-threads', type=int, default=1,
+                            help='Request threads of the WSGI worker (gunicorn --threads); on SQLite, '
+                                 'more than one can hit "database table is locked"')
+
+    def handle(self, *args, **options):
+        # Scratch database, in-memory Redis and a stub Cloudinary: only the model is "slow"
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        server = fakeredis.FakeServer()
+        model = SlowStubModel(options['latency'])
+        uploads = iter(range(10 ** 9))
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(mock.patch.object(
+                    cache_utils, 'redis_client',
+                    fakeredis.FakeStrictRedis(server=server, decode_responses=True)))
+                stack.enter_context(mock.patch.object(
+                    cache_utils, 'binary_redis_client', fakeredis.FakeStrictRedis(server=server)))
+                stack.enter_context(mock.patch.object(
+                    cache_utils, 'get_async_redis_client',
+                    lambda: fakeredis.FakeAsyncRedis(server=server)))
+                stack.enter_context(mock.patch(
+                    'cloudinary.uploader.upload',
+                    side_effect=lambda f: {'url': 'https://example.invalid/x.jpg',
+                                           'public_id': f"bench/{next(uploads)}"}))
+                stack.enter_context(mock.patch.object(ingredient_service, 'PHASH_ENABLED', False))
+                stack.enter_context(mock.patch.object(ai_service, 'model', model))
+
+                user = User.objects.create_user('bench-inflight', password='bench-pass-123')
+                headers = {'Authorization': f"Bearer {RefreshToken.for_user(user).access_token}"}
+
+                count = options['requests']
+                wsgi = self._run_wsgi(model, headers, range(count), options['wsgi_threads'])
+                asgi = asyncio.run(self._run_asgi(model, headers, range(count, 2 * count)))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write(
+            f"{count} simultaneous analyses, model latency {options['latency'] * 1000:.0f} ms "
+            f"x 2 calls, one worker each")
+        for label, stats in ((f"WSGI (sync view, {options['wsgi_threads']} thread(s))", wsgi),
+                             ("ASGI (async view, 1 event loop)", asgi)):
+            self.stdout.write(
+                f"  {label}:\n"
+                f"    max in-flight analyses: {stats['peak']}\n"
+                f"    wall time:              {stats['wall']:.2f} s "
+                f"({count / stats['wall']:.1f} analyses/s)\n"
+                f"    latency p50 / p95:      {percentile(stats['latencies'], 50):.2f} / "
+                f"{percentile(stats['latencies'], 95):.2f} s\n"
+                f"    errors:                 {stats['errors']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"In-flight per worker: {wsgi['peak']} (WSGI) -> {asgi['peak']} (ASGI)"))
+
+    @staticmethod
+    def _upload(seed):
+        return SimpleUploadedFile(f'bench-{seed}.jpg', noise_jpeg(seed), content_type='image/jpeg')
+
+    def _run_wsgi(self, model, headers, seeds, threads):
+        model.peak = 0
+        start = time.perf_counter()
+
+        def post(seed):
+            # Latency is measured from submission, so it includes time queued for a thread
+            response = Client().post('/api/v1/analysis/analyze/',
+                                     {'image': self._upload(seed), 'category': 'food'},
+                                     headers=headers)
+            return time.perf_counter() - start, response.status_code
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            # Requests queue for the worker's threads, as they would in gunicorn's backlog
+            outcomes = list(pool.map(post, seeds))
+        return self._stats(model, start, outcomes)
+
+    async def _run_asgi(self, model, headers, seeds):
+        model.peak = 0
+        start = time.perf_counter()
+
+        async def post(seed):
+            response = await AsyncClient().post('/api/v1/analysis/analyze/async/',
+                                                {'image': self._upload(seed), 'category': 'food'},
+                                                headers=headers)
+            return time.perf_counter() - start, response.status_code
+
+        outcomes = await asyncio.gather(*(post(seed) for seed in seeds))
+        return self._stats(model, start, outcomes)
+
+    @staticmethod
+    def _stats(model, start, outcomes):
+        wall = time.perf_counter() - start
+        return {
+            'peak': model.peak,
+            'wall': wall,
+            'latencies': [latency for latency, _ in outcomes],
+            'errors': sum(1 for _, status_code in outcomes if status_code != 200),
+        }
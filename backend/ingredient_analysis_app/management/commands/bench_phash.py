@@ -0,0 +1,180 @@
+import io
+import random
+import statistics
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+
+from ...utils.cache_utils import (
+    PerceptualHashIndex,
+    generate_perceptual_hash,
+    redis_client
+)
+
+WORDS = [
+    'Sugar', 'Wheat Flour', 'Palm Oil', 'Cocoa Butter', 'Skim Milk Powder',
+    'Emulsifier (322)', 'Salt', 'Raising Agent (500ii)', 'Glucose Syrup',
+    'Acidity Regulator (330)', 'Natural Flavour', 'Sesame Seeds', 'Soy Lecithin',
+    'Maltodextrin', 'Corn Starch', 'Whey Powder', 'Colour (150d)', 'Yeast Extract',
+]
+
+
+def render_label(rng, width=900, height=600):
+    """Draw a synthetic ingredient panel: a title bar and wrapped ingredient text"""
+    img = Image.new('RGB', (width, height), (rng.randint(225, 255),) * 3)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([0, 0, width, 70], fill=tuple(rng.randint(0, 160) for _ in range(3)))
+    draw.text((20, 25), 'INGREDIENTS', fill='white')
+    y = 95
+    line = ''
+    for word in rng.sample(WORDS, k=rng.randint(8, len(WORDS))):
+        candidate = f"{line}, {word}" if line else word
+        if len(candidate) > 60:
+            draw.text((20, y), line, fill='black')
+            y += 28
+            line = word
+        else:
+            line = candidate
+    draw.text((20, y), line, fill='black')
+    for _ in range(rng.randint(2, 6)):
+        x0, y0 = rng.randint(0, width - 200), rng.randint(y + 40, height - 40)
+        draw.rectangle([x0, y0, x0 + rng.randint(60, 200), y0 + 30],
+                       fill=tuple(rng.randint(0, 255) for _ in range(3)))
+    return img
+
+
+def rephotograph(img, rng):
+    """Simulate a second photo: slight tilt, crop, lighting, blur and JPEG re-encode"""
+    width, height = img.size
+    shot = img.rotate(rng.uniform(-3, 3), resample=Image.Resampling.BILINEAR,
+                      expand=False, fillcolor=(240, 240, 240))
+    dx, dy = int(width * rng.uniform(0, 0.03)), int(height * rng.uniform(0, 0.03))
+    shot = shot.crop((dx, dy, width - int(width * rng.uniform(0, 0.03)),
+                      height - int(height * rng.uniform(0, 0.03))))
+    shot = ImageEnhance.Brightness(shot).enhance(rng.uniform(0.85, 1.15))
+    shot = ImageEnhance.Contrast(shot).enhance(rng.uniform(0.85, 1.15))
+    if rng.random() < 0.5:
+        shot = shot.filter(ImageFilter.GaussianBlur(rng.uniform(0.3, 1.2)))
+    return encode_jpeg(shot, quality=rng.randint(60, 92))
+
+
+def encode_jpeg(img, quality=90):
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def load_corpus(path):
+    """One sub-directory per product; the first image (by name) is the reference"""
+    products = []
+    for product_dir in sorted(p for p in Path(path).iterdir() if p.is_dir()):
+        photos = sorted(f for f in product_dir.iterdir() if f.is_file())
+        if len(photos) >= 2:
+            products.append([f.read_bytes() for f in photos])
+    return products
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the perceptual-hash near-duplicate cache: hit rate on "
+            "re-photographed labels and lookup latency as the index grows")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', help='Directory with one sub-directory of photos per product')
+        parser.add_argument('--products', type=int, default=100,
+                            help='Synthetic products to generate when no corpus is given')
+        parser.add_argument('--shots', type=int, default=4,
+                            help='Re-photographs per synthetic product')
+        parser.add_argument('--sizes', default='1000,10000,100000',
+                            help='Comma-separated index sizes for the latency sweep')
+        parser.add_argument('--queries', type=int, default=500, help='Lookups per index size')
+        parser.add_argument('--max-distance', type=int, default=None)
+        parser.add_argument('--fakeredis', action='store_true',
+                            help='Use an in-memory fakeredis server instead of REDIS_HOST')
+        parser.add_argument('--seed', type=int, default=7)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        if options['fakeredis']:
+            import fakeredis
+            client = fakeredis.FakeStrictRedis(decode_responses=True)
+        else:
+            client = redis_client
+
+        prefix = f"bench_phash:{int(time.time())}"
+        index = PerceptualHashIndex(client=client, prefix=prefix)
+        if options['max_distance'] is not None:
+            index.max_distance = options['max_distance']
+
+        try:
+            self._hit_rate(index, rng, options)
+            self._latency(index, rng, options)
+        finally:
+            for key in client.scan_iter(f"{prefix}:*", count=1000):
+                client.delete(key)
+
+    def _hit_rate(self, index, rng, options):
+        if options['corpus']:
+            products = load_corpus(options['corpus'])
+        else:
+            products = []
+            for _ in range(options['products']):
+                label = render_label(rng)
+                products.append([encode_jpeg(label)] + [
+                    rephotograph(label, rng) for _ in range(options['shots'])])
+
+        for product_id, photos in enumerate(products):
+            index.add('bench', generate_perceptual_hash(photos[0]), f"product-{product_id}")
+
+        hits = wrong = queries = 0
+        distances = []
+        for product_id, photos in enumerate(products):
+            for photo in photos[1:]:
+                queries += 1
+                match = index.find('bench', generate_perceptual_hash(photo))
+                if match is None:
+                    continue
+                if match[0] == f"product-{product_id}":
+                    hits += 1
+                    distances.append(match[1])
+                else:
+                    wrong += 1
+
+        self.stdout.write(
+            f"Corpus: {len(products)} products, {queries} re-photographs, "
+            f"max distance {index.max_distance}")
+        self.stdout.write(
+            f"  near-duplicate hit rate: {hits / max(queries, 1):.1%} "
+            f"(exact SHA-256 hit rate: 0.0%)")
+        self.stdout.write(f"  wrong-product matches:   {wrong / max(queries, 1):.1%}")
+        if distances:
+            self.stdout.write(f"  median matched distance: {statistics.median(distances)}")
+
+    def _latency(self, index, rng, options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        indexed = 0
+        self.stdout.write("Lookup latency (index size: p50 / p95 / p99 ms)")
+        for size in sizes:
+            pipe = index.client.pipeline(transaction=False)
+            while indexed < size:
+                index.add('bench', rng.getrandbits(64), f"filler-{indexed}", pipeline=pipe)
+                indexed += 1
+                if indexed % 1000 == 0:
+                    pipe.execute()
+            pipe.execute()
+
+            timings = []
+            for _ in range(options['queries']):
+                fingerprint = rng.getrandbits(64)
+                start = time.perf_counter()
+                index.find('bench', fingerprint)
+                timings.append((time.perf_counter() - start) * 1000)
+            self.stdout.write(
+                f"  {size:>7}: {percentile(timings, 50):.2f} / "
+                f"{percentile(timings, 95):.2f} / {percentile(timings, 99):.2f}")
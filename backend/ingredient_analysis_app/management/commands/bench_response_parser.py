@@ -0,0 +1,118 @@
+import json
+import logging
+import statistics
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...utils.ai_results import AnalysisResult, ExtractionResult, decode_response, load_object
+from ..benchmarking import synthetic_response
+
+
+def legacy_parse(ai_response):
+    """The parser this replaced: fence stripping, then a first-to-last brace retry"""
+    try:
+        cleaned_response = ai_response.strip().replace(
+            '```json', '').replace('```', '').strip()
+        return json.loads(cleaned_response)
+    except json.JSONDecodeError:
+        try:
+            start_idx = ai_response.find('{')
+            end_idx = ai_response.rfind('}')
+            if start_idx != -1 and end_idx != -1:
+                return json.loads(ai_response[start_idx:end_idx + 1])
+        except Exception:
+            pass
+        return None
+
+
+def malformed(text):
+    """The same answer with the field-level slips models make: strings for numbers, odd enums"""
+    value = json.loads(text)
+    summary = value.get('analysis_summary')
+    if not isinstance(summary, dict):
+        return text
+    summary['safety_score'] = f"{summary.get('safety_score', 50)}%"
+    summary['safety_level'] = str(summary.get('safety_level', '')).upper()
+    summary.pop('concern_count', None)
+    value['health_alerts'] = ['See ingredients below.']
+    value.pop('recommendation', None)
+    return json.dumps(value)
+
+
+# Variant name -> how a response text is wrapped or damaged for it
+VARIANTS = {
+    'plain': lambda text: text,
+    'fenced': lambda text: f"```json\n{text}\n```",
+    'prose_wrapped': lambda text: f"Here is the analysis you asked for:\n\n{text}\n\nStay healthy!",
+    'trailing_text': lambda text: f"{text}\nNote: {{consult a doctor}} for medical advice.",
+    'malformed_fields': malformed,
+    'truncated': lambda text: text[:len(text) * 2 // 3],
+}
+
+
+def timed(func, arg, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(arg)
+    return (time.perf_counter() - start) / repeat * 1e6, result
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the validating response decoder against the previous fence-stripping "
+            "parser on model answers, plain and in the wrappings that hit its fallback path")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', help='Recording written by loadtest --record '
+                                             '(default: synthetic analyses)')
+        parser.add_argument('--samples', type=int, default=100,
+                            help='Synthetic responses when no --corpus is given')
+        parser.add_argument('--repeat', type=int, default=50, help='Timing repetitions per response')
+
+    def handle(self, *args, **options):
+        if options['corpus']:
+            try:
+                responses = list(json.loads(Path(options['corpus']).read_text()).values())
+            except (OSError, ValueError, AttributeError) as e:
+                raise CommandError(f"Cannot read {options['corpus']}: {e}")
+        else:
+            responses = [synthetic_response(f'sample {index}') for index in range(options['samples'])]
+        # Recorded answers may already be fenced; the variants wrap the bare object
+        bare = []
+        for text in responses:
+            value, _ = load_object(text)
+            if isinstance(value, dict):
+                bare.append((json.dumps(value), ExtractionResult
+                             if 'analysis_summary' not in value else AnalysisResult))
+        if not bare:
+            raise CommandError('No JSON answers in the corpus')
+
+        # Truncated answers would log an error per repetition
+        logging.getLogger(decode_response.__module__).setLevel(logging.CRITICAL)
+        repeat = options['repeat']
+        self.stdout.write(f"{len(bare)} {'recorded' if options['corpus'] else 'synthetic'} "
+                          f"responses, {repeat} repetitions each")
+        self.stdout.write(f"{'variant':18} {'legacy us':>10} {'decoder us':>11} "
+                          f"{'legacy ok':>10} {'decoder ok':>11}")
+        for name, variant in VARIANTS.items():
+            rows = []
+            for text, result_type in bare:
+                text = variant(text)
+                legacy_us, legacy = timed(legacy_parse, text, repeat)
+                decoder_us, decoded = timed(
+                    lambda t: self._decode(t, result_type), text, repeat)
+                rows.append((legacy_us, decoder_us, isinstance(legacy, dict), decoded is not None))
+            self.stdout.write(
+                f"{name:18} {statistics.median(r[0] for r in rows):10.1f} "
+                f"{statistics.median(r[1] for r in rows):11.1f} "
+                f"{sum(r[2] for r in rows):>10} {sum(r[3] for r in rows):>11}")
+        self.stdout.write(self.style.SUCCESS(
+            "Decoder times include validation into typed results and to_dict(), as the "
+            "service does; legacy returns the raw dict unchecked. 'ok' counts responses "
+            "each parser returned a result for."))
+
+    @staticmethod
+    def _decode(text, result_type):
+        result = decode_response(text, result_type)
+        return result.to_dict() if result is not None else None
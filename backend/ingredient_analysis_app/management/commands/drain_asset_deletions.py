@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...service.asset_service import asset_deletion_service
+
+
+class Command(BaseCommand):
+    help = ("Destroy the Cloudinary images of deleted analyses queued in the asset outbox, "
+            "in batches with the bulk delete API")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--burst', action='store_true',
+            help='Exit once nothing is due instead of polling for new deletions')
+        parser.add_argument(
+            '--interval', type=float, default=5,
+            help='Seconds to sleep when nothing is due before polling again')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        self.stdout.write("Asset deletion drainer started")
+        deleted = failed = 0
+        try:
+            while True:
+                close_old_connections()
+                batch_deleted, batch_failed = asset_deletion_service.drain(options['batch_size'])
+                deleted += batch_deleted
+                failed += batch_failed
+                if batch_deleted or batch_failed:
+                    self.stdout.write(f"Deleted {batch_deleted}, {batch_failed} to retry")
+                    continue
+                if options['burst']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            close_old_connections()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Asset deletion drainer stopped after {deleted} deleted, {failed} failed attempt(s)"))
@@ -0,0 +1,137 @@
+import csv
+import json
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import Product
+from ...service.ai_service import ai_service
+from ...utils.cache_utils import barcode_scans
+from ...utils.image_utils import normalize_barcode
+
+# Accepted column names, first match wins (the second set is Open Food Facts' export)
+BARCODE_COLUMNS = ('barcode', 'code', 'gtin', 'ean')
+NAME_COLUMNS = ('name', 'product_name')
+INGREDIENT_COLUMNS = ('ingredients', 'ingredients_text')
+
+
+def split_ingredients(text):
+    """Split a label's ingredient text on commas and semicolons outside parentheses"""
+    items, depth, current = [], 0, []
+    for char in text:
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth = max(depth - 1, 0)
+        if char in ',;' and depth == 0:
+            items.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    items.append(''.join(current))
+    return [item.strip().rstrip('.') for item in items]
+
+
+def pick(row, columns):
+    for column in columns:
+        if row.get(column) not in (None, ''):
+            return row[column]
+    return None
+
+
+class Command(BaseCommand):
+    help = ("Bulk-import a product catalog (barcode -> ingredient list) for the barcode fast "
+            "path, and report the share of scans it served")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?',
+                            help='CSV/TSV with a header row, a JSON array or JSON lines; '
+                                 'omit to only print the fast-path report')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--keep-existing', action='store_true',
+                            help='Skip barcodes already known instead of overwriting them')
+        parser.add_argument('--days', type=int, default=7,
+                            help='Days of scan counts to report (at most BARCODE_STATS_RETENTION_DAYS)')
+
+    def handle(self, *args, **options):
+        if options['path']:
+            self._import(Path(options['path']), options)
+        self._report(options['days'])
+
+    def _import(self, path, options):
+        if not path.exists():
+            raise CommandError(f"No such file: {path}")
+        imported = invalid = empty = 0
+        batch = {}
+        for row in self._rows(path):
+            barcode = normalize_barcode(pick(row, BARCODE_COLUMNS) or '')
+            if barcode is None:
+                invalid += 1
+                continue
+            ingredients = pick(row, INGREDIENT_COLUMNS) or []
+            if isinstance(ingredients, str):
+                ingredients = split_ingredients(ingredients)
+            ingredients = ai_service._normalize_ingredients(
+                item for item in ingredients if isinstance(item, str))
+            if not ingredients:
+                empty += 1
+                continue
+            # A later row for the same barcode replaces an earlier one
+            batch[barcode] = Product(barcode=barcode, name=str(pick(row, NAME_COLUMNS) or '')[:255],
+                                     ingredients=ingredients, source=Product.SOURCE_CATALOG)
+            if len(batch) >= options['batch_size']:
+                imported += self._save(batch, options['keep_existing'])
+                batch = {}
+        if batch:
+            imported += self._save(batch, options['keep_existing'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {imported} product(s) from {path}; skipped {invalid} with an invalid "
+            f"barcode and {empty} without ingredients"))
+
+    @staticmethod
+    def _save(batch, keep_existing):
+        products = list(batch.values())
+        if keep_existing:
+            known = set(Product.objects.filter(barcode__in=batch).values_list('barcode', flat=True))
+            products = [product for product in products if product.barcode not in known]
+            Product.objects.bulk_create(products, ignore_conflicts=True)
+        else:
+            Product.objects.bulk_create(
+                products, update_conflicts=True, unique_fields=['barcode'],
+                update_fields=['name', 'ingredients', 'source', 'updated_at'])
+        return len(products)
+
+    @staticmethod
+    def _rows(path):
+        """Rows of the catalog as dicts, whatever its format"""
+        with path.open(encoding='utf-8', newline='') as handle:
+            first_line = handle.readline()
+            handle.seek(0)
+            if first_line.lstrip().startswith('['):
+                yield from json.load(handle)
+            elif first_line.lstrip().startswith('{'):
+                for line in handle:
+                    if line.strip():
+                        yield json.loads(line)
+            else:
+                # Catalog exports carry long ingredient texts
+                csv.field_size_limit(sys.maxsize)
+                yield from csv.DictReader(
+                    handle, delimiter='\t' if '\t' in first_line else ',')
+
+    def _report(self, days):
+        totals = barcode_scans.totals(days)
+        scans = sum(totals.values())
+        if not scans:
+            self.stdout.write(f"No scans reached the barcode check in the last {days} day(s)")
+            return
+        detected = totals['served'] + totals['unknown']
+        self.stdout.write(
+            f"Last {days} day(s): {scans} scan(s) checked for a barcode\n"
+            f"  served by the fast path: {totals['served']} ({totals['served'] / scans:.1%})\n"
+            f"  unknown barcode:         {totals['unknown']} ({totals['unknown'] / scans:.1%})\n"
+            f"  no barcode found:        {totals['none']} ({totals['none'] / scans:.1%})\n"
+            f"  barcode detected in {detected / scans:.1%}; "
+            f"{Product.objects.count()} product(s) known")
@@ -0,0 +1,235 @@
+import itertools
+import json
+import platform
+import subprocess
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from medical_history.models import MedicalHistory
+
+from ...models import IngredientAnalysis
+from ...service.ai_service import ai_service
+from ...utils.admission import gemini_admission
+from ..benchmarking import (
+    ReplayModel, local_stand_ins, noise_jpeg, percentile, scratch_database, synthetic_response
+)
+
+SCENARIOS = ('analyze', 'history', 'medical')
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp'}
+
+
+class Command(BaseCommand):
+    help = ("Load test the analyze, history and medical-history endpoints against local "
+            "stand-ins (scratch database, fakeredis, fake Cloudinary, record/replay Gemini "
+            "stub) and write throughput and latency percentiles as JSON")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                            help='Scenario to run; repeat for several (default: all)')
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=8, help='Client threads')
+        parser.add_argument('--warmup', type=int, default=10,
+                            help='Unmeasured requests per scenario before timing starts')
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--history-rows', type=int, default=100,
+                            help='Saved analyses seeded per user for the history scenario')
+        parser.add_argument('--distinct-images', type=int, default=0,
+                            help='Cycle through this many images (0: every request is a new image); '
+                                 'lower values raise the cache hit rate')
+        parser.add_argument('--images', help='Directory of label photos to use instead of '
+                                             'synthetic images (needed for a useful --record)')
+        parser.add_argument('--latency', type=float, default=0.3,
+                            help='Seconds the stub model takes per call')
+        parser.add_argument('--jitter', type=float, default=0.2,
+                            help='Uniform +/- fraction applied to --latency')
+        parser.add_argument('--upload-latency', type=float, default=0.05,
+                            help='Seconds the fake Cloudinary upload takes')
+        parser.add_argument('--replay', help='Recording to answer model calls from')
+        parser.add_argument('--record', help='Call the real Gemini API and save its answers here')
+        parser.add_argument('--gemini-rate', type=float,
+                            help='Override the shared Gemini admission rate (calls per second); '
+                                 'the configured limit applies otherwise')
+        parser.add_argument('--local-redis', action='store_true',
+                            help='Use the configured Redis instead of fakeredis')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='Result file (default: loadtest-results/<timestamp>.json)')
+
+    def handle(self, *args, **options):
+        if options['record'] and options['replay']:
+            raise CommandError('--record and --replay are mutually exclusive')
+        scenarios = options['scenario'] or list(SCENARIOS)
+        model = self._model(options)
+        images = self._images(options)
+
+        if options['gemini_rate']:
+            gemini_admission.rate = options['gemini_rate']
+            gemini_admission.burst = max(gemini_admission.burst, int(options['gemini_rate']))
+
+        with scratch_database(), local_stand_ins(
+                model, local_redis=options['local_redis'],
+                upload_latency=options['upload_latency']):
+            users = self._seed_users(options)
+            results = {}
+            for scenario in scenarios:
+                requests = getattr(self, f'_{scenario}_requests')(users, images)
+                self._drive(requests, options['warmup'], options['concurrency'])
+                model.calls = model.peak = 0
+                results[scenario] = self._measure(requests, options)
+                results[scenario]['model_calls'] = model.calls
+
+        if options['record']:
+            model.save(options['record'])
+
+        report = {
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git_commit': self._git_commit(),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': settings.DATABASES['default']['ENGINE'],
+                'redis': 'local' if options['local_redis'] else 'fakeredis',
+            },
+            'options': {key: options[key] for key in (
+                'requests', 'concurrency', 'warmup', 'users', 'history_rows', 'distinct_images',
+                'images', 'latency', 'jitter', 'upload_latency', 'replay', 'record', 'seed')},
+            'gemini_admission': {'rate': gemini_admission.rate, 'burst': gemini_admission.burst,
+                                 'max_concurrency': gemini_admission.max_concurrency,
+                                 'enabled': gemini_admission.enabled},
+            'model_responses_replayed': model.replayed,
+            'scenarios': results,
+        }
+        output = Path(options['output'] or Path('loadtest-results') / (
+            datetime.now().strftime('%Y%m%d-%H%M%S') + '.json'))
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(report, indent=2))
+
+        for scenario, stats in results.items():
+            self.stdout.write(
+                f"{scenario:8} {stats['throughput_rps']:7.1f} req/s   p50 {stats['p50_ms']:7.1f} ms   "
+                f"p95 {stats['p95_ms']:7.1f} ms   p99 {stats['p99_ms']:7.1f} ms   "
+                f"errors {stats['errors']}")
+        self.stdout.write(self.style.SUCCESS(f"Results written to {output}"))
+
+    @staticmethod
+    def _model(options):
+        kwargs = {'latency': options['latency'], 'jitter': options['jitter'], 'seed': options['seed']}
+        if options['record']:
+            return ReplayModel(upstream=ai_service._get_model(), **kwargs)
+        if options['replay']:
+            return ReplayModel.from_file(options['replay'], **kwargs)
+        return ReplayModel(**kwargs)
+
+    @staticmethod
+    def _images(options):
+        """Endless iterator of (name, bytes) for the analyze scenario"""
+        if options['images']:
+            paths = sorted(path for path in Path(options['images']).iterdir()
+                           if path.suffix.lower() in IMAGE_SUFFIXES)
+            if not paths:
+                raise CommandError(f"No images found in {options['images']}")
+            if options['distinct_images']:
+                paths = paths[:options['distinct_images']]
+            return itertools.cycle([(path.name, path.read_bytes()) for path in paths])
+        seeds = itertools.count(options['seed'] * 10 ** 6)
+        if options['distinct_images']:
+            seeds = itertools.cycle(range(options['seed'] * 10 ** 6,
+                                          options['seed'] * 10 ** 6 + options['distinct_images']))
+        return ((f'label-{seed}.jpg', noise_jpeg(seed)) for seed in seeds)
+
+    @staticmethod
+    def _seed_users(options):
+        """Users with a medical history, JWT headers and saved analyses to list"""
+        result = json.loads(synthetic_response('seed'))
+        users = []
+        for index in range(options['users']):
+            user = User.objects.create_user(f'loadtest-{index}', password='loadtest-pass-123')
+            MedicalHistory.objects.create(user=user, allergies='Peanuts, Sesame',
+                                          diseases='Hypertension', age=30 + index % 40)
+            IngredientAnalysis.objects.bulk_create([
+                IngredientAnalysis(user=user, category='food',
+                                   image=IngredientAnalysis.image_reference(f'loadtest/seed-{index}-{row}'),
+                                   result=json.dumps(result),
+                                   **IngredientAnalysis.summary_fields(result))
+                for row in range(options['history_rows'])
+            ])
+            users.append({'Authorization': f"Bearer {RefreshToken.for_user(user).access_token}"})
+        return users
+
+    @staticmethod
+    def _analyze_requests(users, images):
+        for headers in itertools.cycle(users):
+            name, content = next(images)
+            yield lambda client, headers=headers, name=name, content=content: client.post(
+                '/api/v1/analysis/analyze/',
+                {'image': SimpleUploadedFile(name, content, content_type='image/jpeg'),
+                 'category': 'food'},
+                headers=headers)
+
+    @staticmethod
+    def _history_requests(users, images):
+        for headers in itertools.cycle(users):
+            yield lambda client, headers=headers: client.get(
+                '/api/v1/analysis/history/', headers=headers)
+
+    @staticmethod
+    def _medical_requests(users, images):
+        # Mostly reads; every fifth request updates the profile (and invalidates its cache)
+        for index, headers in enumerate(itertools.cycle(users)):
+            if index % 5 == 4:
+                yield lambda client, headers=headers, index=index: client.patch(
+                    '/api/v1/medical/', {'age': 20 + index % 50},
+                    content_type='application/json', headers=headers)
+            else:
+                yield lambda client, headers=headers: client.get('/api/v1/medical/', headers=headers)
+
+    @staticmethod
+    def _drive(requests, count, concurrency):
+        """Send `count` requests from `concurrency` threads; returns (latency, status) pairs"""
+        batch = list(itertools.islice(requests, count))
+
+        def send(request):
+            start = time.perf_counter()
+            response = request(Client())
+            return time.perf_counter() - start, response.status_code
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(send, batch))
+
+    def _measure(self, requests, options):
+        start = time.perf_counter()
+        outcomes = self._drive(requests, options['requests'], options['concurrency'])
+        wall = time.perf_counter() - start
+        latencies = [latency * 1000 for latency, _ in outcomes]
+        statuses = Counter(str(status_code) for _, status_code in outcomes)
+        return {
+            'requests': len(outcomes),
+            'wall_s': round(wall, 3),
+            'throughput_rps': round(len(outcomes) / wall, 2),
+            'mean_ms': round(sum(latencies) / len(latencies), 2),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'max_ms': round(max(latencies), 2),
+            'errors': sum(count for status_code, count in statuses.items()
+                          if not status_code.startswith('2')),
+            'status_codes': dict(statuses),
+        }
+
+    @staticmethod
+    def _git_commit():
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  cwd=settings.BASE_DIR, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...service.job_queue import RedisJobQueue
+from ...service.job_service import analysis_job_service
+
+
+class Command(BaseCommand):
+    help = "Process queued ingredient analysis jobs from the Redis queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--burst', action='store_true',
+            help='Exit once the queue is empty instead of waiting for new jobs')
+        parser.add_argument(
+            '--timeout', type=int, default=5,
+            help='Seconds to block waiting for a job before polling again')
+        parser.add_argument(
+            '--no-recover', action='store_true',
+            help='Do not re-enqueue pending jobs and jobs whose worker died')
+        parser.add_argument(
+            '--recover-interval', type=int, default=60,
+            help='Seconds between checks for jobs whose worker died (lease expired)')
+
+    def handle(self, *args, **options):
+        queue = RedisJobQueue()
+        recover = not options['no_recover']
+
+        if recover:
+            recovered = analysis_job_service.recover(queue)
+            if recovered:
+                self.stdout.write(f"Re-enqueued {recovered} job(s)")
+        next_recovery = time.monotonic() + options['recover_interval']
+
+        self.stdout.write("Analysis worker started")
+        processed = 0
+        try:
+            while True:
+                if recover and time.monotonic() >= next_recovery:
+                    # Another worker may have died holding a job
+                    close_old_connections()
+                    analysis_job_service.recover(queue, include_pending=False)
+                    next_recovery = time.monotonic() + options['recover_interval']
+
+                job_id = queue.dequeue(timeout=options['timeout'])
+                if job_id is None:
+                    if options['burst']:
+                        break
+                    continue
+
+                close_old_connections()
+                job = analysis_job_service.process(job_id)
+                if job is not None:
+                    processed += 1
+                    self.stdout.write(f"Job {job.id}: {job.status}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            close_old_connections()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Analysis worker stopped after {processed} job(s)"))
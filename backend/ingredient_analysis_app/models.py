@@ -1,9 +1,20 @@
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
 from django.db import models
 from django.contrib.auth.models import User
 from cloudinary.models import CloudinaryField
-from django.db.models.signals import pre_delete
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_delete, post_save, post_delete
 from django.dispatch import receiver
-import cloudinary
+from django.utils import timezone
+from medical_history.models import MedicalHistory
+from .utils.cache_utils import mark_assets_deleted, profile_cache, profile_cache_key
+from .utils.metrics import time_db_query
+
+# Set while collect_asset_deletions() gathers the images of a bulk delete
+_asset_batch = ContextVar('asset_deletion_batch', default=None)
 
 
 class IngredientAnalysis(models.Model):
@@ -13,14 +24,228 @@ class IngredientAnalysis(models.Model):
     result = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    # Copied out of `result` when the row is written so the history list
+    # can be served without loading or parsing the JSON
+    safety_score = models.PositiveSmallIntegerField(null=True, blank=True, db_index=True)
+    safety_level = models.CharField(max_length=20, blank=True, db_index=True)
+    verdict = models.CharField(max_length=20, blank=True, db_index=True)
+    concern_count = models.PositiveSmallIntegerField(null=True, blank=True, db_index=True)
+    main_verdict = models.TextField(blank=True)
+
+    SUMMARY_FIELDS = ['safety_score', 'safety_level', 'verdict', 'concern_count', 'main_verdict']
+
     class Meta:
-        ordering = ['-timestamp']
+        ordering = ['-timestamp', '-id']
+        indexes = [
+            # History pages and date ranges for one user, newest first
+            models.Index(fields=['user', '-timestamp', '-id'], name='analysis_user_recent_idx'),
+            # The same, filtered by category
+            models.Index(fields=['user', 'category', '-timestamp', '-id'],
+                         name='analysis_user_cat_recent_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.category} - {self.timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
 
+    @staticmethod
+    def image_reference(public_id):
+        """Value stored in `image` for an asset uploaded by the analyze pipeline"""
+        return f"v1/{public_id}"
+
+    @classmethod
+    def referenced_public_ids(cls, public_ids, chunk_size=500):
+        """The subset of `public_ids` that saved analyses still show"""
+        image_field = cls._meta.get_field('image')
+        public_ids = list(public_ids)
+        referenced = set()
+        for start in range(0, len(public_ids), chunk_size):
+            images = cls.objects.filter(image__in=[
+                cls.image_reference(public_id) for public_id in public_ids[start:start + chunk_size]
+            ]).values_list('image', flat=True)
+            referenced.update(image_field.to_python(image).public_id for image in images)
+        return referenced
+
+    @staticmethod
+    def summary_fields(result):
+        """Summary column values for a parsed analysis result"""
+        summary = result.get('analysis_summary') or {}
+        recommendation = result.get('recommendation') or {}
+
+        def small_int(value, upper):
+            try:
+                return min(max(int(value), 0), upper)
+            except (TypeError, ValueError):
+                return None
+
+        def label(value):
+            return str(value or '').strip().lower()[:20]
+
+        return {
+            'safety_score': small_int(summary.get('safety_score'), 100),
+            'safety_level': label(summary.get('safety_level')),
+            'verdict': label(recommendation.get('verdict')),
+            'concern_count': small_int(summary.get('concern_count'), 32767),
+            'main_verdict': str(summary.get('main_verdict') or ''),
+        }
+
+
+class AnalysisJob(models.Model):
+    """Queued ingredient analysis processed outside the request cycle"""
+
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    category = models.CharField(max_length=100)
+    # Raw upload kept until the worker has processed it
+    image_data = models.BinaryField(blank=True)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    analysis = models.ForeignKey(
+        IngredientAnalysis, null=True, blank=True, on_delete=models.SET_NULL)
+    error = models.TextField(blank=True)
+    # Times a worker claimed the job, and when the current claim was made
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # Not claimed before this time (set when Gemini turned the job away as busy)
+    retry_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.user.username} - {self.category} - {self.status}"
+
+
+class Product(models.Model):
+    """
+    Ingredient list of a product, by barcode (GTIN). Photos showing a known
+    barcode are scored without the Gemini vision call. Rows are learned from
+    extractions of photos that showed the barcode, or imported from a
+    catalog with `manage.py import_products`.
+    """
+
+    SOURCE_ANALYSIS = 'analysis'
+    SOURCE_CATALOG = 'catalog'
+    SOURCE_CHOICES = [
+        (SOURCE_ANALYSIS, 'Analysis'),
+        (SOURCE_CATALOG, 'Catalog'),
+    ]
+
+    barcode = models.CharField(max_length=14, unique=True)
+    name = models.CharField(max_length=255, blank=True)
+    ingredients = models.JSONField()
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES, default=SOURCE_ANALYSIS)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['barcode']
+
+    def __str__(self):
+        return f"{self.barcode} {self.name}".strip()
+
+    @classmethod
+    def ingredients_for(cls, barcode):
+        """Known ingredient list for `barcode`, or None"""
+        return cls.objects.filter(barcode=barcode).values_list('ingredients', flat=True).first()
+
+    @classmethod
+    async def aingredients_for(cls, barcode):
+        return await cls.objects.filter(barcode=barcode).values_list(
+            'ingredients', flat=True).afirst()
+
+    @classmethod
+    def learn(cls, barcode, ingredients):
+        """Remember an extraction; an existing row (e.g. from the catalog) is kept"""
+        cls.objects.get_or_create(
+            barcode=barcode, defaults={'ingredients': ingredients, 'source': cls.SOURCE_ANALYSIS})
+
+
+class PendingAssetDeletion(models.Model):
+    """
+    Outbox of Cloudinary assets to destroy. Deleting analyses only records
+    their images here; `manage.py drain_asset_deletions` removes them in
+    batches with the bulk delete API and retries failures with backoff.
+    """
+    public_id = models.CharField(max_length=255, unique=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['next_attempt_at']
+
+    def __str__(self):
+        return f"{self.public_id} ({self.attempts} attempts)"
+
+    @classmethod
+    def schedule(cls, public_ids):
+        """Queue assets no analysis shows any more; returns how many were queued"""
+        public_ids = set(public_ids)
+        if not public_ids:
+            return 0
+        # Cached analyses share one upload between rows; keep it while referenced
+        orphaned = public_ids - IngredientAnalysis.referenced_public_ids(public_ids)
+        cls.objects.bulk_create(
+            [cls(public_id=public_id) for public_id in orphaned], ignore_conflicts=True)
+        # Cache hits re-upload from now on instead of handing out the doomed URL
+        mark_assets_deleted(orphaned)
+        return len(orphaned)
+
+
+@contextmanager
+def collect_asset_deletions():
+    """
+    Gather the images of analyses deleted inside the block and queue them
+    with one reference check and one insert after the transaction commits.
+    """
+    public_ids = set()
+    token = _asset_batch.set(public_ids)
+    try:
+        yield public_ids
+    finally:
+        _asset_batch.reset(token)
+    transaction.on_commit(lambda: PendingAssetDeletion.schedule(public_ids))
+
 
 @receiver(pre_delete, sender=IngredientAnalysis)
 def delete_cloudinary_image(sender, instance, **kwargs):
-    if instance.image:
-        cloudinary.uploader.destroy(instance.image.public_id)
+    if not instance.image:
+        return
+    # Instances that were never reloaded still hold the raw "v1/<id>" string
+    public_id = sender._meta.get_field(
+        'image').to_python(instance.image).public_id
+    batch = _asset_batch.get()
+    if batch is not None:
+        batch.add(public_id)
+    else:
+        # After commit: a rolled-back delete keeps its image, and the
+        # reference check no longer counts the row being deleted
+        transaction.on_commit(lambda: PendingAssetDeletion.schedule([public_id]))
+
+
+@receiver([post_save, post_delete], sender=MedicalHistory)
+def invalidate_cached_profile(sender, instance, **kwargs):
+    # After commit; invalidating earlier lets a concurrent read re-cache the old row
+    transaction.on_commit(
+        lambda: profile_cache.invalidate(profile_cache_key(instance.user_id)))
+
+
+@receiver(connection_created)
+def time_database_queries(sender, connection, **kwargs):
+    # Wrappers survive reconnects, so only add it once per connection object
+    if time_db_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_db_query)
@@ -1,7 +1,15 @@
+import json
+import sys
+from pathlib import Path
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
-from .models import IngredientAnalysis
+from .models import IngredientAnalysis, AnalysisJob
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from config.configuration import BATCH_MAX_IMAGES
 
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
@@ -72,8 +80,8 @@ class IngredientAnalysisSerializer(serializers.ModelSerializer):
     class Meta:
         model = IngredientAnalysis
         fields = ['id', 'user', 'category', 'image',
-                  'image_url', 'result', 'timestamp']
-        read_only_fields = ['id', 'user', 'result', 'timestamp']
+                  'image_url', 'result', 'timestamp', *IngredientAnalysis.SUMMARY_FIELDS]
+        read_only_fields = ['id', 'user', 'result', 'timestamp', *IngredientAnalysis.SUMMARY_FIELDS]
 
     def get_image_url(self, obj):
         if obj.image:
@@ -81,6 +89,90 @@ class IngredientAnalysisSerializer(serializers.ModelSerializer):
         return None
 
 
+class IngredientAnalysisListSerializer(serializers.ModelSerializer):
+    """History list entry: the summary columns instead of the full result"""
+    image_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = IngredientAnalysis
+        fields = ['id', 'category', 'image_url', 'timestamp',
+                  *IngredientAnalysis.SUMMARY_FIELDS]
+        read_only_fields = fields
+
+    def get_image_url(self, obj):
+        if obj.image:
+            return obj.image.url
+        return None
+
+
+class HistoryFilterSerializer(serializers.Serializer):
+    """Optional query parameters of the history list and feed"""
+    category = serializers.CharField(max_length=100, required=False)
+    since = serializers.DateTimeField(required=False, help_text="Analyses at or after this time")
+    until = serializers.DateTimeField(required=False, help_text="Analyses before this time")
+
+    def validate(self, attrs):
+        if 'since' in attrs and 'until' in attrs and attrs['since'] >= attrs['until']:
+            raise serializers.ValidationError({"until": "Must be later than since."})
+        return attrs
+
+
+class HistoryPurgeSerializer(HistoryFilterSerializer):
+    """Query parameters of the bulk history delete"""
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), required=False, max_length=1000,
+        help_text="Only these analyses (repeat the parameter for several)")
+    all = serializers.BooleanField(
+        required=False, default=False, help_text="Required to delete the whole history")
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if not attrs['all'] and not {'category', 'since', 'until', 'ids'} & attrs.keys():
+            raise serializers.ValidationError(
+                "Give a filter, or all=true to delete the whole history.")
+        return attrs
+
+
 class AnalyzeRequestSerializer(serializers.Serializer):
     image = serializers.ImageField()
     category = serializers.CharField(max_length=100)
+    mode = serializers.ChoiceField(
+        choices=['sync', 'async'], default='sync', required=False)
+
+
+class AnalyzeBatchRequestSerializer(serializers.Serializer):
+    images = serializers.ListField(
+        child=serializers.ImageField(), min_length=1, max_length=BATCH_MAX_IMAGES)
+    categories = serializers.ListField(
+        child=serializers.CharField(max_length=100), min_length=1,
+        help_text="One category per image, or a single category for all of them")
+
+    def validate(self, attrs):
+        images, categories = attrs['images'], attrs['categories']
+        if len(categories) == 1:
+            categories = categories * len(images)
+        elif len(categories) != len(images):
+            raise serializers.ValidationError(
+                {"categories": "Provide one category per image, or a single category."})
+        attrs['items'] = list(zip(images, categories))
+        return attrs
+
+
+class AnalysisJobSerializer(serializers.ModelSerializer):
+    analysis = serializers.SerializerMethodField()
+
+    class Meta:
+        model = AnalysisJob
+        fields = ['id', 'category', 'status', 'error',
+                  'analysis', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+    def get_analysis(self, obj):
+        if obj.status != AnalysisJob.STATUS_COMPLETED or not obj.analysis:
+            return None
+        return {
+            'id': obj.analysis.id,
+            'category': obj.analysis.category,
+            'created_at': obj.analysis.timestamp,
+            'result': json.loads(obj.analysis.result)
+        }
@@ -1,10 +1,21 @@
-import json
+import asyncio
+import io
 import logging
 import sys
 from pathlib import Path
-import google.genai as genai
+from google.genai import types
 from PIL import Image
 
+from ..utils.admission import GeminiBusy
+from ..utils.ai_results import (
+    AnalysisResult, ExtractionResult, EXTRACTION_SCHEMA, SCORING_SCHEMA, decode_response
+)
+from ..utils.context_cache import ContextCache, is_missing_cache_error, record_token_usage
+from ..utils.gemini import GeminiModel, shared_client
+from ..utils.metrics import record_gemini_failure
+from ..utils.resilience import gemini_resilience
+from ..utils.timing import span
+
 # Add the parent directory to the path to import config module
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
 
@@ -17,6 +28,7 @@ class AIAnalysisService:
     """Service for AI-powered ingredient analysis using Google Gemini"""
 
     _instance = None
+    MODEL_NAME = 'gemini-2.0-flash'
 
     def __new__(cls):
         if not cls._instance:
@@ -27,40 +39,61 @@ class AIAnalysisService:
     def __init__(self):
         if not self._initialized:
             self.model = None
-            self.prompt_template = self._create_prompt_template()
+            self.extraction_prompt = self._create_extraction_prompt()
+            self.scoring_instruction = self._create_scoring_instruction()
+            self.request_template = self._create_request_template()
+            # The static instructions are sent once as cached content when possible
+            self.extraction_cache = ContextCache(
+                'extraction', self.MODEL_NAME, self.extraction_prompt)
+            self.scoring_cache = ContextCache(
+                'scoring', self.MODEL_NAME, self.scoring_instruction)
+            # JSON mode: Gemini answers with exactly these shapes, no fences or prose
+            self.extraction_config = self._json_config(EXTRACTION_SCHEMA)
+            self.scoring_config = self._json_config(SCORING_SCHEMA)
             self._initialized = True
 
     def _get_api_key(self):
-        """Validate and set Gemini API key"""
+        """Validate the Gemini API key"""
         if not GEMINI_API_KEY:
             raise ValueError("GEMINI_API_KEY environment variable is required")
-        genai.configure(api_key=GEMINI_API_KEY)
         return GEMINI_API_KEY
 
     def _get_model(self):
         """Get or create the Gemini model instance"""
         if self.model is None:
             self._get_api_key()
-            self.model = genai.GenerativeModel('gemini-2.0-flash')
+            self.model = GeminiModel(shared_client(), self.MODEL_NAME)
         return self.model
 
-    def _create_prompt_template(self):
-        """Create the prompt template for ingredient analysis"""
-        system_template = """You are an expert health advisor and food scientist. Analyze the ingredients from the attached image for a user with the following health profile:
-        - AGE: {age}
-        - LIFE STAGE: {life_stage}
-        - ALLERGIES: {allergies}
-        - MEDICAL CONDITIONS: {diseases}
-        - DIETARY PREFERENCES: {dietary_preferences}
-        - CURRENT MEDICATIONS: {medications}
-        - SKIN TYPE: {skin_type}
-        - HEALTH GOALS: {health_goals}
-        - REGION: {region}
-        - PRODUCT CATEGORY: {category}
+    @staticmethod
+    def _json_config(schema):
+        return types.GenerateContentConfig(
+            response_mime_type='application/json', response_schema=schema)
+
+    def _create_extraction_prompt(self):
+        """Create the profile-independent prompt for reading ingredients off a label"""
+        return """You are an expert food scientist reading a product label. Extract the ingredient list from the attached image.
 
         **Instructions:**
 
         1.  **Extract & Refine**: Identify all ingredients, correct OCR errors, normalize names, and remove duplicates.
+        2.  **Keep Detail**: Keep additive codes and sub-ingredients (e.g., "Acidity Regulator (331)", "Chocolate (Sugar, Cocoa Butter)").
+        3.  **No Ingredients**: If the image does not show a readable ingredient list, set "no_valid_ingredients" to true and return an empty list.
+        4.  **JSON Output**: Return a single, clean JSON object with the exact structure below. Do not include any text, markdown, or explanations outside of the JSON structure.
+
+        **JSON Structure:**
+        {
+            "no_valid_ingredients": false,
+            "ingredients": ["Ingredient one", "Ingredient two"]
+        }"""
+
+    def _create_scoring_instruction(self):
+        """Create the static, profile-independent part of the analysis prompt"""
+        return """You are an expert health advisor and food scientist. Each request gives a user's health profile, a product category and the product's ingredients; analyze the ingredients for that user.
+
+        **Instructions:**
+
+        1.  **Review**: Treat the ingredient list in the request as authoritative. Do not add ingredients that are not listed.
         2.  **Filter**: Exclude common, low-impact ingredients (like Water, Salt) unless they are relevant to a specific medical condition (e.g., Salt for hypertension).
         3.  **Group & Consolidate**: Group the filtered ingredients into logical categories. **Crucially, consolidate similar items.** For example, instead of listing four different acidity regulators, create one entry for "Acidity Regulators" and list the specific types (331, 332, etc.) within its details.
         4.  **Detailed Analysis**: For each consolidated group or significant ingredient, determine its purpose, safety, and relevance to the user's profile.
@@ -69,9 +102,9 @@ class AIAnalysisService:
         7.  **JSON Output**: Format the entire analysis as a single, clean JSON object with the exact structure provided below. Do not include any text, markdown, or explanations outside of the JSON structure.
         
         **JSON Structure:**
-        {{
+        {
             "no_valid_ingredients": false,
-            "analysis_summary": {{
+            "analysis_summary": {
                 "safety_score": 0-100,
                 "safety_level": "safe",
                 "should_use": true,
@@ -79,12 +112,12 @@ class AIAnalysisService:
                 "detailed_explanation": "A more in-depth paragraph explaining the product's composition, its pros and cons for the user, and how it aligns with their health goals.",
                 "nutritional_highlights": "A brief overview of key nutritional aspects, like 'High in Protein' or 'Contains Added Sugars'.",
                 "concern_count": 2
-            }},
+            },
             "ingredient_groups": [
-                {{
+                {
                     "group_name": "e.g., Milk-Based Ingredients",
                     "ingredients": [
-                        {{
+                        {
                             "name": "e.g., Skim Milk, Cream",
                             "purpose": "The primary function of this ingredient.",
                             "status": "safe | caution | danger",
@@ -92,90 +125,304 @@ class AIAnalysisService:
                             "user_specific_risk": false,
                             "quick_summary": "Concise 1-line description of health impact.",
                             "why_flagged": "Reason for concern if flagged, otherwise null."
-                        }}
+                        }
                     ]
-                }}
+                }
             ],
             "health_alerts": [
-                {{
+                {
                     "type": "allergy_match | condition_risk | interaction_warning",
                     "severity": "low | medium | high",
                     "message": "Brief, clear warning message.",
                     "ingredient": "Exact ingredient name.",
                     "action": "Practical recommended action for the user."
-                }}
+                }
             ],
-            "recommendation": {{
+            "recommendation": {
                 "verdict": "recommend | caution | avoid",
                 "confidence": "high | medium | low",
                 "reason": "Short explanation for the recommendation.",
                 "safe_to_try": true
-            }},
+            },
             "alternatives": [
-                {{
+                {
                     "name": "Name of a real, commercially available product in the user's region.",
                     "why": "Reason it's a better alternative for this user.",
                     "benefit": "Key health benefit for the user."
-                }}
+                }
             ],
             "key_advice": "The single most important piece of actionable advice for this user regarding this product."
-        }}"""
+        }"""
 
-        return system_template
+    def _create_request_template(self):
+        """Create the per-request part of the analysis prompt (profile and ingredients)"""
+        return """Analyze the following product ingredients for a user with the following health profile:
+        - AGE: {age}
+        - LIFE STAGE: {life_stage}
+        - ALLERGIES: {allergies}
+        - MEDICAL CONDITIONS: {diseases}
+        - DIETARY PREFERENCES: {dietary_preferences}
+        - CURRENT MEDICATIONS: {medications}
+        - SKIN TYPE: {skin_type}
+        - HEALTH GOALS: {health_goals}
+        - REGION: {region}
+        - PRODUCT CATEGORY: {category}
+
+        **Ingredients (as read from the product label):**
+        {ingredients}"""
 
-    def analyze_ingredients(self, image_file, category, user_profile):
-        """Analyze ingredients using Gemini AI model"""
+    def extract_ingredients(self, image_file):
+        """Read the normalized ingredient list from a label image (vision call)"""
         try:
-            model_instance = self._get_model()
-
-            prompt = self.prompt_template.format(
-                category=category,
-                age=user_profile.get('age', 'Not specified'),
-                life_stage=user_profile.get('life_stage', 'Not specified'),
-                allergies=", ".join(user_profile.get('allergies', ['None'])),
-                diseases=", ".join(user_profile.get('diseases', ['None'])),
-                dietary_preferences=", ".join(
-                    user_profile.get('dietary_preferences', ['None'])),
-                medications=", ".join(
-                    user_profile.get('medications', ['None'])),
-                skin_type=user_profile.get('skin_type', 'Not specified'),
-                health_goals=", ".join(
-                    user_profile.get('health_goals', ['None'])),
-                region=user_profile.get('region', 'Not specified')
-            )
-
-            img = Image.open(image_file)
-
-            response = model_instance.generate_content([prompt, img])
-
-            if response and hasattr(response, 'text') and response.text:
-                logger.info("Received response from Gemini AI")
-                return self._parse_ai_response(response.text)
-            else:
-                logger.error("Empty or invalid response from Gemini")
-                return self._get_error_response()
+            image_part = self._image_part(image_file)
+            response = self._generate(
+                'extract', self.extraction_cache, self.extraction_config, [image_part],
+                [self.extraction_prompt, image_part])
 
+            return self._extraction_result(response)
+
+        except GeminiBusy:
+            raise
+        except Exception as e:
+            logger.error(f"AI extraction error: {str(e)}")
+            return self._extraction_error()
+
+    async def extract_ingredients_async(self, image_file):
+        """extract_ingredients for the async path: awaits Gemini instead of blocking"""
+        try:
+            image_part = self._image_part(image_file)
+            response = await self._agenerate(
+                'extract', self.extraction_cache, self.extraction_config, [image_part],
+                [self.extraction_prompt, image_part])
+
+            return self._extraction_result(response)
+
+        except GeminiBusy:
+            raise
+        except Exception as e:
+            logger.error(f"AI extraction error: {str(e)}")
+            return self._extraction_error()
+
+    def score_ingredients(self, ingredients, category, user_profile):
+        """Analyze an extracted ingredient list against the user's profile (text-only call)"""
+        try:
+            request = self._format_request(ingredients, category, user_profile)
+            response = self._generate(
+                'score', self.scoring_cache, self.scoring_config, request,
+                self._inline_prompt(request))
+
+            return self._scoring_result(response)
+
+        except GeminiBusy:
+            raise
         except Exception as e:
             logger.error(f"AI analysis error: {str(e)}")
             return self._get_error_response()
 
-    def _parse_ai_response(self, ai_response):
-        """Parse AI response with comprehensive error handling"""
+    async def score_ingredients_async(self, ingredients, category, user_profile):
+        """score_ingredients for the async path: awaits Gemini instead of blocking"""
         try:
-            # Clean the response to remove markdown code blocks
-            cleaned_response = ai_response.strip().replace(
-                '```json', '').replace('```', '').strip()
-            return json.loads(cleaned_response)
-        except json.JSONDecodeError:
+            request = self._format_request(ingredients, category, user_profile)
+            response = await self._agenerate(
+                'score', self.scoring_cache, self.scoring_config, request,
+                self._inline_prompt(request))
+
+            return self._scoring_result(response)
+
+        except GeminiBusy:
+            raise
+        except Exception as e:
+            logger.error(f"AI analysis error: {str(e)}")
+            return self._get_error_response()
+
+    def _generate(self, call, cache, config, request_contents, inline_contents):
+        """
+        generate_content with the static instruction taken from the context
+        cache, or sent inline while the cache is unavailable
+        """
+        cached_model = cache.model()
+        if cached_model is not None:
             try:
-                start_idx = ai_response.find('{')
-                end_idx = ai_response.rfind('}')
-                if start_idx != -1 and end_idx != -1:
-                    json_str = ai_response[start_idx:end_idx + 1]
-                    return json.loads(json_str)
+                response = gemini_resilience.call(
+                    call, lambda: cached_model.generate_content(
+                        request_contents, config=config))
+                record_token_usage(call, response)
+                return response
             except Exception as e:
-                logger.error(f"Failed to extract JSON: {str(e)}")
+                if not is_missing_cache_error(e):
+                    raise
+                logger.warning(f"Gemini context cache '{cache.label}' expired: {str(e)}")
+                cache.invalidate(cached_model)
+
+        model_instance = self._get_model()
+        response = gemini_resilience.call(
+            call, lambda: model_instance.generate_content(
+                inline_contents, config=config))
+        record_token_usage(call, response)
+        return response
+
+    async def _agenerate(self, call, cache, config, request_contents, inline_contents):
+        """Async variant of _generate; both answer through GeminiModel"""
+        cached_model = await asyncio.to_thread(cache.model)
+        if cached_model is not None:
+            try:
+                response = await gemini_resilience.acall(
+                    call, lambda: cached_model.generate_content_async(
+                        request_contents, config=config))
+                record_token_usage(call, response)
+                return response
+            except Exception as e:
+                if not is_missing_cache_error(e):
+                    raise
+                logger.warning(f"Gemini context cache '{cache.label}' expired: {str(e)}")
+                await asyncio.to_thread(cache.invalidate, cached_model)
+
+        model_instance = self._get_model()
+        response = await gemini_resilience.acall(
+            call, lambda: model_instance.generate_content_async(
+                inline_contents, config=config))
+        record_token_usage(call, response)
+        return response
+
+    def _image_part(self, image_file):
+        """Inline image blob for the extraction call"""
+        # Send the (already size-budgeted) bytes as-is; a PIL image would be re-encoded
+        image_file.seek(0)
+        image_data = image_file.read()
+        with Image.open(io.BytesIO(image_data)) as img:
+            mime_type = Image.MIME.get(img.format, 'image/jpeg')
+        return types.Part.from_bytes(data=image_data, mime_type=mime_type)
+
+    def _extraction_result(self, response):
+        if response and hasattr(response, 'text') and response.text:
+            logger.info("Received extraction response from Gemini AI")
+            with span('parse'):
+                extraction = decode_response(response.text, ExtractionResult)
+            if extraction is None:
+                # Unparseable, not an empty label: not worth remembering
+                return self._extraction_error()
+            ingredients = self._normalize_ingredients(extraction.ingredients)
+            if ingredients and not extraction.no_valid_ingredients:
+                return {"no_valid_ingredients": False, "ingredients": ingredients}
+            # The model looked at the image and found nothing: safe to remember
+            return {**self._extraction_error(), "cacheable": True}
+        else:
+            logger.error("Empty or invalid extraction response from Gemini")
+            record_gemini_failure('extract', 'EmptyResponse')
+        return self._extraction_error()
+
+    def _extraction_error(self):
+        # Unreadable label: same shape as a failed analysis, with no ingredients
+        return {**self._get_error_response(), "ingredients": []}
+
+    def _scoring_result(self, response):
+        if response and hasattr(response, 'text') and response.text:
+            logger.info("Received response from Gemini AI")
+            return self._parse_ai_response(response.text)
+        logger.error("Empty or invalid response from Gemini")
+        record_gemini_failure('score', 'EmptyResponse')
+        return self._get_error_response()
+
+    def score_ingredients_stream(self, ingredients, category, user_profile):
+        """
+        Streaming variant of score_ingredients: yields the raw response text
+        chunk by chunk as Gemini generates it, and returns the parsed result
+        (as the generator's return value) once the stream ends.
+        """
+        chunks = []
+        try:
+            request = self._format_request(ingredients, category, user_profile)
+
+            for chunk in self._generate_stream(
+                    'score_stream', self.scoring_cache, self.scoring_config, request,
+                    self._inline_prompt(request)):
+                text = getattr(chunk, 'text', None)
+                if text:
+                    chunks.append(text)
+                    yield text
+
+        except GeminiBusy:
+            raise
+        except Exception as e:
+            logger.error(f"AI streaming analysis error: {str(e)}")
+            return self._get_error_response()
+
+        if not chunks:
+            logger.error("Empty or invalid streaming response from Gemini")
+            record_gemini_failure('score_stream', 'EmptyResponse')
             return self._get_error_response()
+        logger.info("Received streamed response from Gemini AI")
+        return self._parse_ai_response(''.join(chunks))
+
+    def _generate_stream(self, call, cache, config, request_contents,
+                         inline_contents):
+        """
+        Streamed _generate. Falls back to the inline prompt only if the cache
+        turns out to be gone before the first chunk.
+        """
+        cached_model = cache.model()
+        if cached_model is not None:
+            chunk = None
+            try:
+                for chunk in gemini_resilience.stream(call, lambda: cached_model.generate_content_stream(
+                        request_contents, config=config)):
+                    yield chunk
+                record_token_usage(call, chunk)
+                return
+            except Exception as e:
+                if chunk is not None or not is_missing_cache_error(e):
+                    raise
+                logger.warning(f"Gemini context cache '{cache.label}' expired: {str(e)}")
+                cache.invalidate(cached_model)
+
+        model_instance = self._get_model()
+        chunk = None
+        for chunk in gemini_resilience.stream(call, lambda: model_instance.generate_content_stream(
+                inline_contents, config=config)):
+            yield chunk
+        # Usage totals arrive with the last chunk
+        record_token_usage(call, chunk)
+
+    def _inline_prompt(self, request):
+        """Scoring instruction and request as one prompt, for calls without the context cache"""
+        return f"{self.scoring_instruction}\n\n        {request}"
+
+    def _format_request(self, ingredients, category, user_profile):
+        """Fill the per-request part of the analysis prompt with the ingredients and profile"""
+        return self.request_template.format(
+            category=category,
+            ingredients="\n        ".join(f"- {name}" for name in ingredients),
+            age=user_profile.get('age', 'Not specified'),
+            life_stage=user_profile.get('life_stage', 'Not specified'),
+            allergies=", ".join(user_profile.get('allergies', ['None'])),
+            diseases=", ".join(user_profile.get('diseases', ['None'])),
+            dietary_preferences=", ".join(
+                user_profile.get('dietary_preferences', ['None'])),
+            medications=", ".join(
+                user_profile.get('medications', ['None'])),
+            skin_type=user_profile.get('skin_type', 'Not specified'),
+            health_goals=", ".join(
+                user_profile.get('health_goals', ['None'])),
+            region=user_profile.get('region', 'Not specified')
+        )
+
+    @staticmethod
+    def _normalize_ingredients(ingredients):
+        """Collapse whitespace and drop case-insensitive duplicates, keeping label order"""
+        normalized = []
+        seen = set()
+        for name in ingredients:
+            name = " ".join(name.split())
+            if name and name.lower() not in seen:
+                seen.add(name.lower())
+                normalized.append(name)
+        return normalized
+
+    def _parse_ai_response(self, ai_response):
+        """Validated analysis from the response text; the error response when it is unusable"""
+        with span('parse'):
+            result = decode_response(ai_response, AnalysisResult)
+        return result.to_dict() if result is not None else self._get_error_response()
 
     def _get_error_response(self):
         """Return standardized error response"""
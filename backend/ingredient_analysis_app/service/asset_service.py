@@ -0,0 +1,118 @@
+import datetime
+import logging
+import sys
+from pathlib import Path
+import cloudinary.api
+from django.db import transaction
+from django.utils import timezone
+from ..models import IngredientAnalysis, PendingAssetDeletion, collect_asset_deletions
+from ..utils.metrics import ASSET_DELETIONS, CLOUDINARY_SECONDS
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import (
+    ASSET_DELETION_BACKEND, ASSET_DELETION_BATCH_SIZE, ASSET_DELETION_MAX_ATTEMPTS,
+    ASSET_DELETION_RETRY_BASE_SECONDS, ASSET_DELETION_RETRY_MAX_SECONDS,
+    ASSET_DELETION_LEASE_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+# Most public ids the Cloudinary bulk delete API accepts per call
+CLOUDINARY_DELETE_LIMIT = 100
+# Per-id results of delete_resources that need no retry
+GONE = ('deleted', 'not_found')
+
+
+class AssetDeletionService:
+    """Deletes analyses without waiting on Cloudinary and drains the asset outbox"""
+
+    @staticmethod
+    def purge(queryset):
+        """
+        Delete analyses with one queryset delete; their images are queued in
+        the outbox. Returns the number of analyses deleted.
+        """
+        with transaction.atomic(), collect_asset_deletions():
+            _, per_model = queryset.delete()
+        return per_model.get(IngredientAnalysis._meta.label, 0)
+
+    @staticmethod
+    def delete_user(user):
+        """Delete an account and everything it owns; its images go through the outbox"""
+        with transaction.atomic(), collect_asset_deletions():
+            user.delete()
+
+    @staticmethod
+    def discard(public_id):
+        """Queue an upload that never made it into an analysis"""
+        PendingAssetDeletion.schedule([public_id])
+
+    @staticmethod
+    def drain(batch_size=ASSET_DELETION_BATCH_SIZE):
+        """
+        Destroy one batch of due assets. Returns (deleted, failed); (0, 0)
+        when nothing is due.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            due = list(PendingAssetDeletion.objects.select_for_update(skip_locked=True).filter(
+                next_attempt_at__lte=now, attempts__lt=ASSET_DELETION_MAX_ATTEMPTS
+            )[:min(batch_size, CLOUDINARY_DELETE_LIMIT)])
+            # Lease the batch so a second drainer skips it while Cloudinary is called
+            PendingAssetDeletion.objects.filter(pk__in=[row.pk for row in due]).update(
+                next_attempt_at=now + datetime.timedelta(seconds=ASSET_DELETION_LEASE_SECONDS))
+        if not due:
+            return 0, 0
+
+        # An analysis may have picked the asset up from the cache before it was queued
+        referenced = IngredientAnalysis.referenced_public_ids(row.public_id for row in due)
+        if referenced:
+            PendingAssetDeletion.objects.filter(public_id__in=referenced).delete()
+            ASSET_DELETIONS.labels('kept').inc(len(referenced))
+        due = [row for row in due if row.public_id not in referenced]
+        if not due:
+            return 0, 0
+
+        error = None
+        try:
+            with CLOUDINARY_SECONDS.labels('delete_resources').time():
+                response = AssetDeletionService._delete_resources([row.public_id for row in due])
+            statuses = response.get('deleted', {})
+        except Exception as e:
+            logger.error(f"Cloudinary bulk delete failed: {str(e)}")
+            statuses = {}
+            error = str(e)
+
+        done = [row.public_id for row in due if statuses.get(row.public_id) in GONE]
+        PendingAssetDeletion.objects.filter(public_id__in=done).delete()
+        ASSET_DELETIONS.labels('deleted').inc(len(done))
+
+        failed = [row for row in due if row.public_id not in done]
+        for row in failed:
+            row.attempts += 1
+            row.last_error = error or f"Cloudinary returned {statuses.get(row.public_id)!r}"
+            row.next_attempt_at = now + datetime.timedelta(seconds=min(
+                ASSET_DELETION_RETRY_BASE_SECONDS * 2 ** (row.attempts - 1),
+                ASSET_DELETION_RETRY_MAX_SECONDS))
+            if row.attempts >= ASSET_DELETION_MAX_ATTEMPTS:
+                logger.error(f"Giving up on deleting Cloudinary asset {row.public_id}: "
+                             f"{row.last_error}")
+                ASSET_DELETIONS.labels('abandoned').inc()
+            else:
+                ASSET_DELETIONS.labels('retry').inc()
+        PendingAssetDeletion.objects.bulk_update(
+            failed, ['attempts', 'last_error', 'next_attempt_at'])
+        return len(done), len(failed)
+
+    @staticmethod
+    def _delete_resources(public_ids):
+        if ASSET_DELETION_BACKEND == 'log':
+            logger.info(f"Would delete Cloudinary assets: {', '.join(public_ids)}")
+            return {'deleted': {public_id: 'deleted' for public_id in public_ids}}
+        return cloudinary.api.delete_resources(public_ids)
+
+
+# Service instance
+asset_deletion_service = AssetDeletionService()
@@ -1,74 +1,560 @@
+import asyncio
 import json
 import logging
 import hashlib
-from PIL import Image
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import cloudinary.uploader
-from ..utils.cache_utils import redis_client, generate_image_cache_key
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from medical_history.models import MedicalHistory
+from ..models import IngredientAnalysis, Product
+from ..utils.admission import GeminiBusy, requester
+from ..utils.cache_utils import (
+    generate_image_cache_key,
+    generate_perceptual_hash,
+    perceptual_hash_index,
+    is_asset_deleted,
+    ais_asset_deleted,
+    single_flight,
+    unreadable_images,
+    barcode_scans,
+    analysis_cache,
+    profile_cache,
+    profile_cache_key
+)
+from ..utils.image_utils import detect_barcode, prepare_image
+from ..utils.json_stream import IncrementalJSONParser
+from ..utils.metrics import CLOUDINARY_SECONDS, IMAGE_BYTES
+from ..utils.timing import span
 from .ai_service import ai_service
+from .asset_service import asset_deletion_service
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import (
+    PHASH_ENABLED, BATCH_MAX_WORKERS, NEGATIVE_CACHE_ENABLED, BARCODE_FAST_PATH_ENABLED
+)
 
 logger = logging.getLogger(__name__)
 
+# Profile of users without a medical history
+DEFAULT_PROFILE = {
+    **MedicalHistory.default_profile(),
+    'profile_hash': MedicalHistory.hash_profile(MedicalHistory.default_profile())
+}
+
+# Top-level fields pushed to streaming clients as soon as they are complete
+STREAMED_FIELDS = ('analysis_summary', 'health_alerts')
+
 
 class IngredientAnalysisService:
     """Main service coordinating AI analysis"""
 
     @staticmethod
-    def analyze_image(image_file, category, user):
+    def analyze_image(image_file, category, user, user_profile=None):
+        """
+        Cache-first analysis pipeline:
+        hash -> profile fetch -> ingredient extraction -> profile-specific scoring.
+
+        Extraction (the vision call, plus the Cloudinary upload) is cached per
+        image for every user; scoring is a text-only call cached per
+        ingredient list, category and profile. Callers that already hold the
+        user's profile can pass it to skip the fetch.
+        """
         try:
-            image_file.seek(0)
-            image_content = image_file.read()
-            image_file.seek(0)
+            with requester(user):
+                image_hash = IngredientAnalysisService._hash_image(image_file)
 
-            image_hash = generate_image_cache_key(image_content)
+                if user_profile is None:
+                    user_profile = IngredientAnalysisService._get_user_medical_history(
+                        user)
 
-            # Upload image to Cloudinary
-            upload_result = cloudinary.uploader.upload(image_file)
-            image_url = upload_result.get('url')
-            public_id = upload_result.get('public_id')
+                extraction = IngredientAnalysisService._get_extraction(
+                    image_file, image_hash, category, getattr(user, 'pk', None))
+                if extraction.get('no_valid_ingredients'):
+                    return {
+                        'success': False,
+                        'error': extraction['result'].get('key_advice', 'Unable to process ingredients from image'),
+                        'result': extraction['result']
+                    }
+
+                analysis_result = IngredientAnalysisService._get_scoring(
+                    extraction['ingredients'], category, user_profile)
+                if analysis_result.get('no_valid_ingredients', False):
+                    return {
+                        'success': False,
+                        'error': analysis_result.get('key_advice', 'Unable to process ingredients from image'),
+                        'result': analysis_result
+                    }
+
+                return {
+                    'success': True,
+                    'result': analysis_result,
+                    'image_url': extraction['image_url'],
+                    'public_id': extraction['public_id']
+                }
+        except GeminiBusy:
+            raise
+        except Exception as e:
+            logger.error(f"Ingredient analysis error: {str(e)}")
+            return {
+                'success': False,
+                'error': f'Processing failed: {str(e)}',
+                'result': None
+            }
 
-            user_profile = IngredientAnalysisService._get_user_medical_history(
-                user)
+    @staticmethod
+    def analyze_batch(items, user, max_workers=BATCH_MAX_WORKERS):
+        """
+        Analyze a list of (image_file, category) pairs for one user.
 
-            # Generate unique cache key based on the full profile
-            cache_key_str = image_hash + category + \
-                json.dumps(user_profile, sort_keys=True)
-            cache_key = f"ingredient_analysis:{hashlib.sha256(cache_key_str.encode()).hexdigest()}"
+        The medical profile is fetched once, identical images in the same
+        category are analyzed once, and the remaining images run
+        concurrently on a bounded thread pool. Returns one analyze_image
+        result per item, in order, each with 'timings' (ms spent queued for
+        a worker and analyzing) and 'duplicate_of' (the index whose result
+        it reuses, or None).
+        """
+        user_profile = IngredientAnalysisService._get_user_medical_history(
+            user)
 
-            # Check Redis cache
-            cached_result = redis_client.get(cache_key)
-            if cached_result:
-                return json.loads(cached_result)
+        first_index = {}
+        duplicate_of = []
+        for index, (image_file, category) in enumerate(items):
+            key = (IngredientAnalysisService._hash_image(image_file), category)
+            duplicate_of.append(first_index.setdefault(key, index))
+        unique = [index for index, first in enumerate(duplicate_of) if first == index]
 
-            # Directly pass the image and the full user profile to the AI service
-            analysis_result = ai_service.analyze_ingredients(
-                image_file=image_file,
-                category=category,
-                user_profile=user_profile
-            )
+        def analyze(index, submitted_at):
+            started_at = time.perf_counter()
+            image_file, category = items[index]
+            # Pool threads open their own DB connections (product lookups, asset outbox)
+            close_old_connections()
+            try:
+                result = IngredientAnalysisService.analyze_image(
+                    image_file, category, user, user_profile=user_profile)
+            except GeminiBusy as e:
+                # Only this item is turned away; the rest of the batch still counts
+                result = {'success': False, 'error': str(e), 'result': None,
+                          'retry_after': e.retry_after}
+            finally:
+                close_old_connections()
+            result['timings'] = {
+                'queued_ms': round((started_at - submitted_at) * 1000, 1),
+                'analysis_ms': round((time.perf_counter() - started_at) * 1000, 1)
+            }
+            return result
 
-            # Cache only successful analyses with 7-day TTL
-            if not analysis_result.get('no_valid_ingredients', False):
-                analysis_result["metadata"] = {
-                    "status": "completed"
+        # The profile was read above; threads close the connections they open
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique)))) as pool:
+            submitted_at = time.perf_counter()
+            futures = {index: pool.submit(analyze, index, submitted_at) for index in unique}
+            for index, future in futures.items():
+                results[index] = {**future.result(), 'duplicate_of': None}
+
+        for index, first in enumerate(duplicate_of):
+            if first != index:
+                results[index] = {
+                    **results[first],
+                    'duplicate_of': first,
+                    'timings': {'queued_ms': 0.0, 'analysis_ms': 0.0}
                 }
-                response_obj = {
+        return [results[index] for index in range(len(items))]
+
+    @staticmethod
+    def analyze_image_stream(image_file, category, user):
+        """
+        Streaming variant of analyze_image. Yields (event, data) pairs as
+        soon as each part of the analysis is complete: 'analysis_summary',
+        one 'ingredient_group' per group, 'health_alerts', and finally
+        'result' (the dict analyze_image would return) or 'error'.
+        """
+        try:
+            with requester(user):
+                image_hash = IngredientAnalysisService._hash_image(image_file)
+
+                user_profile = IngredientAnalysisService._get_user_medical_history(
+                    user)
+
+                extraction = IngredientAnalysisService._get_extraction(
+                    image_file, image_hash, category, getattr(user, 'pk', None))
+                if extraction.get('no_valid_ingredients'):
+                    yield 'error', {
+                        'success': False,
+                        'error': extraction['result'].get('key_advice', 'Unable to process ingredients from image'),
+                        'result': extraction['result']
+                    }
+                    return
+
+                cache_key = IngredientAnalysisService._build_cache_key(
+                    extraction['ingredients'], category, user_profile)
+                with span('cache'):
+                    analysis_result = analysis_cache.get(cache_key)
+                token = None
+                if analysis_result is None:
+                    token = single_flight.acquire(cache_key)
+                    if token is None:
+                        # An identical request is already scoring; replay its result
+                        analysis_result = single_flight.wait(cache_key)
+
+                if analysis_result:
+                    yield from IngredientAnalysisService._replay_stream_events(
+                        analysis_result)
+                else:
+                    try:
+                        analysis_result = yield from IngredientAnalysisService._stream_scoring(
+                            extraction['ingredients'], category, user_profile)
+                        if analysis_result.get('no_valid_ingredients', False):
+                            yield 'error', {
+                                'success': False,
+                                'error': analysis_result.get('key_advice', 'Unable to process ingredients from image'),
+                                'result': analysis_result
+                            }
+                            return
+                        IngredientAnalysisService._store_scoring(
+                            cache_key, analysis_result)
+                    finally:
+                        if token is not None:
+                            single_flight.release(cache_key, token)
+
+                yield 'result', {
                     'success': True,
                     'result': analysis_result,
-                    'image_url': image_url,
-                    'public_id': public_id
+                    'image_url': extraction['image_url'],
+                    'public_id': extraction['public_id']
                 }
-                redis_client.set(cache_key, json.dumps(
-                    response_obj), ex=604800)  # TTL 7 days
+        except GeminiBusy as e:
+            yield 'error', {
+                'success': False,
+                'error': str(e),
+                'result': None,
+                'retry_after': e.retry_after
+            }
+        except Exception as e:
+            logger.error(f"Ingredient analysis stream error: {str(e)}")
+            yield 'error', {
+                'success': False,
+                'error': f'Processing failed: {str(e)}',
+                'result': None
+            }
+
+    @staticmethod
+    def _stream_scoring(ingredients, category, user_profile):
+        """Relay Gemini's streamed scoring as events; returns the parsed result"""
+        parser = IncrementalJSONParser(item_keys=['ingredient_groups'])
+        stream = ai_service.score_ingredients_stream(
+            ingredients=ingredients,
+            category=category,
+            user_profile=user_profile
+        )
+        while True:
+            try:
+                chunk = next(stream)
+            except StopIteration as finished:
+                return finished.value
+
+            if parser is None:
+                continue
+            try:
+                events = parser.feed(chunk)
+            except ValueError as e:
+                # Malformed partial JSON: stop streaming parts, the final parse still runs
+                logger.warning(f"Incremental parse failed: {str(e)}")
+                parser = None
+                continue
+            for event in events:
+                if event.kind == 'item':
+                    yield 'ingredient_group', {'index': event.index, 'group': event.value}
+                elif event.key in STREAMED_FIELDS:
+                    yield event.key, event.value
+
+    @staticmethod
+    def _replay_stream_events(analysis_result):
+        """Emit a cached result as the same events a live stream produces"""
+        yield 'analysis_summary', analysis_result.get('analysis_summary', {})
+        for index, group in enumerate(analysis_result.get('ingredient_groups', [])):
+            yield 'ingredient_group', {'index': index, 'group': group}
+        yield 'health_alerts', analysis_result.get('health_alerts', [])
+
+    @staticmethod
+    def _get_extraction(image_file, image_hash, category, user_id=None):
+        """
+        Ingredient list for the image, shared by all users.
+        Exact-hash misses fall back to the perceptual index so re-photographs
+        of a known label reuse its extraction. Cache hits reuse the image
+        uploaded by the original extraction. Images the model recently
+        could not read get their stored failure back (see NegativeCache).
+        Photos showing the barcode of a known Product take its ingredient
+        list instead of a vision call.
+        """
+        cache_key = f"ingredient_extraction:{image_hash}"
+        with span('cache'):
+            extraction = analysis_cache.get(cache_key)
+            if extraction is None and NEGATIVE_CACHE_ENABLED:
+                failure = unreadable_images.get(image_hash)
+                if failure is not None:
+                    unreadable_images.hit(image_hash, user_id)
+                    return {'no_valid_ingredients': True, 'result': failure}
+
+        barcode = known_ingredients = None
+        if extraction is None and BARCODE_FAST_PATH_ENABLED:
+            with span('barcode'):
+                barcode = IngredientAnalysisService._detect_barcode(image_file)
+                if barcode:
+                    known_ingredients = Product.ingredients_for(barcode)
+            barcode_scans.record(IngredientAnalysisService._scan_outcome(
+                barcode, known_ingredients))
+
+        fingerprint = None
+        if extraction is None and known_ingredients is None and PHASH_ENABLED:
+            with span('phash'):
+                fingerprint, match = IngredientAnalysisService._find_similar(
+                    image_file, category)
+            if match:
+                similar_key = f"ingredient_extraction:{match[0]}"
+                with span('cache'):
+                    extraction = analysis_cache.get(similar_key)
+                if extraction:
+                    cache_key = similar_key
+            elif NEGATIVE_CACHE_ENABLED:
+                with span('cache'):
+                    similar = unreadable_images.find_similar(category, fingerprint, user_id)
+                if similar is not None:
+                    unreadable_images.hit(similar[0], user_id)
+                    return {'no_valid_ingredients': True, 'result': similar[1]}
+
+        if extraction:
+            with span('cache'):
+                asset_deleted = is_asset_deleted(extraction['public_id'])
+            if asset_deleted:
+                return IngredientAnalysisService._reupload_cached(
+                    image_file, cache_key, extraction)
+            return extraction
+
+        # Concurrent identical uploads wait for one worker to extract
+        return single_flight.run(
+            cache_key,
+            lambda: IngredientAnalysisService._extract_and_cache(
+                image_file, cache_key, image_hash, category, fingerprint, user_id,
+                barcode, known_ingredients)
+        )
+
+    @staticmethod
+    def _extract_and_cache(image_file, cache_key, image_hash, category, fingerprint,
+                           user_id=None, barcode=None, known_ingredients=None):
+        """
+        Extraction miss path: upload, vision call (skipped when the barcode
+        named a known product), then cache and index
+        """
+        # A single-flight follower lands here once the leader lets go; the
+        # leader may have just recorded the image as unreadable
+        if NEGATIVE_CACHE_ENABLED:
+            failure = unreadable_images.get(image_hash)
+            if failure is not None:
+                unreadable_images.hit(image_hash, user_id)
+                return {'no_valid_ingredients': True, 'result': failure}
+
+        # Downscale once; the same bytes go to Cloudinary and to Gemini
+        prepared_file = IngredientAnalysisService._prepare_image(image_file)
+
+        upload_result = IngredientAnalysisService._upload_image(prepared_file)
+        public_id = upload_result.get('public_id')
+
+        if known_ingredients is not None:
+            extracted = {'no_valid_ingredients': False, 'ingredients': known_ingredients}
+        else:
+            extracted = ai_service.extract_ingredients(prepared_file)
+        if extracted['no_valid_ingredients']:
+            # Delete the uploaded image if the analysis fails
+            asset_deletion_service.discard(public_id)
+            if extracted.pop('cacheable', False) and NEGATIVE_CACHE_ENABLED:
+                unreadable_images.add(image_hash, category, fingerprint, extracted, user_id)
+            return {'no_valid_ingredients': True, 'result': extracted}
+
+        extraction = {
+            'ingredients': extracted['ingredients'],
+            'image_url': upload_result.get('url'),
+            'public_id': public_id
+        }
+        analysis_cache.set(cache_key, extraction)
+        if fingerprint is not None:
+            perceptual_hash_index.add(category, fingerprint, image_hash)
+        if barcode and known_ingredients is None:
+            Product.learn(barcode, extracted['ingredients'])
+        return extraction
+
+    @staticmethod
+    def _detect_barcode(image_file):
+        """Product barcode in the image, or None if there is none or OpenCV cannot decode it"""
+        try:
+            return detect_barcode(image_file)
+        except Exception as e:
+            logger.warning(f"Barcode detection failed: {str(e)}")
+            image_file.seek(0)
+            return None
+
+    @staticmethod
+    def _scan_outcome(barcode, known_ingredients):
+        if known_ingredients is not None:
+            return 'served'
+        return 'unknown' if barcode else 'none'
+
+    @staticmethod
+    def _find_similar(image_file, category):
+        """Perceptual fingerprint of the image and its nearest indexed match, if any"""
+        fingerprint = IngredientAnalysisService._fingerprint_image(image_file)
+        match = perceptual_hash_index.find(
+            category, fingerprint) if fingerprint is not None else None
+        return fingerprint, match
+
+    @staticmethod
+    def _fingerprint_image(image_file):
+        """Perceptual hash of the image, or None if Pillow cannot decode it"""
+        try:
+            return generate_perceptual_hash(image_file)
+        except Exception as e:
+            logger.warning(f"Perceptual hash failed: {str(e)}")
+            image_file.seek(0)
+            return None
+
+    @staticmethod
+    def _prepare_image(image_file):
+        """Size-budgeted JPEG of the upload, or the original if Pillow cannot decode it"""
+        try:
+            with span('prepare'):
+                return prepare_image(image_file).file
+        except Exception as e:
+            logger.warning(f"Image preprocessing failed: {str(e)}")
+            image_file.seek(0)
+            return image_file
+
+    @staticmethod
+    def _get_scoring(ingredients, category, user_profile):
+        """Profile-specific analysis of an ingredient list (text-only AI call)"""
+        cache_key = IngredientAnalysisService._build_cache_key(
+            ingredients, category, user_profile)
+        with span('cache'):
+            cached_result = analysis_cache.get(cache_key)
+        if cached_result:
+            return cached_result
+
+        return single_flight.run(
+            cache_key,
+            lambda: IngredientAnalysisService._score_and_cache(
+                cache_key, ingredients, category, user_profile)
+        )
+
+    @staticmethod
+    def _score_and_cache(cache_key, ingredients, category, user_profile):
+        """Scoring miss path: text-only AI call, cached when successful"""
+        analysis_result = ai_service.score_ingredients(
+            ingredients=ingredients,
+            category=category,
+            user_profile=user_profile
+        )
+
+        # Cache only successful analyses
+        if not analysis_result.get('no_valid_ingredients', False):
+            IngredientAnalysisService._store_scoring(
+                cache_key, analysis_result)
+        return analysis_result
+
+    @staticmethod
+    def _store_scoring(cache_key, analysis_result):
+        analysis_result["metadata"] = {
+            "status": "completed"
+        }
+        analysis_cache.set(cache_key, analysis_result)
+
+    @staticmethod
+    def _hash_image(image_file):
+        """Content hash of the uploaded image, leaving the file rewound"""
+        with span('hash'):
+            image_file.seek(0)
+            image_content = image_file.read()
+            image_file.seek(0)
+            IMAGE_BYTES.labels('received').observe(len(image_content))
+            return generate_image_cache_key(image_content)
+
+    @staticmethod
+    def _build_cache_key(ingredients, category, user_profile):
+        """Cache key covering the ingredient list, the category and the full profile"""
+        profile_hash = user_profile.get('profile_hash') or MedicalHistory.hash_profile(user_profile)
+        cache_key_str = json.dumps(ingredients) + category + profile_hash
+        return f"ingredient_analysis:{hashlib.sha256(cache_key_str.encode()).hexdigest()}"
+
+    @staticmethod
+    def _upload_image(image_file):
+        """Upload the image to Cloudinary, leaving the file rewound for the AI"""
+        image_file.seek(0, io.SEEK_END)
+        IMAGE_BYTES.labels('uploaded').observe(image_file.tell())
+        image_file.seek(0)
+        with CLOUDINARY_SECONDS.labels('upload').time(), span('upload'):
+            upload_result = cloudinary.uploader.upload(image_file)
+        image_file.seek(0)
+        return upload_result
+
+    @staticmethod
+    def _reupload_cached(image_file, cache_key, cached_result):
+        """Keep a cached extraction but replace its since-deleted image"""
+        upload_result = IngredientAnalysisService._upload_image(
+            IngredientAnalysisService._prepare_image(image_file))
+        cached_result['image_url'] = upload_result.get('url')
+        cached_result['public_id'] = upload_result.get('public_id')
+        analysis_cache.set(cache_key, cached_result)
+        return cached_result
+
+    @staticmethod
+    async def analyze_image_async(image_file, category, user, user_profile=None):
+        """
+        Native async variant of analyze_image for the ASGI deployment.
+
+        Cache and lock traffic uses redis.asyncio and Gemini calls are
+        awaited, so a worker can hold many analyses open while they wait on
+        the model. Blocking work (PIL, Cloudinary, the ORM profile read and
+        the perceptual index) runs in threads.
+        """
+        try:
+            with requester(user):
+                image_hash = await asyncio.to_thread(
+                    IngredientAnalysisService._hash_image, image_file)
+
+                if user_profile is None:
+                    user_profile = await sync_to_async(
+                        IngredientAnalysisService._get_user_medical_history)(user)
+
+                extraction = await IngredientAnalysisService._get_extraction_async(
+                    image_file, image_hash, category, getattr(user, 'pk', None))
+                if extraction.get('no_valid_ingredients'):
+                    return {
+                        'success': False,
+                        'error': extraction['result'].get('key_advice', 'Unable to process ingredients from image'),
+                        'result': extraction['result']
+                    }
+
+                analysis_result = await IngredientAnalysisService._get_scoring_async(
+                    extraction['ingredients'], category, user_profile)
+                if analysis_result.get('no_valid_ingredients', False):
+                    return {
+                        'success': False,
+                        'error': analysis_result.get('key_advice', 'Unable to process ingredients from image'),
+                        'result': analysis_result
+                    }
 
-                return response_obj
-            else:
-                # Delete the uploaded image if the analysis fails
-                cloudinary.uploader.destroy(public_id)
                 return {
-                    'success': False,
-                    'error': analysis_result.get('key_advice', 'Unable to process ingredients from image'),
-                    'result': analysis_result
+                    'success': True,
+                    'result': analysis_result,
+                    'image_url': extraction['image_url'],
+                    'public_id': extraction['public_id']
                 }
+        except GeminiBusy:
+            raise
         except Exception as e:
             logger.error(f"Ingredient analysis error: {str(e)}")
             return {
@@ -78,33 +564,202 @@ class IngredientAnalysisService:
             }
 
     @staticmethod
-    def _get_user_medical_history(user):
-        """Extract user's full medical profile safely"""
-        profile = {
-            "allergies": ["No allergies specified"],
-            "diseases": ["No diseases specified"],
-            "age": None,
-            "life_stage": "",
-            "dietary_preferences": [],
-            "medications": [],
-            "skin_type": "",
-            "health_goals": [],
-            "region": ""
+    async def _get_extraction_async(image_file, image_hash, category, user_id=None):
+        """Async variant of _get_extraction"""
+        cache_key = f"ingredient_extraction:{image_hash}"
+        with span('cache'):
+            extraction = await analysis_cache.aget(cache_key)
+            if extraction is None and NEGATIVE_CACHE_ENABLED:
+                failure = await unreadable_images.aget(image_hash)
+                if failure is not None:
+                    await unreadable_images.ahit(image_hash, user_id)
+                    return {'no_valid_ingredients': True, 'result': failure}
+
+        barcode = known_ingredients = None
+        if extraction is None and BARCODE_FAST_PATH_ENABLED:
+            with span('barcode'):
+                barcode = await asyncio.to_thread(
+                    IngredientAnalysisService._detect_barcode, image_file)
+                if barcode:
+                    known_ingredients = await Product.aingredients_for(barcode)
+            await barcode_scans.arecord(IngredientAnalysisService._scan_outcome(
+                barcode, known_ingredients))
+
+        fingerprint = None
+        if extraction is None and known_ingredients is None and PHASH_ENABLED:
+            with span('phash'):
+                fingerprint, match = await asyncio.to_thread(
+                    IngredientAnalysisService._find_similar, image_file, category)
+            if match:
+                similar_key = f"ingredient_extraction:{match[0]}"
+                with span('cache'):
+                    extraction = await analysis_cache.aget(similar_key)
+                if extraction:
+                    cache_key = similar_key
+            elif NEGATIVE_CACHE_ENABLED:
+                with span('cache'):
+                    similar = await asyncio.to_thread(
+                        unreadable_images.find_similar, category, fingerprint, user_id)
+                if similar is not None:
+                    await unreadable_images.ahit(similar[0], user_id)
+                    return {'no_valid_ingredients': True, 'result': similar[1]}
+
+        if extraction:
+            with span('cache'):
+                asset_deleted = await ais_asset_deleted(extraction['public_id'])
+            if asset_deleted:
+                return await asyncio.to_thread(
+                    IngredientAnalysisService._reupload_cached,
+                    image_file, cache_key, extraction)
+            return extraction
+
+        return await single_flight.arun(
+            cache_key,
+            lambda: IngredientAnalysisService._extract_and_cache_async(
+                image_file, cache_key, image_hash, category, fingerprint, user_id,
+                barcode, known_ingredients)
+        )
+
+    @staticmethod
+    async def _extract_and_cache_async(image_file, cache_key, image_hash, category, fingerprint,
+                                       user_id=None, barcode=None, known_ingredients=None):
+        if NEGATIVE_CACHE_ENABLED:
+            failure = await unreadable_images.aget(image_hash)
+            if failure is not None:
+                await unreadable_images.ahit(image_hash, user_id)
+                return {'no_valid_ingredients': True, 'result': failure}
+
+        prepared_file = await asyncio.to_thread(
+            IngredientAnalysisService._prepare_image, image_file)
+
+        upload_result = await asyncio.to_thread(
+            IngredientAnalysisService._upload_image, prepared_file)
+        public_id = upload_result.get('public_id')
+
+        if known_ingredients is not None:
+            extracted = {'no_valid_ingredients': False, 'ingredients': known_ingredients}
+        else:
+            extracted = await ai_service.extract_ingredients_async(prepared_file)
+        if extracted['no_valid_ingredients']:
+            await sync_to_async(asset_deletion_service.discard)(public_id)
+            if extracted.pop('cacheable', False) and NEGATIVE_CACHE_ENABLED:
+                await asyncio.to_thread(
+                    unreadable_images.add, image_hash, category, fingerprint, extracted, user_id)
+            return {'no_valid_ingredients': True, 'result': extracted}
+
+        extraction = {
+            'ingredients': extracted['ingredients'],
+            'image_url': upload_result.get('url'),
+            'public_id': public_id
         }
-        if hasattr(user, 'medicalhistory') and user.medicalhistory:
-            history = user.medicalhistory
-            profile.update({
-                "allergies": [a.strip() for a in history.allergies.split(',')] if history.allergies else [],
-                "diseases": [d.strip() for d in history.diseases.split(',')] if history.diseases else [],
-                "age": history.age,
-                "life_stage": history.life_stage,
-                "dietary_preferences": [p.strip() for p in history.dietary_preferences.split(',')] if history.dietary_preferences else [],
-                "medications": [m.strip() for m in history.medications.split(',')] if history.medications else [],
-                "skin_type": history.skin_type,
-                "health_goals": [g.strip() for g in history.health_goals.split(',')] if history.health_goals else [],
-                "region": history.region
-            })
-        return profile
+        await analysis_cache.aset(cache_key, extraction)
+        if fingerprint is not None:
+            await asyncio.to_thread(
+                perceptual_hash_index.add, category, fingerprint, image_hash)
+        if barcode and known_ingredients is None:
+            await sync_to_async(Product.learn)(barcode, extracted['ingredients'])
+        return extraction
+
+    @staticmethod
+    async def _get_scoring_async(ingredients, category, user_profile):
+        """Async variant of _get_scoring"""
+        cache_key = IngredientAnalysisService._build_cache_key(
+            ingredients, category, user_profile)
+        with span('cache'):
+            cached_result = await analysis_cache.aget(cache_key)
+        if cached_result:
+            return cached_result
+
+        async def score_and_cache():
+            analysis_result = await ai_service.score_ingredients_async(
+                ingredients=ingredients,
+                category=category,
+                user_profile=user_profile
+            )
+            if not analysis_result.get('no_valid_ingredients', False):
+                analysis_result["metadata"] = {
+                    "status": "completed"
+                }
+                await analysis_cache.aset(cache_key, analysis_result)
+            return analysis_result
+
+        return await single_flight.arun(cache_key, score_and_cache)
+
+    @staticmethod
+    async def asave_analysis(user, category, analysis_result):
+        """Async variant of save_analysis"""
+        with span('db'):
+            return await IngredientAnalysis.objects.acreate(
+                **IngredientAnalysisService._analysis_fields(user, category, analysis_result))
+
+    @staticmethod
+    def save_analysis(user, category, analysis_result):
+        """Persist a successful analysis result as an IngredientAnalysis row"""
+        with span('db'):
+            return IngredientAnalysis.objects.create(
+                **IngredientAnalysisService._analysis_fields(user, category, analysis_result))
+
+    @staticmethod
+    def save_analyses(user, entries):
+        """Persist (category, analysis_result) pairs with a single bulk INSERT"""
+        return IngredientAnalysis.objects.bulk_create([
+            IngredientAnalysis(
+                **IngredientAnalysisService._analysis_fields(user, category, analysis_result))
+            for category, analysis_result in entries
+        ])
+
+    @staticmethod
+    def _analysis_fields(user, category, analysis_result):
+        """Column values for an IngredientAnalysis row, summary columns included"""
+        return {
+            'user': user,
+            'category': category,
+            'image': IngredientAnalysis.image_reference(analysis_result['public_id']),
+            'result': json.dumps(analysis_result['result']),
+            **IngredientAnalysis.summary_fields(analysis_result['result'])
+        }
+
+    @staticmethod
+    def serialize_analysis(analysis, result):
+        """Shape a saved analysis the way the analyze endpoints return it"""
+        return {
+            'id': analysis.id,
+            'category': analysis.category,
+            'created_at': analysis.timestamp,
+            'result': result
+        }
+
+    @staticmethod
+    def _get_user_medical_history(user):
+        """
+        User's full medical profile, served from the two-tier profile cache;
+        the cached copy is invalidated whenever the MedicalHistory changes.
+        The profile carries its 'profile_hash', which scoring cache keys use.
+        """
+        with span('profile'):
+            if user is None or user.pk is None:
+                return DEFAULT_PROFILE
+            return profile_cache.get_or_set(
+                profile_cache_key(user.pk),
+                lambda: IngredientAnalysisService._build_medical_profile(user)
+            )
+
+    @staticmethod
+    def _build_medical_profile(user):
+        """Profile precomputed when the user's MedicalHistory was saved"""
+        history = MedicalHistory.objects.filter(user_id=user.pk).values(
+            'pk', 'normalized_profile', 'profile_hash').first()
+        if history is None:
+            return DEFAULT_PROFILE
+        if not history['profile_hash']:
+            # Saved before profiles were precomputed; compute and store it once
+            instance = MedicalHistory.objects.get(pk=history['pk'])
+            history['normalized_profile'] = instance.build_profile()
+            history['profile_hash'] = MedicalHistory.hash_profile(history['normalized_profile'])
+            MedicalHistory.objects.filter(pk=instance.pk).update(
+                normalized_profile=history['normalized_profile'],
+                profile_hash=history['profile_hash'])
+        return {**history['normalized_profile'], 'profile_hash': history['profile_hash']}
 
     @staticmethod
     def get_analysis_summary(analysis_result):
@@ -0,0 +1,106 @@
+import logging
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from django.db import close_old_connections
+from ..utils import cache_utils
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import (
+    ANALYSIS_JOB_BACKEND, ANALYSIS_JOB_QUEUE_KEY, ANALYSIS_JOB_INPROCESS_WORKERS
+)
+
+logger = logging.getLogger(__name__)
+
+
+class RedisJobQueue:
+    """
+    FIFO job queue stored in a Redis list, drained by run_analysis_worker.
+    Delayed jobs wait in a sorted set scored by due time and are moved to
+    the list by whichever worker dequeues once they are due.
+    """
+
+    def __init__(self, client=None, key=ANALYSIS_JOB_QUEUE_KEY):
+        self._client = client
+        self.key = key
+        self.delayed_key = f"{key}:delayed"
+
+    @property
+    def client(self):
+        return self._client or cache_utils.redis_client
+
+    def enqueue(self, job_id, delay=0):
+        if delay > 0:
+            self.client.zadd(self.delayed_key, {str(job_id): time.time() + delay})
+        else:
+            self.client.lpush(self.key, str(job_id))
+
+    def dequeue(self, timeout=5):
+        """Block up to `timeout` seconds for the next job id, None if idle"""
+        next_due = self._promote_due()
+        if next_due is not None:
+            # Wake up in time to move the next delayed job
+            timeout = min(timeout, max(math.ceil(next_due - time.time()), 1))
+        item = self.client.brpop(self.key, timeout=timeout)
+        if not item:
+            return None
+        job_id = item[1]
+        return job_id.decode() if isinstance(job_id, bytes) else job_id
+
+    def _promote_due(self):
+        """Move due delayed jobs to the queue; returns when the next one is due, if any"""
+        for job_id in self.client.zrangebyscore(self.delayed_key, '-inf', time.time()):
+            # Only the worker whose ZREM succeeds queues it
+            if self.client.zrem(self.delayed_key, job_id):
+                self.client.lpush(self.key, job_id)
+        upcoming = self.client.zrange(self.delayed_key, 0, 0, withscores=True)
+        return upcoming[0][1] if upcoming else None
+
+    def __len__(self):
+        return self.client.llen(self.key)
+
+
+class InProcessJobQueue:
+    """Stand-in queue that runs jobs on a local thread pool (no worker needed)"""
+
+    def __init__(self, max_workers=ANALYSIS_JOB_INPROCESS_WORKERS):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='analysis-job')
+
+    def enqueue(self, job_id, delay=0):
+        if delay > 0:
+            timer = threading.Timer(delay, self.enqueue, args=(job_id,))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.executor.submit(self._run, str(job_id))
+
+    @staticmethod
+    def _run(job_id):
+        from .job_service import analysis_job_service
+        try:
+            analysis_job_service.process(job_id)
+        except Exception as e:
+            logger.error(f"In-process analysis job {job_id} crashed: {str(e)}")
+        finally:
+            # Worker threads own their DB connections
+            close_old_connections()
+
+
+def get_job_queue():
+    """Return the queue backend selected by ANALYSIS_JOB_BACKEND"""
+    global _job_queue
+    if _job_queue is None:
+        if ANALYSIS_JOB_BACKEND == 'inprocess':
+            _job_queue = InProcessJobQueue()
+        else:
+            _job_queue = RedisJobQueue()
+    return _job_queue
+
+
+_job_queue = None
@@ -0,0 +1,147 @@
+import datetime
+import io
+import logging
+import sys
+from pathlib import Path
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from ..models import AnalysisJob
+from ..utils.admission import GeminiBusy
+from .ingredient_service import ingredient_analysis_service
+from .job_queue import get_job_queue
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import ANALYSIS_JOB_LEASE_SECONDS, ANALYSIS_JOB_MAX_ATTEMPTS
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisJobService:
+    """Submits analyses to the job queue and processes them in workers"""
+
+    @staticmethod
+    def submit(image_file, category, user):
+        """Persist the upload and enqueue it; returns the pending AnalysisJob"""
+        image_file.seek(0)
+        job = AnalysisJob.objects.create(
+            user=user,
+            category=category,
+            image_data=image_file.read()
+        )
+        # Only publish the id once the row is visible to the worker
+        transaction.on_commit(lambda: get_job_queue().enqueue(job.id))
+        return job
+
+    @staticmethod
+    def process(job_id):
+        """Run the analysis for a queued job and record the outcome"""
+        now = timezone.now()
+        claimed = AnalysisJob.objects.filter(
+            Q(retry_at__isnull=True) | Q(retry_at__lte=now),
+            pk=job_id, status=AnalysisJob.STATUS_PENDING
+        ).update(status=AnalysisJob.STATUS_PROCESSING, claimed_at=now,
+                 attempts=F('attempts') + 1, updated_at=now)
+        if not claimed:
+            # Unknown id, already picked up by another worker, or waiting to be retried
+            return None
+
+        job = AnalysisJob.objects.select_related('user').get(pk=job_id)
+        try:
+            analysis_result = ingredient_analysis_service.analyze_image(
+                image_file=io.BytesIO(bytes(job.image_data)),
+                category=job.category,
+                user=job.user
+            )
+
+            if analysis_result['success']:
+                job.analysis = ingredient_analysis_service.save_analysis(
+                    job.user, job.category, analysis_result)
+                job.status = AnalysisJob.STATUS_COMPLETED
+            else:
+                job.error = analysis_result['error']
+                job.status = AnalysisJob.STATUS_FAILED
+        except GeminiBusy as e:
+            if job.attempts < ANALYSIS_JOB_MAX_ATTEMPTS:
+                return AnalysisJobService._retry_later(job, e)
+            job.error = str(e)
+            job.status = AnalysisJob.STATUS_FAILED
+        except Exception as e:
+            logger.error(f"Analysis job {job_id} error: {str(e)}")
+            job.error = f'Processing failed: {str(e)}'
+            job.status = AnalysisJob.STATUS_FAILED
+
+        # The image now lives in Cloudinary (or was rejected); drop the raw bytes
+        job.image_data = b''
+        AnalysisJobService._finish(job)
+        return job
+
+    @staticmethod
+    def _retry_later(job, busy):
+        """Load shedding is transient: queue the job again once Retry-After has passed"""
+        job.status = AnalysisJob.STATUS_PENDING
+        job.error = str(busy)
+        job.retry_at = timezone.now() + datetime.timedelta(seconds=busy.retry_after)
+        if AnalysisJobService._finish(job):
+            get_job_queue().enqueue(job.pk, delay=busy.retry_after)
+            logger.info(f"Analysis job {job.pk} shed by admission control; "
+                        f"retrying in {busy.retry_after} s (attempt {job.attempts})")
+        return job
+
+    @staticmethod
+    def _finish(job):
+        """Store the outcome, unless the lease ran out and the job was handed to another worker"""
+        saved = AnalysisJob.objects.filter(
+            pk=job.pk, status=AnalysisJob.STATUS_PROCESSING, claimed_at=job.claimed_at
+        ).update(status=job.status, analysis=job.analysis, error=job.error,
+                 image_data=job.image_data, retry_at=job.retry_at, updated_at=timezone.now())
+        if not saved:
+            logger.warning(f"Analysis job {job.pk} finished after its lease expired; "
+                           f"keeping the other worker's outcome")
+        return bool(saved)
+
+    @staticmethod
+    def recover(queue, include_pending=True):
+        """
+        Queue again the jobs no worker will finish: processing jobs whose
+        lease has expired (the worker died) and, with `include_pending`,
+        pending jobs whose queue entry was lost (Redis restart, crash before
+        enqueue). A stale job that used all its attempts is failed instead.
+        Returns the number of jobs queued.
+        """
+        cutoff = timezone.now() - datetime.timedelta(seconds=ANALYSIS_JOB_LEASE_SECONDS)
+        stale = AnalysisJob.objects.filter(
+            status=AnalysisJob.STATUS_PROCESSING, claimed_at__lt=cutoff
+        ).values_list('id', 'claimed_at', 'attempts')
+        job_ids = []
+        for job_id, claimed_at, attempts in stale:
+            # Matching the claim keeps a worker that finishes meanwhile from being overwritten
+            job = AnalysisJob.objects.filter(
+                pk=job_id, status=AnalysisJob.STATUS_PROCESSING, claimed_at=claimed_at)
+            if attempts >= ANALYSIS_JOB_MAX_ATTEMPTS:
+                if job.update(status=AnalysisJob.STATUS_FAILED, image_data=b'',
+                              error='Processing failed: the worker stopped before finishing',
+                              updated_at=timezone.now()):
+                    logger.error(f"Analysis job {job_id} abandoned after {attempts} attempt(s)")
+            elif job.update(status=AnalysisJob.STATUS_PENDING, updated_at=timezone.now()):
+                logger.warning(f"Analysis job {job_id} lease expired; queueing it again")
+                job_ids.append(job_id)
+
+        for job_id in job_ids:
+            queue.enqueue(job_id)
+
+        if include_pending:
+            # Claiming is idempotent, so a job also still in the queue runs once
+            now = timezone.now()
+            pending = AnalysisJob.objects.filter(
+                status=AnalysisJob.STATUS_PENDING).exclude(pk__in=job_ids)
+            for job_id, retry_at in pending.values_list('id', 'retry_at'):
+                queue.enqueue(job_id, delay=(retry_at - now).total_seconds() if retry_at else 0)
+                job_ids.append(job_id)
+        return len(job_ids)
+
+
+# Service instance
+analysis_job_service = AnalysisJobService()
@@ -1,3 +1,1908 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import cloudinary
+import cv2
+import fakeredis
+import google.genai as genai
+import httpx
+import redis.asyncio
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.utils import timezone
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import AsyncClient, TestCase
+from google.genai import types as genai_types
+from PIL import Image, ImageDraw, ImageEnhance
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from medical_history.models import MedicalHistory
+
+from .models import AnalysisJob, IngredientAnalysis, PendingAssetDeletion, Product
+from .service.ai_service import ai_service
+from .service.asset_service import asset_deletion_service
+from .service.ingredient_service import IngredientAnalysisService, ingredient_analysis_service
+from .service.job_queue import RedisJobQueue
+from .service.job_service import analysis_job_service
+from .utils import cache_utils, gemini, image_utils
+from .utils.admission import GeminiAdmission, GeminiBusy, gemini_admission
+from .utils.ai_results import (
+    EXTRACTION_SCHEMA, SCORING_SCHEMA, AnalysisResult, decode_response, load_object
+)
+from .utils.resilience import CLOSED, OPEN, CircuitBreaker, GeminiResilience
+from .utils.cache_codec import CODEC_ZLIB_DICT_V1, decode_value, encode_value
+from .utils.context_cache import ContextCache, GeminiCachingClient
+from .utils.image_utils import detect_barcode, normalize_barcode, prepare_image
+from .utils.metrics import AI_RESPONSE_REPAIRS
+
+
+SAMPLE_RESULT = {
+    "no_valid_ingredients": False,
+    "analysis_summary": {
+        "safety_score": 80, "safety_level": "safe", "should_use": True,
+        "main_verdict": "Fine in moderation.", "detailed_explanation": "",
+        "nutritional_highlights": "", "concern_count": 0,
+    },
+    "ingredient_groups": [],
+    "health_alerts": [],
+    "recommendation": {"verdict": "recommend", "confidence": "high", "reason": "",
+                       "safe_to_try": True},
+    "alternatives": [],
+    "key_advice": "",
+}
+
+
+def fake_upload_result(public_id='analysis/abc123'):
+    return {'url': f'https://res.cloudinary.com/demo/{public_id}.jpg', 'public_id': public_id}
+
+
+def fake_redis():
+    """
+    Point every Redis client in cache_utils at one in-memory server; returns
+    the str-decoding client. Stopped by mock.patch.stopall.
+    """
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeStrictRedis(server=server, decode_responses=True)
+    mock.patch.object(cache_utils, 'redis_client', client).start()
+    mock.patch.object(
+        cache_utils, 'binary_redis_client', fakeredis.FakeStrictRedis(server=server)).start()
+    mock.patch.object(
+        cache_utils, 'get_async_redis_client', lambda: fakeredis.FakeAsyncRedis(server=server)).start()
+    return client
+
+
+def pending_deletions():
+    return list(PendingAssetDeletion.objects.order_by('public_id').values_list('public_id', flat=True))
+
+
+def label_photo(seed, brightness=1.0, quality=90):
+    """JPEG bytes of a simple synthetic label; `seed` picks the layout"""
+    img = Image.new('RGB', (640, 480), 'white')
+    draw = ImageDraw.Draw(img)
+    for i in range(6):
+        offset = (seed * 37 + i * 53) % 300
+        draw.rectangle([20 + offset, 30 + i * 70, 300 + offset, 70 + i * 70], fill='black')
+    img = ImageEnhance.Brightness(img).enhance(brightness)
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+EAN_L_CODES = ('0001101', '0011001', '0010011', '0111101', '0100011',
+               '0110001', '0101111', '0111011', '0110111', '0001011')
+EAN_PARITY = ('LLLLLL', 'LLGLGG', 'LLGGLG', 'LLGGGL', 'LGLLGG',
+              'LGGLLG', 'LGGGLL', 'LGLGLG', 'LGLGGL', 'LGGLGL')
+
+
+def barcode_photo(code, seed=0, module=3, size=(800, 600)):
+    """JPEG bytes of a synthetic label with an EAN-13 barcode; `seed` varies the text blocks"""
+    right = [''.join('1' if bit == '0' else '0' for bit in pattern) for pattern in EAN_L_CODES]
+    bits = '101'
+    for digit, parity in zip(code[1:7], EAN_PARITY[int(code[0])]):
+        bits += EAN_L_CODES[int(digit)] if parity == 'L' else right[int(digit)][::-1]
+    bits += '01010' + ''.join(right[int(digit)] for digit in code[7:]) + '101'
+    img = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(img)
+    for i in range(3):
+        offset = (seed * 37 + i * 53) % 300
+        draw.rectangle([20 + offset, 30 + i * 50, 300 + offset, 55 + i * 50], fill='black')
+    for index, bit in enumerate(bits):
+        if bit == '1':
+            x = 250 + index * module
+            draw.rectangle([x, 300, x + module - 1, 500], fill='black')
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+class CacheFirstAnalyzeTests(TestCase):
+    """analyze_image must serve Redis hits without touching Cloudinary or Gemini"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret-pass')
+        fake_redis()
+
+        self.upload = mock.patch(
+            'cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        self.extract = mock.patch.object(
+            ai_service, 'extract_ingredients',
+            return_value={'no_valid_ingredients': False, 'ingredients': ['Sugar', 'Sesame Oil']}).start()
+        self.analyze = mock.patch.object(
+            ai_service, 'score_ingredients', side_effect=lambda **kw: dict(SAMPLE_RESULT)).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _analyze(self, content=None, user=None):
+        return ingredient_analysis_service.analyze_image(
+            image_file=io.BytesIO(content or label_photo(seed=0)), category='food',
+            user=user or self.user)
+
+    def test_cache_hit_makes_zero_uploads(self):
+        first = self._analyze()
+        self.assertTrue(first['success'])
+        self.assertEqual(self.upload.call_count, 1)
+
+        self.upload.reset_mock()
+        self.extract.reset_mock()
+        self.analyze.reset_mock()
+        second = self._analyze()
+
+        self.assertTrue(second['success'])
+        self.upload.assert_not_called()
+        self.extract.assert_not_called()
+        self.analyze.assert_not_called()
+        self.assertEqual(second['public_id'], first['public_id'])
+        self.assertEqual(second['image_url'], first['image_url'])
+
+    def test_cache_hit_reuploads_when_cached_asset_was_deleted(self):
+        first = self._analyze()
+        cache_utils.mark_asset_deleted(first['public_id'])
+        self.upload.return_value = fake_upload_result('analysis/fresh')
+        self.analyze.reset_mock()
+
+        second = self._analyze()
+
+        self.assertEqual(second['public_id'], 'analysis/fresh')
+        self.analyze.assert_not_called()
+
+    def test_extraction_shared_across_profiles(self):
+        self._analyze()
+        other = User.objects.create_user('bob', password='secret-pass')
+        MedicalHistory.objects.create(user=other, allergies='Sesame')
+        self.upload.reset_mock()
+        self.extract.reset_mock()
+        self.analyze.reset_mock()
+
+        result = self._analyze(user=User.objects.get(pk=other.pk))
+
+        self.assertTrue(result['success'])
+        self.upload.assert_not_called()
+        self.extract.assert_not_called()
+        self.assertEqual(self.analyze.call_count, 1)
+        self.assertEqual(
+            self.analyze.call_args.kwargs['ingredients'], ['Sugar', 'Sesame Oil'])
+        self.assertEqual(
+            self.analyze.call_args.kwargs['user_profile']['allergies'], ['Sesame'])
+
+    def test_unreadable_image_destroys_upload(self):
+        self.extract.return_value = {
+            **ai_service._get_error_response(), 'ingredients': []}
+
+        result = self._analyze()
+
+        self.assertFalse(result['success'])
+        self.assertEqual(pending_deletions(), ['analysis/abc123'])
+        self.analyze.assert_not_called()
+
+    def test_shared_asset_kept_until_last_row_deleted(self):
+        result = self._analyze()
+        first = ingredient_analysis_service.save_analysis(self.user, 'food', result)
+        second = ingredient_analysis_service.save_analysis(self.user, 'food', result)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(pending_deletions(), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(pending_deletions(), [result['public_id']])
+        self.assertTrue(cache_utils.is_asset_deleted(result['public_id']))
+        self.assertFalse(IngredientAnalysis.objects.exists())
+
+
+class AnalysisJobTests(TestCase):
+    """mode=async queues the analysis; the worker runs it and jobs/<id>/ reports it"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('jane', password='secret-pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        fake_redis()
+        self.queue = RedisJobQueue()
+        mock.patch('ingredient_analysis_app.service.job_service.get_job_queue',
+                   return_value=self.queue).start()
+        # The test's transaction must survive the worker's connection housekeeping
+        mock.patch('ingredient_analysis_app.management.commands.run_analysis_worker'
+                   '.close_old_connections').start()
+        mock.patch('cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        self.extract = mock.patch.object(
+            ai_service, 'extract_ingredients',
+            return_value={'no_valid_ingredients': False, 'ingredients': ['Sugar']}).start()
+        mock.patch.object(
+            ai_service, 'score_ingredients', side_effect=lambda **kw: dict(SAMPLE_RESULT)).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _submit(self):
+        upload = SimpleUploadedFile('label.jpg', label_photo(4), content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/v1/analysis/analyze/',
+                                    {'image': upload, 'category': 'food', 'mode': 'async'})
+
+    def _work(self):
+        call_command('run_analysis_worker', '--burst', '--timeout', '1', stdout=io.StringIO())
+
+    def test_async_mode_answers_202_with_a_queued_job(self):
+        response = self._submit()
+
+        self.assertEqual(response.status_code, 202)
+        job = AnalysisJob.objects.get(pk=response.data['job']['id'])
+        self.assertEqual(job.status, AnalysisJob.STATUS_PENDING)
+        self.assertEqual(response.data['job']['status_url'], f'/api/v1/analysis/jobs/{job.id}/')
+        self.assertEqual(self.queue.dequeue(timeout=1), str(job.id))
+        self.extract.assert_not_called()
+
+    def test_worker_processes_the_job_and_status_shows_the_result(self):
+        job_id = self._submit().data['job']['id']
+        pending = self.client.get(f'/api/v1/analysis/jobs/{job_id}/')
+        self.assertEqual(pending.data['status'], AnalysisJob.STATUS_PENDING)
+        self.assertIsNone(pending.data['analysis'])
+
+        self._work()
+
+        job = AnalysisJob.objects.get(pk=job_id)
+        self.assertEqual(job.status, AnalysisJob.STATUS_COMPLETED)
+        self.assertEqual(bytes(job.image_data), b'')
+        response = self.client.get(f'/api/v1/analysis/jobs/{job_id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], AnalysisJob.STATUS_COMPLETED)
+        self.assertEqual(response.data['analysis']['id'], job.analysis_id)
+        self.assertEqual(response.data['analysis']['result']['analysis_summary']['safety_score'],
+                         SAMPLE_RESULT['analysis_summary']['safety_score'])
+
+    def test_failed_job_reports_its_error(self):
+        self.extract.return_value = {**ai_service._get_error_response(), 'ingredients': []}
+        job_id = self._submit().data['job']['id']
+
+        self._work()
+
+        response = self.client.get(f'/api/v1/analysis/jobs/{job_id}/')
+        self.assertEqual(response.data['status'], AnalysisJob.STATUS_FAILED)
+        self.assertTrue(response.data['error'])
+        self.assertIsNone(response.data['analysis'])
+
+    def test_other_users_job_is_not_found(self):
+        job_id = self._submit().data['job']['id']
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user('kim', password='secret-pass'))
+
+        self.assertEqual(other.get(f'/api/v1/analysis/jobs/{job_id}/').status_code, 404)
+
+    def test_job_of_a_dead_worker_is_queued_again_once_its_lease_expires(self):
+        job_id = self._submit().data['job']['id']
+        self.queue.dequeue(timeout=1)
+        expired = timezone.now() - datetime.timedelta(hours=1)
+        AnalysisJob.objects.filter(pk=job_id).update(
+            status=AnalysisJob.STATUS_PROCESSING, claimed_at=expired, attempts=1)
+        fresh = AnalysisJob.objects.create(
+            user=self.user, category='food', status=AnalysisJob.STATUS_PROCESSING,
+            claimed_at=timezone.now(), attempts=1)
+
+        self.assertEqual(analysis_job_service.recover(self.queue, include_pending=False), 1)
+        self.assertEqual(AnalysisJob.objects.get(pk=fresh.pk).status, AnalysisJob.STATUS_PROCESSING)
+
+        self._work()
+
+        job = AnalysisJob.objects.get(pk=job_id)
+        self.assertEqual(job.status, AnalysisJob.STATUS_COMPLETED)
+        self.assertEqual(job.attempts, 2)
+
+    def test_job_shed_by_admission_control_is_retried_after_retry_after(self):
+        self.extract.side_effect = GeminiBusy(retry_after=7)
+        job_id = self._submit().data['job']['id']
+
+        self._work()
+
+        job = AnalysisJob.objects.get(pk=job_id)
+        self.assertEqual(job.status, AnalysisJob.STATUS_PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(bytes(job.image_data))
+        self.assertIsNone(analysis_job_service.process(job_id))
+        due = cache_utils.redis_client.zscore(self.queue.delayed_key, job_id)
+        self.assertAlmostEqual(due, time.time() + 7, delta=2)
+        self.assertEqual(len(self.queue), 0)
+
+        # Once due, the next worker picks it up
+        AnalysisJob.objects.filter(pk=job_id).update(
+            retry_at=timezone.now() - datetime.timedelta(seconds=1))
+        cache_utils.redis_client.zadd(self.queue.delayed_key, {job_id: time.time() - 1})
+        self.extract.side_effect = None
+        self._work()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.STATUS_COMPLETED)
+        self.assertEqual(job.attempts, 2)
+
+    def test_job_shed_on_its_last_attempt_fails(self):
+        self.extract.side_effect = GeminiBusy(retry_after=7)
+        job_id = self._submit().data['job']['id']
+        AnalysisJob.objects.filter(pk=job_id).update(attempts=4)
+
+        self._work()
+
+        job = AnalysisJob.objects.get(pk=job_id)
+        self.assertEqual(job.status, AnalysisJob.STATUS_FAILED)
+        self.assertIn('busy', job.error)
+        self.assertEqual(cache_utils.redis_client.zcard(self.queue.delayed_key), 0)
+
+    def test_stale_job_out_of_attempts_is_failed(self):
+        job = AnalysisJob.objects.create(
+            user=self.user, category='food', image_data=b'raw', attempts=5,
+            status=AnalysisJob.STATUS_PROCESSING,
+            claimed_at=timezone.now() - datetime.timedelta(hours=1))
+
+        self.assertEqual(analysis_job_service.recover(self.queue), 0)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJob.STATUS_FAILED)
+        self.assertEqual(bytes(job.image_data), b'')
+        self.assertEqual(len(self.queue), 0)
+
+
+class PerceptualCacheTests(TestCase):
+    """Re-photographs of a known label reuse its cached extraction"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('carol', password='secret-pass')
+        fake_redis()
+        self.upload = mock.patch(
+            'cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        self.extract = mock.patch.object(
+            ai_service, 'extract_ingredients',
+            return_value={'no_valid_ingredients': False, 'ingredients': ['Sugar']}).start()
+        mock.patch.object(
+            ai_service, 'score_ingredients', side_effect=lambda **kw: dict(SAMPLE_RESULT)).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _analyze(self, content, category='food'):
+        return ingredient_analysis_service.analyze_image(
+            image_file=io.BytesIO(content), category=category, user=self.user)
+
+    def test_near_duplicate_photo_reuses_extraction(self):
+        self._analyze(label_photo(seed=1))
+        self.extract.reset_mock()
+
+        result = self._analyze(label_photo(seed=1, brightness=0.9, quality=70))
+
+        self.assertTrue(result['success'])
+        self.extract.assert_not_called()
+        self.assertEqual(self.upload.call_count, 1)
+
+    def test_different_label_or_category_is_a_miss(self):
+        self._analyze(label_photo(seed=1))
+        self.extract.reset_mock()
+
+        self._analyze(label_photo(seed=5))
+        self._analyze(label_photo(seed=1, brightness=0.9), category='cosmetics')
+
+        self.assertEqual(self.extract.call_count, 2)
+
+    def test_index_finds_matches_at_its_distance_limit(self):
+        index = cache_utils.PerceptualHashIndex(prefix='phash-limit', max_distance=7)
+        fingerprint = 0x0123456789abcdef
+        index.add('food', fingerprint, 'original')
+        # Seven flipped bits, one in each of seven bands: only the last band still agrees
+        retake = fingerprint ^ sum(1 << (band * 8) for band in range(7))
+
+        self.assertEqual(index.find('food', retake), ('original', 7))
+        with self.assertRaises(ValueError):
+            cache_utils.PerceptualHashIndex(max_distance=8)
+
+
+class NegativeCacheTests(TestCase):
+    """Unreadable images are remembered, with TTLs escalating for repeat offenders"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('dora', password='secret-pass')
+        self.redis = fake_redis()
+        self.upload = mock.patch(
+            'cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        self.model = mock.Mock(**{'generate_content.return_value': SimpleNamespace(
+            text='{"no_valid_ingredients": true, "ingredients": []}')})
+        mock.patch.object(ai_service, 'model', self.model).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _analyze(self, content, user=None):
+        return ingredient_analysis_service.analyze_image(
+            image_file=io.BytesIO(content), category='food', user=user or self.user)
+
+    def _entry_ttl(self, content):
+        return self.redis.ttl(f"unreadable:{cache_utils.generate_image_cache_key(content)}")
+
+    def test_resubmitted_junk_skips_upload_and_model(self):
+        junk = label_photo(seed=7)
+        first = self._analyze(junk)
+        self.assertEqual(self._entry_ttl(junk), cache_utils.unreadable_images.ttl)
+
+        second = self._analyze(junk)
+        third = asyncio.run(ingredient_analysis_service.analyze_image_async(
+            image_file=io.BytesIO(junk), category='food', user=self.user))
+
+        self.assertFalse(second['success'])
+        self.assertEqual(second['result'], first['result'])
+        self.assertEqual(third['result'], first['result'])
+        self.assertEqual(self.model.generate_content.call_count, 1)
+        self.assertEqual(self.upload.call_count, 1)
+        # Third strike: the entry now lives 4x the base TTL
+        self.assertEqual(self._entry_ttl(junk), 4 * cache_utils.unreadable_images.ttl)
+
+    def test_single_flight_follower_rechecks_after_leader_fails(self):
+        junk = label_photo(seed=7)
+        image_hash = cache_utils.generate_image_cache_key(junk)
+        leader_result = {'no_valid_ingredients': True, 'ingredients': []}
+        run, arun = cache_utils.single_flight.run, cache_utils.single_flight.arun
+
+        def after_leader(cache_key, compute):
+            # The leader finished while this request waited on its lease
+            cache_utils.unreadable_images.add(
+                image_hash, 'food', None, leader_result, self.user.id)
+            return run(cache_key, compute)
+
+        async def aafter_leader(cache_key, compute):
+            cache_utils.unreadable_images.add(
+                image_hash, 'food', None, leader_result, self.user.id)
+            return await arun(cache_key, compute)
+
+        with mock.patch.object(cache_utils.single_flight, 'run', side_effect=after_leader), \
+                mock.patch.object(cache_utils.single_flight, 'arun', side_effect=aafter_leader):
+            result = self._analyze(junk)
+            self.redis.delete(f"unreadable:{image_hash}")
+            async_result = asyncio.run(ingredient_analysis_service.analyze_image_async(
+                image_file=io.BytesIO(junk), category='food', user=self.user))
+
+        self.assertFalse(result['success'])
+        self.assertEqual(result['result'], leader_result)
+        self.assertEqual(async_result['result'], leader_result)
+        self.model.generate_content.assert_not_called()
+        self.upload.assert_not_called()
+
+    def test_model_errors_are_not_remembered(self):
+        self.model.generate_content.side_effect = ValueError('malformed request')
+        self._analyze(label_photo(seed=7))
+        self._analyze(label_photo(seed=7))
+
+        self.assertEqual(self.model.generate_content.call_count, 2)
+
+    def test_near_duplicates_only_turned_away_after_repeated_junk(self):
+        self._analyze(label_photo(seed=7))
+        # An honest retake of the blurry label still reaches the model
+        self._analyze(label_photo(seed=7, brightness=0.9, quality=70))
+        self.assertEqual(self.model.generate_content.call_count, 2)
+
+        self._analyze(label_photo(seed=8))
+        result = self._analyze(label_photo(seed=7, brightness=0.95, quality=60))
+
+        self.assertFalse(result['success'])
+        self.assertEqual(self.model.generate_content.call_count, 3)
+        # Other users are not affected by this user's strikes
+        other = User.objects.create_user('eli', password='secret-pass')
+        self._analyze(label_photo(seed=7, brightness=0.85, quality=65), user=other)
+        self.assertEqual(self.model.generate_content.call_count, 4)
+
+
+class PrepareImageTests(TestCase):
+    """Uploads are shrunk once before going to Gemini and Cloudinary"""
+
+    def _jpeg(self, size, orientation=None):
+        img = Image.new('RGB', size, 'white')
+        ImageDraw.Draw(img).rectangle([0, 0, size[0] // 4, size[1] // 2], fill='black')
+        exif = Image.Exif()
+        if orientation:
+            exif[0x0112] = orientation
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=95, exif=exif)
+        return buffer.getvalue()
+
+    def test_large_photo_is_downscaled_within_budget(self):
+        prepared = prepare_image(
+            io.BytesIO(self._jpeg((4000, 3000))), max_dimension=1000, max_bytes=60 * 1024)
+
+        self.assertEqual(prepared.size, (1000, 750))
+        self.assertLessEqual(len(prepared.data), 60 * 1024)
+        self.assertEqual(prepared.mime_type, 'image/jpeg')
+
+    def test_exif_orientation_is_applied(self):
+        prepared = prepare_image(io.BytesIO(self._jpeg((800, 600), orientation=6)))
+
+        self.assertEqual(prepared.size, (600, 800))
+
+    def test_small_photo_passes_through(self):
+        original = self._jpeg((400, 300))
+        prepared = prepare_image(io.BytesIO(original))
+
+        self.assertEqual(prepared.data, original)
+
+
+STREAMED_RESULT = {
+    "no_valid_ingredients": False,
+    "analysis_summary": {"safety_score": 55, "safety_level": "caution", "concern_count": 1},
+    "ingredient_groups": [
+        {"group_name": "Sweeteners", "ingredients": [{"name": "Sugar", "status": "caution"}]},
+        {"group_name": "Oils", "ingredients": [{"name": "Sesame Oil", "status": "danger"}]},
+    ],
+    "health_alerts": [{"type": "allergy_match", "severity": "high", "ingredient": "Sesame Oil"}],
+    "recommendation": {"verdict": "avoid"},
+    "key_advice": "Avoid: contains sesame.",
+}
+
+
+class StubStreamingModel:
+    """Gemini stand-in that streams a JSON answer in small chunks"""
+
+    def __init__(self, text, chunk_size=40):
+        self.chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+        self.consumed = 0
+        self.calls = 0
+
+    def generate_content_stream(self, prompt, config=None):
+        self.calls += 1
+        for chunk in self.chunks:
+            self.consumed += 1
+            yield SimpleNamespace(text=chunk)
+
+
+def parse_sse(frame):
+    event, data = frame.decode().strip().split('\n')
+    return event[len('event: '):], json.loads(data[len('data: '):])
+
+
+class StreamingAnalyzeTests(TestCase):
+    """The SSE endpoint pushes each section before Gemini has finished"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('dave', password='secret-pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        fake_redis()
+        mock.patch('cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        mock.patch.object(
+            ai_service, 'extract_ingredients',
+            return_value={'no_valid_ingredients': False, 'ingredients': ['Sugar', 'Sesame Oil']}).start()
+        self.model = StubStreamingModel("```json\n" + json.dumps(STREAMED_RESULT, indent=2) + "\n```")
+        mock.patch.object(ai_service, 'model', self.model).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _stream(self):
+        response = self.client.post('/api/v1/analysis/analyze/stream/', {
+            'image': SimpleUploadedFile('label.jpg', label_photo(seed=3), 'image/jpeg'),
+            'category': 'food'
+        }, format='multipart', HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return response
+
+    def test_sections_arrive_before_stream_ends(self):
+        events = []
+        consumed_at_first_event = None
+        for frame in self._stream().streaming_content:
+            events.append(parse_sse(frame))
+            if consumed_at_first_event is None:
+                consumed_at_first_event = self.model.consumed
+
+        self.assertLess(consumed_at_first_event, len(self.model.chunks) // 2)
+        self.assertEqual([name for name, _ in events], [
+            'analysis_summary', 'ingredient_group', 'ingredient_group', 'health_alerts', 'complete'])
+        self.assertEqual(events[0][1], STREAMED_RESULT['analysis_summary'])
+        self.assertEqual(events[2][1], {'index': 1, 'group': STREAMED_RESULT['ingredient_groups'][1]})
+        complete = events[-1][1]
+        self.assertEqual(complete['analysis']['result']['key_advice'], STREAMED_RESULT['key_advice'])
+        self.assertTrue(IngredientAnalysis.objects.filter(pk=complete['analysis']['id']).exists())
+
+    async def test_asgi_stream_is_sent_as_it_is_produced(self):
+        token = await sync_to_async(lambda: str(RefreshToken.for_user(self.user).access_token))()
+        upload = SimpleUploadedFile('label.jpg', label_photo(seed=3), 'image/jpeg')
+        response = await AsyncClient().post(
+            '/api/v1/analysis/analyze/stream/', {'image': upload, 'category': 'food'},
+            headers={'Authorization': f'Bearer {token}', 'Accept': 'text/event-stream'})
+
+        # An async iterator; a sync one would be buffered whole by Django's ASGI handler
+        self.assertTrue(response.is_async)
+        events = []
+        consumed_at_first_event = None
+        async for frame in response.streaming_content:
+            events.append(parse_sse(frame))
+            if consumed_at_first_event is None:
+                consumed_at_first_event = self.model.consumed
+        self.assertLess(consumed_at_first_event, len(self.model.chunks) // 2)
+        self.assertEqual(events[-1][0], 'complete')
+
+    def test_cached_result_replays_same_events(self):
+        first = [parse_sse(frame)[0] for frame in self._stream().streaming_content]
+        second = [parse_sse(frame)[0] for frame in self._stream().streaming_content]
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.model.calls, 1)
+        self.assertEqual(IngredientAnalysis.objects.count(), 2)
+
+
+class SingleFlightTests(TestCase):
+    """Identical concurrent misses make one upload and one AI call per stage"""
+
+    def setUp(self):
+        self.redis = fake_redis()
+        mock.patch.object(
+            IngredientAnalysisService, '_get_user_medical_history', return_value={}).start()
+        self.upload = mock.patch(
+            'cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        self.extract = mock.patch.object(
+            ai_service, 'extract_ingredients', side_effect=self._slow(
+                {'no_valid_ingredients': False, 'ingredients': ['Sugar']})).start()
+        self.score = mock.patch.object(
+            ai_service, 'score_ingredients', side_effect=self._slow(SAMPLE_RESULT)).start()
+        self.addCleanup(mock.patch.stopall)
+
+    @staticmethod
+    def _slow(result):
+        def call(*args, **kwargs):
+            time.sleep(0.3)
+            return dict(result)
+        return call
+
+    def _analyze(self, barrier=None):
+        if barrier:
+            barrier.wait()
+        upload = SimpleUploadedFile('label.jpg', label_photo(1), content_type='image/jpeg')
+        return ingredient_analysis_service.analyze_image(upload, 'food', user=None)
+
+    def test_parallel_identical_requests_make_one_ai_call(self):
+        workers = 8
+        barrier = threading.Barrier(workers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda _: self._analyze(barrier), range(workers)))
+
+        self.assertEqual(self.extract.call_count, 1)
+        self.assertEqual(self.score.call_count, 1)
+        self.assertEqual(self.upload.call_count, 1)
+        self.assertTrue(all(result['success'] for result in results))
+        self.assertEqual({result['public_id'] for result in results}, {'analysis/abc123'})
+
+    def test_follower_takes_over_after_leader_lease_expires(self):
+        image_hash = cache_utils.generate_image_cache_key(label_photo(1))
+        # A crashed worker left its lock behind
+        self.redis.set(f"lock:ingredient_extraction:{image_hash}", 'dead-worker', px=300)
+
+        result = self._analyze()
+
+        self.assertTrue(result['success'])
+        self.assertEqual(self.extract.call_count, 1)
+
+
+class BatchAnalyzeTests(TestCase):
+    """One request analyzes a shelf of images with shared profile and dedup"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('erin', password='secret-pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        fake_redis()
+        self.upload = mock.patch(
+            'cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        self.extract = mock.patch.object(
+            ai_service, 'extract_ingredients',
+            return_value={'no_valid_ingredients': False, 'ingredients': ['Sugar']}).start()
+        self.score = mock.patch.object(
+            ai_service, 'score_ingredients', side_effect=lambda **kwargs: dict(SAMPLE_RESULT)).start()
+        self.profile = mock.patch.object(
+            IngredientAnalysisService, '_get_user_medical_history',
+            wraps=IngredientAnalysisService._get_user_medical_history).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _upload(self, seed):
+        return SimpleUploadedFile(f'label-{seed}.jpg', label_photo(seed), content_type='image/jpeg')
+
+    def test_batch_dedupes_images_and_bulk_creates_rows(self):
+        response = self.client.post('/api/v1/analysis/analyze/batch/', {
+            'images': [self._upload(1), self._upload(2), self._upload(1)],
+            'categories': ['food', 'food', 'food'],
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([item['status'] for item in results], ['successful'] * 3)
+        self.assertEqual(results[2]['duplicate_of'], 0)
+        self.assertIn('analysis_ms', results[1]['timings'])
+        self.assertEqual(self.extract.call_count, 2)
+        self.assertEqual(self.profile.call_count, 1)
+        self.assertEqual(IngredientAnalysis.objects.filter(user=self.user).count(), 3)
+
+    def test_pool_threads_close_their_db_connections(self):
+        closed_in = []
+        mock.patch('ingredient_analysis_app.service.ingredient_service.close_old_connections',
+                   side_effect=lambda: closed_in.append(threading.current_thread())).start()
+        items = [(io.BytesIO(label_photo(seed)), 'food') for seed in (1, 2)]
+
+        IngredientAnalysisService.analyze_batch(items, self.user)
+
+        self.assertEqual(len(closed_in), 4)
+        self.assertNotIn(threading.main_thread(), closed_in)
+
+    def test_category_count_must_match_images(self):
+        response = self.client.post('/api/v1/analysis/analyze/batch/', {
+            'images': [self._upload(1), self._upload(2)],
+            'categories': ['food', 'cosmetics', 'food'],
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('categories', response.json())
+
+
+class StubAsyncModel:
+    """Gemini stand-in for generate_content_async that records peak concurrency"""
+
+    def __init__(self, latency=0.2):
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+
+    async def generate_content_async(self, contents, config=None):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        if isinstance(contents, list):
+            return SimpleNamespace(text=json.dumps(
+                {'no_valid_ingredients': False, 'ingredients': ['Sugar']}))
+        return SimpleNamespace(text=json.dumps(SAMPLE_RESULT))
+
+
+class AsyncAnalyzeTests(TestCase):
+    """The ASGI analyze path awaits Gemini, so analyses overlap on one event loop"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('frank', password='secret-pass')
+        self.token = str(RefreshToken.for_user(self.user).access_token)
+        fake_redis()
+        self.upload = mock.patch(
+            'cloudinary.uploader.upload',
+            side_effect=lambda f: fake_upload_result(f'analysis/{id(f)}')).start()
+        self.model = StubAsyncModel()
+        mock.patch.object(ai_service, 'model', self.model).start()
+        self.addCleanup(mock.patch.stopall)
+
+    async def _post(self, seed, token=None):
+        upload = SimpleUploadedFile(f'label-{seed}.jpg', label_photo(seed), content_type='image/jpeg')
+        return await AsyncClient().post(
+            '/api/v1/analysis/analyze/async/', {'image': upload, 'category': 'food'},
+            headers={'Authorization': f'Bearer {token or self.token}'})
+
+    async def test_concurrent_requests_overlap_on_the_model(self):
+        responses = await asyncio.gather(*(self._post(seed) for seed in range(5)))
+
+        self.assertEqual([r.status_code for r in responses], [200] * 5)
+        self.assertEqual(responses[0].json()['analysis']['result']['analysis_summary'],
+                         SAMPLE_RESULT['analysis_summary'])
+        # Five extraction calls were awaited at the same time
+        self.assertEqual(self.model.peak, 5)
+        self.assertEqual(
+            await IngredientAnalysis.objects.filter(user=self.user).acount(), 5)
+
+    async def test_requires_valid_token(self):
+        response = await self._post(1, token='not-a-token')
+
+        self.assertEqual(response.status_code, 401)
+
+    async def test_accepts_session_authentication_like_the_sync_view(self):
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.user)
+        upload = SimpleUploadedFile('label-1.jpg', label_photo(1), content_type='image/jpeg')
+
+        response = await client.post(
+            '/api/v1/analysis/analyze/async/', {'image': upload, 'category': 'food'})
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_async_redis_client_is_per_loop_and_closed_with_it(self):
+        mock.patch.stopall()
+        closed = []
+        close = redis.asyncio.StrictRedis.aclose
+
+        async def recording_close(client):
+            closed.append(client)
+            await close(client)
+
+        async def use_client():
+            client = cache_utils.get_async_redis_client()
+            self.assertIs(cache_utils.get_async_redis_client(), client)
+            await asyncio.sleep(0)
+            return client
+
+        with mock.patch.object(redis.asyncio.StrictRedis, 'aclose', recording_close):
+            first = asyncio.run(use_client())
+            second = asyncio.run(use_client())
+
+        self.assertIsNot(first, second)
+        self.assertEqual(closed, [first, second])
+        self.assertEqual(len(cache_utils._async_redis), 0)
+
+
+class GeminiAdmissionTests(TestCase):
+    """Gemini calls pass a shared concurrency cap, token bucket and bounded fair queue"""
+
+    def setUp(self):
+        fake_redis()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_concurrency_cap_and_token_bucket(self):
+        admission = GeminiAdmission(rate=100, burst=10, max_concurrency=2, wait_seconds=0.2)
+        first, second = admission.acquire(1), admission.acquire(2)
+        with self.assertRaises(GeminiBusy) as busy:
+            admission.acquire(3)
+        self.assertEqual(busy.exception.reason, 'timeout')
+        admission.release(first)
+        admission.release(admission.acquire(3))
+        admission.release(second)
+
+        # Two tokens of burst, refilled at one per second
+        admission = GeminiAdmission(prefix='slow', rate=1, burst=2, wait_seconds=0.2)
+        admission.release(admission.acquire(1))
+        admission.release(admission.acquire(1))
+        with self.assertRaises(GeminiBusy):
+            admission.acquire(1)
+        self.assertEqual(admission.state()['queued'], 0)
+
+    def test_full_queue_is_busy_with_retry_after(self):
+        admission = GeminiAdmission(rate=2, max_concurrency=1, max_queue=1, wait_seconds=5)
+        held = admission.acquire(1)
+        waiter = threading.Thread(target=lambda: admission.release(admission.acquire(2)))
+        waiter.start()
+        while admission.state()['queued'] == 0:
+            time.sleep(0.01)
+
+        with self.assertRaises(GeminiBusy) as busy:
+            admission.acquire(3)
+        self.assertEqual((busy.exception.reason, busy.exception.retry_after), ('queue_full', 1))
+        admission.release(held)
+        waiter.join()
+
+    def test_queue_is_fair_across_users(self):
+        admission = GeminiAdmission(max_queue_per_user=3)
+        greedy = [admission._enqueue('user1') for _ in range(3)]
+        polite = admission._enqueue('user2')
+        with self.assertRaises(GeminiBusy) as busy:
+            admission._enqueue('user1')
+        self.assertEqual(busy.exception.reason, 'user_queue_full')
+
+        order = admission.client.zrange(admission.queue_key, 0, -1)
+        # user2's first call goes ahead of user1's second and third
+        self.assertEqual(order.index(polite), 1)
+        self.assertEqual(order.index(greedy[0]), 0)
+
+    def test_async_callers_share_the_cap(self):
+        admission = GeminiAdmission(rate=100, burst=10, max_concurrency=2)
+        model = StubAsyncModel(latency=0.05)
+
+        async def call(user_id):
+            ticket = await admission.aacquire(user_id)
+            try:
+                await model.generate_content_async('prompt')
+            finally:
+                await admission.arelease(ticket)
+
+        async def run():
+            await asyncio.gather(*(call(user_id) for user_id in range(6)))
+
+        asyncio.run(run())
+        self.assertEqual(model.peak, 2)
+
+    def test_saturated_model_answers_503_with_retry_after(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('ivy', password='secret-pass'))
+        mock.patch('cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        mock.patch.object(ai_service, 'model', mock.Mock()).start()
+
+        mock.patch.object(gemini_admission, 'max_concurrency', 0).start()
+        mock.patch.object(gemini_admission, 'wait_seconds', 0.1).start()
+        upload = SimpleUploadedFile('label.jpg', label_photo(4), content_type='image/jpeg')
+        response = client.post('/api/v1/analysis/analyze/', {'image': upload, 'category': 'food'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(response.data['retry_after']))
+        ai_service.model.generate_content.assert_not_called()
+
+        # An upstream 429 is reported the same way, not as an unreadable photo
+        mock.patch.stopall()
+        fake_redis()
+        mock.patch('cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        quota = type('ResourceExhausted', (Exception,), {'code': 429})
+        mock.patch.object(ai_service, 'model', mock.Mock(
+            **{'generate_content.side_effect': quota('Quota exceeded')})).start()
+        upload = SimpleUploadedFile('label.jpg', label_photo(4), content_type='image/jpeg')
+        response = client.post('/api/v1/analysis/analyze/', {'image': upload, 'category': 'food'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.data['status'], 'busy')
+
+
+class UpstreamError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class FaultyModel:
+    """
+    Gemini stand-in that plays a script of faults, one per call: 'ok',
+    'hang' (answers after `hang` seconds), 'slow' (after `slow` seconds),
+    an HTTP status code to raise, or 'garbage' (unparseable text).
+    Extra calls answer 'ok'.
+    """
+
+    def __init__(self, script, hang=2.0, slow=0.3):
+        self.script = list(script)
+        self.hang = hang
+        self.slow = slow
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _next(self):
+        with self.lock:
+            self.calls += 1
+            return self.script.pop(0) if self.script else 'ok'
+
+    def _answer(self, fault):
+        if isinstance(fault, int):
+            raise UpstreamError(fault)
+        return SimpleNamespace(text='not json' if fault == 'garbage' else json.dumps(SAMPLE_RESULT))
+
+    def generate_content(self, contents, config=None):
+        fault = self._next()
+        if fault in ('hang', 'slow'):
+            time.sleep(self.hang if fault == 'hang' else self.slow)
+        return self._answer(fault)
+
+    async def generate_content_async(self, contents, config=None):
+        fault = self._next()
+        if fault in ('hang', 'slow'):
+            await asyncio.sleep(self.hang if fault == 'hang' else self.slow)
+        return self._answer(fault)
+
+
+class GeminiResilienceTests(TestCase):
+    """Deadlines, classified retries, hedging and the shared breaker, under injected faults"""
+
+    def setUp(self):
+        fake_redis()
+        self.addCleanup(mock.patch.stopall)
+        self.breaker = CircuitBreaker(threshold=3, cooldown=30)
+        self.resilience = GeminiResilience(
+            breaker=self.breaker, attempt_timeout=0.2, deadline=5, max_attempts=3,
+            backoff_base=0.01, backoff_max=0.02)
+        mock.patch('ingredient_analysis_app.service.ai_service.gemini_resilience',
+                   self.resilience).start()
+
+    def _score(self, model):
+        mock.patch.object(ai_service, 'model', model).start()
+        return ai_service.score_ingredients(['Sugar'], 'food', MedicalHistory.default_profile())
+
+    def test_transient_errors_and_timeouts_are_retried(self):
+        model = FaultyModel([503, 'hang'])
+        started = time.monotonic()
+        result = self._score(model)
+
+        self.assertEqual(result['analysis_summary'], SAMPLE_RESULT['analysis_summary'])
+        self.assertEqual(model.calls, 3)
+        # The hung attempt was abandoned at its timeout, not waited out
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_bad_requests_and_parse_errors_are_not_retried(self):
+        model = FaultyModel([400])
+        self.assertTrue(self._score(model)['no_valid_ingredients'])
+        self.assertEqual(model.calls, 1)
+
+        model = FaultyModel(['garbage'])
+        self.assertTrue(self._score(model)['no_valid_ingredients'])
+        self.assertEqual(model.calls, 1)
+
+    def test_breaker_opens_fails_fast_and_recovers_through_a_probe(self):
+        model = FaultyModel([500, 500, 500])
+        with self.assertRaises(GeminiBusy) as busy:
+            self._score(model)
+        self.assertEqual(busy.exception.reason, 'upstream_unavailable')
+        self.assertEqual(self.breaker.state(), OPEN)
+
+        # Open: the next call fails fast without reaching the model
+        with self.assertRaises(GeminiBusy) as busy:
+            self._score(model)
+        self.assertEqual((busy.exception.reason, busy.exception.retry_after), ('circuit_open', 30))
+        self.assertEqual(model.calls, 3)
+
+        # Cooldown over: one probe goes through and closes it again
+        self.breaker.client.delete(self.breaker.open_key)
+        self.assertEqual(self._score(model)['analysis_summary'], SAMPLE_RESULT['analysis_summary'])
+        self.assertEqual(self.breaker.state(), CLOSED)
+
+    def test_slow_attempt_is_hedged(self):
+        self.resilience.hedge = True
+        self.resilience.attempt_timeout = 2
+        for _ in range(20):
+            self.resilience._observe('score', 0.02)
+        model = FaultyModel(['hang'])
+
+        started = time.monotonic()
+        self.assertEqual(self._score(model)['analysis_summary'], SAMPLE_RESULT['analysis_summary'])
+        self.assertEqual(model.calls, 2)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_hedge_needs_a_free_token_of_its_own(self):
+        self.resilience.admission = GeminiAdmission(rate=0.01, burst=1)
+        self.resilience.hedge = True
+        self.resilience.attempt_timeout = 2
+        for _ in range(20):
+            self.resilience._observe('score', 0.02)
+        model = FaultyModel(['hang'], hang=0.4)
+
+        self.assertEqual(self._score(model)['analysis_summary'], SAMPLE_RESULT['analysis_summary'])
+        self.assertEqual(model.calls, 1)
+
+    def test_abandoned_attempt_keeps_its_slot_until_it_returns(self):
+        model = FaultyModel(['hang'], hang=0.8)
+        self._score(model)
+
+        # The retry answered; the timed-out request is still open upstream
+        self.assertEqual(gemini_admission.state()['in_flight'], 1)
+        time.sleep(1)
+        self.assertEqual(gemini_admission.state()['in_flight'], 0)
+
+    def test_queued_attempts_are_cancelled_at_their_timeout(self):
+        # One pool thread, held by a hung request from another caller
+        self.resilience.pool_size = 1
+        self.resilience.max_attempts = 1
+        blocker = FaultyModel(['hang'], hang=0.8)
+        self.resilience._submit(lambda: blocker.generate_content('prompt'),
+                                gemini_admission.acquire_current())
+        queued = FaultyModel([])
+
+        with self.assertRaises(GeminiBusy):
+            self.resilience.call('score', lambda: queued.generate_content('prompt'))
+
+        # The queued attempt gave its slot back without waiting for a thread
+        self.assertEqual(gemini_admission.state()['in_flight'], 1)
+        time.sleep(1)
+        self.assertEqual(queued.calls, 0)
+        self.assertEqual(gemini_admission.state()['in_flight'], 0)
+
+    def test_stalled_stream_times_out_and_counts_toward_the_breaker(self):
+        def stalled():
+            yield 'first'
+            time.sleep(1)
+            yield 'late'
+
+        chunks = []
+        started = time.monotonic()
+        with self.assertRaises(GeminiBusy) as busy:
+            for chunk in self.resilience.stream('score', stalled):
+                chunks.append(chunk)
+
+        self.assertEqual(chunks, ['first'])
+        self.assertEqual(busy.exception.reason, 'upstream_unavailable')
+        self.assertLess(time.monotonic() - started, 0.8)
+        self.assertEqual(self.breaker.client.get(self.breaker.failures_key), '1')
+        self.assertEqual(gemini_admission.state()['in_flight'], 1)
+        time.sleep(1.2)
+        self.assertEqual(gemini_admission.state()['in_flight'], 0)
+
+    def test_async_path_times_out_retries_and_gives_up_as_busy(self):
+        model = FaultyModel(['hang', 'hang', 'hang'])
+        mock.patch.object(ai_service, 'model', model).start()
+
+        with self.assertRaises(GeminiBusy) as busy:
+            asyncio.run(ai_service.score_ingredients_async(
+                ['Sugar'], 'food', MedicalHistory.default_profile()))
+        self.assertEqual(busy.exception.reason, 'upstream_unavailable')
+        self.assertEqual(model.calls, 3)
+
+        # A failed probe opens the breaker again straight away
+        self.breaker.client.delete(self.breaker.open_key)
+        model.script = [502]
+        with self.assertRaises(GeminiBusy) as busy:
+            asyncio.run(ai_service.score_ingredients_async(
+                ['Sugar'], 'food', MedicalHistory.default_profile()))
+        self.assertEqual(busy.exception.reason, 'circuit_open')
+        self.assertEqual((model.calls, self.breaker.state()), (4, OPEN))
+
+
+class StubCachingClient:
+    """Cached-content API stand-in; models created for a cache play `script`"""
+
+    def __init__(self, script=(), fail_create=None):
+        self.script = list(script)
+        self.fail_create = fail_create
+        self.created = []
+        self.refreshed = []
+        self.deleted = []
+        self.models = {}
+
+    def create(self, model_name, system_instruction, ttl, display_name):
+        if self.fail_create:
+            raise self.fail_create
+        name = f"cachedContents/{len(self.created) + 1}"
+        self.created.append((name, system_instruction))
+        return name
+
+    def refresh(self, name, ttl):
+        self.refreshed.append(name)
+
+    def delete(self, name):
+        self.deleted.append(name)
+
+    def model(self, model_name, name):
+        # The script plays once, on the first cache's model
+        model = self.models[name] = FaultyModel(self.script)
+        self.script = []
+        model.requests = []
+        generate = model.generate_content
+
+        def generate_content(contents, config=None):
+            model.requests.append(contents)
+            response = generate(contents)
+            response.usage_metadata = SimpleNamespace(
+                prompt_token_count=1000, cached_content_token_count=850)
+            return response
+        model.generate_content = generate_content
+        return model
+
+
+class ContextCacheTests(TestCase):
+    """The static scoring instruction is sent once as Gemini cached content"""
+
+    def setUp(self):
+        fake_redis()
+        self.addCleanup(mock.patch.stopall)
+        self.inline = mock.Mock(**{'generate_content.return_value': SimpleNamespace(
+            text=json.dumps(SAMPLE_RESULT))})
+        mock.patch.object(ai_service, 'model', self.inline).start()
+
+    def _use(self, client, **kwargs):
+        cache = ContextCache('scoring', ai_service.MODEL_NAME, ai_service.scoring_instruction,
+                             client=client, enabled=True, **kwargs)
+        mock.patch.object(ai_service, 'scoring_cache', cache).start()
+        return cache
+
+    def _score(self):
+        return ai_service.score_ingredients(['Sugar'], 'food', MedicalHistory.default_profile())
+
+    def test_requests_send_only_the_profile_and_log_savings(self):
+        client = StubCachingClient()
+        self._use(client)
+
+        with self.assertLogs('ingredient_analysis_app.utils.context_cache', 'INFO') as logs:
+            self._score()
+            result = self._score()
+
+        self.assertEqual(result['analysis_summary'], SAMPLE_RESULT['analysis_summary'])
+        self.assertEqual([instruction for _, instruction in client.created],
+                         [ai_service.scoring_instruction])
+        request = client.models['cachedContents/1'].requests[0]
+        self.assertIn('ALLERGIES', request)
+        self.assertNotIn('JSON Structure', request)
+        self.inline.generate_content.assert_not_called()
+        self.assertIn('850 of 1000 input tokens served from the context cache', logs.output[-1])
+
+        # A second worker finds the registration in Redis instead of creating its own
+        other = self._use(client)
+        other.model()
+        self.assertEqual(len(client.created), 1)
+
+    def test_lifetime_is_extended_near_expiry(self):
+        client = StubCachingClient()
+        self._use(client, ttl=600, refresh_margin=900)
+
+        self._score()
+        self._score()
+
+        self.assertEqual(client.refreshed, ['cachedContents/1'])
+
+    def test_expired_cache_falls_back_inline_then_is_recreated(self):
+        client = StubCachingClient(script=[404])
+        self._use(client)
+
+        result = self._score()
+
+        self.assertEqual(result['analysis_summary'], SAMPLE_RESULT['analysis_summary'])
+        self.assertIn('JSON Structure', self.inline.generate_content.call_args.args[0])
+        self._score()
+        self.assertEqual([name for name, _ in client.created],
+                         ['cachedContents/1', 'cachedContents/2'])
+        self.assertEqual(len(client.models['cachedContents/2'].requests), 1)
+        self.assertEqual(self.inline.generate_content.call_count, 1)
+
+    def test_creation_failure_uses_inline_prompt_until_retry(self):
+        client = StubCachingClient(fail_create=UpstreamError(400))
+        cache = self._use(client)
+
+        self._score()
+        client.fail_create = None
+        self._score()
+
+        self.assertEqual(self.inline.generate_content.call_count, 2)
+        self.assertEqual(client.created, [])
+        cache._disabled_until = 0
+        self._score()
+        self.assertEqual(len(client.created), 1)
+
+
+class GeminiCachingClientTests(TestCase):
+    """The caching client drives the installed google-genai SDK, answered over a mock transport"""
+
+    def setUp(self):
+        self.requests = []
+
+        def respond(request):
+            self.requests.append(request)
+            if request.url.path.endswith('/cachedContents'):
+                return httpx.Response(200, json={'name': 'cachedContents/label-1'})
+            if request.method in ('PATCH', 'DELETE'):
+                return httpx.Response(200, json={})
+            return httpx.Response(200, json={
+                'candidates': [{'content': {'role': 'model', 'parts': [{'text': '{}'}]}}],
+                'usageMetadata': {'promptTokenCount': 1000, 'cachedContentTokenCount': 850}})
+
+        transport = httpx.MockTransport(respond)
+        self.client = GeminiCachingClient(genai.Client(
+            api_key='test-key', http_options=genai_types.HttpOptions(
+                httpx_client=httpx.Client(transport=transport),
+                httpx_async_client=httpx.AsyncClient(transport=transport))))
+
+    def _body(self, index):
+        return json.loads(self.requests[index].content)
+
+    def test_cache_lifecycle_and_cached_generation(self):
+        name = self.client.create('gemini-2.0-flash', 'Read the label.', 3600, 'extraction')
+        self.client.refresh(name, 600)
+        model = self.client.model('gemini-2.0-flash', name)
+        response = model.generate_content(
+            [genai_types.Part.from_bytes(data=b'label', mime_type='image/jpeg')],
+            config=genai_types.GenerateContentConfig(response_mime_type='application/json'))
+        async_response = asyncio.run(model.generate_content_async(['Sugar']))
+        self.client.delete(name)
+
+        self.assertEqual(name, 'cachedContents/label-1')
+        created = self._body(0)
+        self.assertEqual(created['model'], 'models/gemini-2.0-flash')
+        self.assertEqual(created['systemInstruction']['parts'], [{'text': 'Read the label.'}])
+        self.assertEqual(created['ttl'], '3600s')
+        self.assertEqual((self.requests[1].method, self._body(1)), ('PATCH', {'ttl': '600s'}))
+        generated = self._body(2)
+        self.assertTrue(self.requests[2].url.path.endswith('gemini-2.0-flash:generateContent'))
+        self.assertEqual(generated['cachedContent'], name)
+        self.assertEqual(generated['generationConfig'], {'responseMimeType': 'application/json'})
+        self.assertEqual(generated['contents'][0]['parts'][0]['inlineData'],
+                         {'data': 'bGFiZWw=', 'mime_type': 'image/jpeg'})
+        self.assertEqual(self._body(3)['cachedContent'], name)
+        self.assertEqual(self.requests[4].method, 'DELETE')
+        self.assertEqual(response.usage_metadata.cached_content_token_count, 850)
+        self.assertEqual(async_response.text, '{}')
+
+
+class GeminiClientTests(TestCase):
+    """Without a model stub, the service talks to Gemini through genai.Client"""
+
+    def setUp(self):
+        self.addCleanup(mock.patch.stopall)
+        fake_redis()
+        self.sdk = mock.Mock()
+        self.sdk.models.generate_content.side_effect = self._answer
+        self.sdk.aio.models.generate_content = mock.AsyncMock(side_effect=self._answer)
+        self.client_class = mock.patch('google.genai.Client', return_value=self.sdk).start()
+        mock.patch.object(gemini, '_client', None).start()
+        mock.patch.object(ai_service, 'model', None).start()
+        mock.patch('ingredient_analysis_app.service.ai_service.GEMINI_API_KEY', 'test-key').start()
+
+    @staticmethod
+    def _answer(model, contents, config):
+        return SimpleNamespace(usage_metadata=None, text=json.dumps(
+            {'no_valid_ingredients': False, 'ingredients': ['Sugar']}
+            if len(contents) == 2 else SAMPLE_RESULT))
+
+    def test_extract_and_score_go_through_the_client(self):
+        extracted = ai_service.extract_ingredients(io.BytesIO(label_photo(seed=1)))
+        result = ai_service.score_ingredients(
+            extracted['ingredients'], 'food', MedicalHistory.default_profile())
+
+        self.client_class.assert_called_once_with(api_key=mock.ANY)
+        self.assertEqual(extracted['ingredients'], ['Sugar'])
+        self.assertEqual(result['analysis_summary'], SAMPLE_RESULT['analysis_summary'])
+        extract, score = self.sdk.models.generate_content.call_args_list
+        self.assertEqual(extract.kwargs['model'], ai_service.MODEL_NAME)
+        self.assertEqual(extract.kwargs['contents'][1].inline_data.mime_type, 'image/jpeg')
+        self.assertIn('ALLERGIES', score.kwargs['contents'])
+
+    def test_async_calls_use_the_aio_client(self):
+        async def analyze():
+            extracted = await ai_service.extract_ingredients_async(
+                io.BytesIO(label_photo(seed=1)))
+            return await ai_service.score_ingredients_async(
+                extracted['ingredients'], 'food', MedicalHistory.default_profile())
+
+        result = asyncio.run(analyze())
+
+        self.assertEqual(result['analysis_summary'], SAMPLE_RESULT['analysis_summary'])
+        self.assertEqual(self.sdk.aio.models.generate_content.await_count, 2)
+        score = self.sdk.aio.models.generate_content.await_args
+        self.assertEqual(score.kwargs['config'].response_schema, SCORING_SCHEMA)
+        self.sdk.models.generate_content.assert_not_called()
+
+    def test_client_is_asked_for_schema_constrained_json(self):
+        ai_service.extract_ingredients(io.BytesIO(label_photo(seed=1)))
+        ai_service.score_ingredients(['Sugar'], 'food', MedicalHistory.default_profile())
+
+        extract, score = [call.kwargs['config']
+                          for call in self.sdk.models.generate_content.call_args_list]
+        for config, schema in ((extract, EXTRACTION_SCHEMA), (score, SCORING_SCHEMA)):
+            self.assertIsInstance(config, genai_types.GenerateContentConfig)
+            self.assertEqual(config.response_mime_type, 'application/json')
+            self.assertEqual(config.response_schema, schema)
+        summary = SCORING_SCHEMA['properties']['analysis_summary']
+        self.assertIn('safety_score', summary['required'])
+        self.assertEqual(summary['properties']['safety_level']['enum'], ['safe', 'caution', 'danger'])
+
+
+class ResponseDecoderTests(TestCase):
+    """Model answers are decoded once and validated into typed results"""
+
+    def setUp(self):
+        fake_redis()
+        self.addCleanup(mock.patch.stopall)
+        self.model = mock.Mock()
+        mock.patch.object(ai_service, 'model', self.model).start()
+
+    def _score(self, text):
+        self.model.generate_content.return_value = SimpleNamespace(text=text)
+        return ai_service.score_ingredients(['Sugar'], 'food', MedicalHistory.default_profile())
+
+    def test_wrapped_answers_decode_to_the_same_result(self):
+        body = json.dumps(SAMPLE_RESULT)
+        for text, outcome in [
+                (body, 'direct'),
+                (f"```json\n{body}\n```", 'direct'),
+                (f"Here is the analysis {{as requested}}:\n{body}", 'brace_extract'),
+                (f"{body}\nLet me know if you need more {{detail}}.", 'brace_extract')]:
+            self.assertEqual(load_object(text)[1], outcome)
+            self.assertEqual(self._score(text), SAMPLE_RESULT)
+
+        # Cut off mid-answer: nothing usable
+        self.assertEqual(load_object(body[:-40]), (None, 'failed'))
+        self.assertTrue(self._score(body[:-40])['no_valid_ingredients'])
+
+    def test_malformed_fields_are_repaired(self):
+        result = self._score(json.dumps({
+            "analysis_summary": {"safety_score": "85%", "safety_level": "SAFE",
+                                 "should_use": "true", "main_verdict": 42},
+            "ingredient_groups": [{"group_name": "Oils", "ingredients": [
+                {"name": "Palm Oil", "status": "Danger", "concern_level": "extreme"},
+                "Sugar"]}],
+            "health_alerts": {"type": "allergy_match"},
+            "key_advice": None,
+            "confidence_note": "unrequested",
+        }))
+
+        summary = result['analysis_summary']
+        self.assertEqual((summary['safety_score'], summary['safety_level'], summary['should_use'],
+                          summary['main_verdict']), (85, 'safe', True, '42'))
+        # Not given: counted from the flagged ingredients
+        self.assertEqual(summary['concern_count'], 1)
+        ingredient = result['ingredient_groups'][0]['ingredients']
+        self.assertEqual(len(ingredient), 1)
+        self.assertEqual((ingredient[0]['status'], ingredient[0]['concern_level'],
+                          ingredient[0]['why_flagged']), ('danger', 'medium', None))
+        self.assertEqual(result['health_alerts'], [])
+        self.assertEqual(result['recommendation']['verdict'], 'caution')
+        self.assertEqual(result['key_advice'], '')
+        self.assertNotIn('confidence_note', result)
+
+    def test_whole_floats_count_as_repairs(self):
+        repairs = AI_RESPONSE_REPAIRS.labels('analysis_summary.safety_score')
+        before = repairs._value.get()
+
+        self._score(json.dumps(SAMPLE_RESULT))
+        result = self._score(json.dumps({
+            **SAMPLE_RESULT,
+            "analysis_summary": {**SAMPLE_RESULT['analysis_summary'], "safety_score": 85.0}}))
+
+        self.assertIs(type(result['analysis_summary']['safety_score']), int)
+        self.assertEqual(repairs._value.get() - before, 1)
+
+    def test_answers_without_a_usable_summary_are_rejected(self):
+        for summary in ("not an object", {"safety_score": "high"}):
+            text = json.dumps({**SAMPLE_RESULT, "analysis_summary": summary})
+            self.assertIsNone(decode_response(text, AnalysisResult))
+            self.assertTrue(self._score(text)['no_valid_ingredients'])
+
+
+
+class BarcodeFastPathTests(TestCase):
+    """Photos of a known product's barcode are scored without the vision call"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('gina', password='secret-pass')
+        self.redis = fake_redis()
+        self.upload = mock.patch(
+            'cloudinary.uploader.upload',
+            side_effect=lambda f: fake_upload_result(f'analysis/{id(f)}')).start()
+        self.model = mock.Mock()
+        self.model.generate_content.side_effect = lambda contents, **kwargs: SimpleNamespace(
+            text=json.dumps({'no_valid_ingredients': False, 'ingredients': ['Sugar', 'Cocoa']}
+                            if isinstance(contents, list) else SAMPLE_RESULT))
+        mock.patch.object(ai_service, 'model', self.model).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _analyze(self, content):
+        return ingredient_analysis_service.analyze_image(
+            image_file=io.BytesIO(content), category='food', user=self.user)
+
+    def _vision_calls(self):
+        return sum(isinstance(call.args[0], list) for call in self.model.generate_content.call_args_list)
+
+    def test_barcode_is_detected_and_normalized(self):
+        self.assertEqual(detect_barcode(io.BytesIO(barcode_photo('4006381333931'))), '4006381333931')
+        self.assertIsNone(detect_barcode(io.BytesIO(label_photo(seed=1))))
+        # UPC-A is stored as EAN-13; a wrong check digit is rejected
+        self.assertEqual(normalize_barcode('036000291452'), '0036000291452')
+        self.assertIsNone(normalize_barcode('4006381333932'))
+
+    def test_large_photos_are_decoded_reduced_and_searched_once(self):
+        decode = self.enterContext(mock.patch.object(cv2, 'imdecode', wraps=cv2.imdecode))
+        detector = mock.Mock(wraps=cv2.barcode.BarcodeDetector())
+        self.enterContext(mock.patch.object(image_utils._detectors, 'barcode', detector,
+                                            create=True))
+
+        photo = barcode_photo('4006381333931', module=6, size=(4000, 3000))
+        self.assertEqual(detect_barcode(io.BytesIO(photo), max_dimension=1600), '4006381333931')
+        self.assertEqual(decode.call_args.args[1], cv2.IMREAD_REDUCED_GRAYSCALE_2)
+
+        # A photo with nothing barcode-like gets a single pass
+        detector.reset_mock()
+        self.assertIsNone(detect_barcode(io.BytesIO(label_photo(seed=1))))
+        self.assertEqual(detector.detectAndDecodeWithType.call_count, 1)
+        self.assertEqual(decode.call_args.args[1], cv2.IMREAD_GRAYSCALE)
+
+    def test_learned_product_skips_the_vision_call(self):
+        first = self._analyze(barcode_photo('4006381333931', seed=1))
+        self.assertEqual(Product.ingredients_for('4006381333931'), ['Sugar', 'Cocoa'])
+
+        # Another photo of the same product
+        second = self._analyze(barcode_photo('4006381333931', seed=5, module=2))
+        # async_to_sync keeps the ORM lookup on this thread's test transaction
+        async_result = async_to_sync(ingredient_analysis_service.analyze_image_async)(
+            image_file=io.BytesIO(barcode_photo('4006381333931', seed=9)),
+            category='food', user=self.user)
+
+        self.assertTrue(second['success'])
+        self.assertEqual(second['result'], first['result'])
+        self.assertTrue(async_result['success'])
+        self.assertEqual(self._vision_calls(), 1)
+        # Each photo is still uploaded for the user's history
+        self.assertEqual(self.upload.call_count, 3)
+        self.assertEqual(cache_utils.barcode_scans.totals(1),
+                         {'served': 2, 'unknown': 1, 'none': 0})
+
+    def test_catalog_import_feeds_the_fast_path_and_reports_it(self):
+        catalog = Path(self.enterContext(tempfile.TemporaryDirectory())) / 'catalog.tsv'
+        catalog.write_text(
+            "code\tproduct_name\tingredients_text\n"
+            "4006381333931\tChoc Bar\tSugar, Chocolate (Cocoa Mass, Cocoa Butter); Salt.\n"
+            "4006381333932\tBad Check Digit\tSugar\n"
+            "036000291452\tNo Ingredients\t\n")
+        Product.objects.create(barcode='4006381333931', ingredients=['Old'])
+        output = io.StringIO()
+
+        call_command('import_products', str(catalog), stdout=output)
+        self.assertEqual(Product.ingredients_for('4006381333931'),
+                         ['Sugar', 'Chocolate (Cocoa Mass, Cocoa Butter)', 'Salt'])
+        self.assertEqual(Product.objects.get(barcode='4006381333931').source, Product.SOURCE_CATALOG)
+        self.assertIn('skipped 1 with an invalid barcode and 1 without ingredients', output.getvalue())
+
+        self.assertTrue(self._analyze(barcode_photo('4006381333931'))['success'])
+        self._analyze(label_photo(seed=2))
+        self.assertEqual(self._vision_calls(), 1)
+
+        call_command('import_products', '--days', '1', stdout=output)
+        self.assertIn('served by the fast path: 1 (50.0%)', output.getvalue())
+
+
+class CacheCodecTests(TestCase):
+    """Cached values are compact and compressed, and legacy JSON entries still read"""
+
+    def setUp(self):
+        self.redis = fake_redis()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_round_trip_compresses_large_values(self):
+        value = {**STREAMED_RESULT, "ingredient_groups": STREAMED_RESULT["ingredient_groups"] * 20}
+        encoded = encode_value(value)
+
+        self.assertEqual(encoded[0], CODEC_ZLIB_DICT_V1)
+        self.assertLess(len(encoded), len(json.dumps(value)) / 4)
+        self.assertEqual(decode_value(encoded), value)
+        self.assertEqual(decode_value(encode_value({"ingredients": ["Sugar"]})),
+                         {"ingredients": ["Sugar"]})
+
+    def test_legacy_json_entries_are_read_transparently(self):
+        self.redis.set('ingredient_analysis:legacy', json.dumps(SAMPLE_RESULT, indent=2))
+
+        self.assertEqual(cache_utils.get_cached_json('ingredient_analysis:legacy'), SAMPLE_RESULT)
+
+        cache_utils.set_cached_json('ingredient_analysis:legacy', SAMPLE_RESULT)
+        self.assertEqual(cache_utils.get_cached_json('ingredient_analysis:legacy'), SAMPLE_RESULT)
+
+
+class TwoTierCacheTests(TestCase):
+    """Hot keys are served from the worker's LRU; writes elsewhere invalidate it"""
+
+    def setUp(self):
+        self.redis = fake_redis()
+        self.addCleanup(mock.patch.stopall)
+
+    def _eventually(self, predicate):
+        deadline = time.monotonic() + 3
+        while not predicate() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return predicate()
+
+    def test_local_tier_serves_hits_without_redis(self):
+        cache = cache_utils.TwoTierCache('test-local')
+        cache.set('product:1', {'ingredients': ['Sugar']})
+        self.redis.delete('product:1')
+
+        self.assertEqual(cache.get('product:1'), {'ingredients': ['Sugar']})
+        self.assertEqual(cache.stats()['local_hits'], 1)
+        self.assertEqual(cache.stats()['redis_hits'], 0)
+
+    def test_write_on_another_worker_invalidates_local_copy(self):
+        worker_a = cache_utils.TwoTierCache('test-shared')
+        worker_b = cache_utils.TwoTierCache('test-shared')
+        worker_a.set('product:1', {'version': 1})
+        self.assertEqual(worker_b.get('product:1'), {'version': 1})
+
+        worker_a.set('product:1', {'version': 2})
+
+        self.assertTrue(self._eventually(lambda: worker_b.stats()['invalidations'] == 1))
+        self.assertEqual(worker_b.get('product:1'), {'version': 2})
+
+    def test_lru_is_bounded(self):
+        cache = cache_utils.TwoTierCache('test-bounded', max_entries=2)
+        for key in ('a', 'b', 'c'):
+            cache.set(key, {'key': key})
+
+        self.assertEqual(cache.stats()['local_entries'], 2)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_profile_cache_invalidated_when_medical_history_changes(self):
+        user = User.objects.create_user('gina', password='secret-pass')
+        with self.captureOnCommitCallbacks(execute=True):
+            history = MedicalHistory.objects.create(user=user, allergies='Peanuts')
+        self.assertEqual(
+            IngredientAnalysisService._get_user_medical_history(user)['allergies'], ['Peanuts'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            history.allergies = 'Sesame'
+            history.save()
+        user = User.objects.get(pk=user.pk)
+
+        self.assertEqual(
+            IngredientAnalysisService._get_user_medical_history(user)['allergies'], ['Sesame'])
+
+    def test_fill_racing_an_invalidation_is_not_stored(self):
+        cache = cache_utils.TwoTierCache('test-race')
+
+        def stale_read():
+            # The source changes and is invalidated while this fill is computing
+            cache.invalidate('profile:1')
+            return {'allergies': ['Peanuts']}
+
+        self.assertEqual(cache.get_or_set('profile:1', stale_read), {'allergies': ['Peanuts']})
+        self.assertIsNone(self.redis.get('profile:1'))
+        self.assertIsNone(cache.get('profile:1'))
+        # The next fill, with no invalidation in between, is kept
+        cache.get_or_set('profile:1', lambda: {'allergies': []})
+        self.assertEqual(cache.get('profile:1'), {'allergies': []})
+
+
+class MedicalProfileTests(TestCase):
+    """The analyze path reads the profile and hash precomputed when MedicalHistory is saved"""
+
+    def setUp(self):
+        fake_redis()
+        self.addCleanup(mock.patch.stopall)
+        self.user = User.objects.create_user('lena', password='secret-pass')
+
+    def test_profile_and_hash_stored_on_save(self):
+        history = MedicalHistory.objects.create(user=self.user, allergies='Peanuts , Sesame,', age=40)
+        self.assertEqual(history.normalized_profile['allergies'], ['Peanuts', 'Sesame'])
+
+        same = MedicalHistory(allergies='Peanuts,Sesame', age=40)
+        self.assertEqual(MedicalHistory.hash_profile(same.build_profile()), history.profile_hash)
+
+        history.age = 41
+        history.save(update_fields=['age'])
+        history.refresh_from_db()
+        self.assertNotEqual(MedicalHistory.hash_profile(same.build_profile()), history.profile_hash)
+
+    def test_analyze_path_reuses_stored_profile(self):
+        history = MedicalHistory.objects.create(user=self.user, diseases='Hypertension')
+
+        with mock.patch.object(MedicalHistory, 'build_profile', side_effect=AssertionError), \
+                self.assertNumQueries(1):
+            profile = IngredientAnalysisService._get_user_medical_history(self.user)
+
+        self.assertEqual(profile['diseases'], ['Hypertension'])
+        self.assertEqual(profile['profile_hash'], history.profile_hash)
+
+
+class MetricsEndpointTests(TestCase):
+    """/metrics exposes the analyze pipeline's counters and histograms"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('hank', password='secret-pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        fake_redis()
+        mock.patch('cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        mock.patch.object(
+            ai_service, 'extract_ingredients',
+            return_value={'no_valid_ingredients': False, 'ingredients': ['Sugar']}).start()
+        mock.patch.object(
+            ai_service, 'score_ingredients', side_effect=lambda **kw: dict(SAMPLE_RESULT)).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_analyze_request_shows_up_in_metrics(self):
+        upload = SimpleUploadedFile('label.jpg', label_photo(3), content_type='image/jpeg')
+        self.client.post('/api/v1/analysis/analyze/', {'image': upload, 'category': 'food'})
+
+        body = self.client.get('/metrics').content.decode()
+
+        self.assertIn('ingredientai_cache_requests_total{cache="analysis",result="miss",tier="redis"}', body)
+        self.assertIn('ingredientai_cloudinary_request_seconds_count{operation="upload"}', body)
+        self.assertIn('ingredientai_image_bytes_count{stage="received"}', body)
+        self.assertIn(
+            'ingredientai_http_request_seconds_count{endpoint="api/v1/analysis/analyze/",'
+            'method="POST",status="200"}', body)
+        self.assertIn('ingredientai_db_query_seconds_count{alias="default"}', body)
+
+    def test_token_required_when_configured(self):
+        with mock.patch('ingredient_analysis_app.view.metrics_views.METRICS_AUTH_TOKEN', 'scrape-me'):
+            self.assertEqual(self.client.get('/metrics').status_code, 401)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-me')
+            self.assertEqual(response.status_code, 200)
+
+    def test_processes_outside_gunicorn_create_the_multiprocess_dir(self):
+        # The queue worker and management commands start without gunicorn's on_starting hook
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'prometheus'
+            result = subprocess.run(
+                [sys.executable, 'manage.py', 'check'], cwd=Path(__file__).resolve().parent.parent,
+                env={**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(path)},
+                capture_output=True, text=True, timeout=120)
+
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertTrue(path.is_dir())
+            self.assertTrue(any(path.glob('*.db')))
+
+class RequestTimingTests(TestCase):
+    """Staff users can ask for a per-stage Server-Timing breakdown of an analysis"""
+
+    def setUp(self):
+        self.client = APIClient()
+        fake_redis()
+        mock.patch('cloudinary.uploader.upload', return_value=fake_upload_result()).start()
+        model = mock.Mock()
+        model.generate_content.side_effect = lambda contents, **kwargs: SimpleNamespace(text=json.dumps(
+            {'no_valid_ingredients': False, 'ingredients': ['Sugar']}
+            if isinstance(contents, list) else SAMPLE_RESULT))
+        mock.patch.object(ai_service, 'model', model).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _analyze(self, user):
+        self.client.force_authenticate(user)
+        upload = SimpleUploadedFile('label.jpg', label_photo(4), content_type='image/jpeg')
+        return self.client.post('/api/v1/analysis/analyze/', {'image': upload, 'category': 'food'},
+                                HTTP_X_REQUEST_TIMING='1')
+
+    def test_staff_request_gets_server_timing_and_log_line(self):
+        staff = User.objects.create_user('ivy', password='secret-pass', is_staff=True)
+        with self.assertLogs('ingredient_analysis_app.utils.timing', 'INFO') as logs:
+            response = self._analyze(staff)
+
+        self.assertEqual(response.status_code, 200)
+        stages = {metric.split(';')[0] for metric in response['Server-Timing'].split(', ')}
+        self.assertTrue({'validate', 'hash', 'profile', 'cache', 'upload', 'model', 'parse',
+                         'db', 'total'} <= stages)
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['user_id'], staff.pk)
+        self.assertEqual(line['spans']['model']['count'], 2)
+
+    def test_header_ignored_for_regular_users(self):
+        response = self._analyze(User.objects.create_user('jack', password='secret-pass'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+
+
+class HistoryListTests(TestCase):
+    """The history list is served from the summary columns, without the result JSON"""
+
+    RESULT = {
+        **SAMPLE_RESULT,
+        "analysis_summary": {"safety_score": 35, "safety_level": "caution",
+                             "main_verdict": "High in added sugar.", "concern_count": 2},
+        "recommendation": {"verdict": "caution", "confidence": "high"},
+    }
+
+    def setUp(self):
+        self.user = User.objects.create_user('kate', password='secret-pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        mock.patch.object(cloudinary.config(), 'cloud_name', 'demo', create=True).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_list_returns_summary_and_retrieve_returns_result(self):
+        analysis = ingredient_analysis_service.save_analysis(
+            self.user, 'food', {'public_id': 'analysis/k1', 'result': self.RESULT})
+
+        with self.assertNumQueries(2):  # count + page
+            listed = self.client.get('/api/v1/analysis/history/').json()['results'][0]
+        self.assertNotIn('result', listed)
+        self.assertEqual(
+            {field: listed[field] for field in IngredientAnalysis.SUMMARY_FIELDS},
+            {'safety_score': 35, 'safety_level': 'caution', 'verdict': 'caution',
+             'concern_count': 2, 'main_verdict': 'High in added sugar.'})
+
+        detail = self.client.get(f'/api/v1/analysis/history/{analysis.pk}/').json()
+        self.assertEqual(json.loads(detail['result']), self.RESULT)
+
+    def test_backfill_fills_rows_saved_without_summary(self):
+        legacy = IngredientAnalysis.objects.create(
+            user=self.user, category='food', image='v1/analysis/k2', result=json.dumps(self.RESULT))
+        unreadable = IngredientAnalysis.objects.create(
+            user=self.user, category='food', image='v1/analysis/k3', result='not json')
+
+        call_command('backfill_analysis_summaries', stdout=io.StringIO())
+
+        legacy.refresh_from_db()
+        self.assertEqual((legacy.safety_score, legacy.verdict), (35, 'caution'))
+        unreadable.refresh_from_db()
+        self.assertIsNone(unreadable.safety_score)
+
+    def _rows(self, count, category='food'):
+        """Saved analyses one minute apart, oldest first"""
+        start = timezone.now() - datetime.timedelta(days=1)
+        rows = []
+        for minute in range(count):
+            analysis = ingredient_analysis_service.save_analysis(
+                self.user, category, {'public_id': f'analysis/r{minute}', 'result': self.RESULT})
+            IngredientAnalysis.objects.filter(pk=analysis.pk).update(
+                timestamp=start + datetime.timedelta(minutes=minute))
+            rows.append(analysis.pk)
+        return rows
+
+    def test_feed_pages_are_stable_while_rows_are_added(self):
+        rows = self._rows(5)
+
+        first = self.client.get('/api/v1/analysis/history/feed/?page_size=2').json()
+        self.assertEqual([item['id'] for item in first['results']], rows[:-3:-1])
+        self.assertNotIn('count', first)
+
+        # A new analysis arrives while the user scrolls; page numbers would shift by one
+        ingredient_analysis_service.save_analysis(
+            self.user, 'food', {'public_id': 'analysis/new', 'result': self.RESULT})
+        second = self.client.get(first['next']).json()
+        self.assertEqual([item['id'] for item in second['results']], [rows[2], rows[1]])
+
+    def test_history_filters_by_category_and_date_range(self):
+        food = self._rows(3)
+        IngredientAnalysis.objects.filter(pk=food[0]).update(category='cosmetics')
+        since = IngredientAnalysis.objects.get(pk=food[1]).timestamp
+
+        response = self.client.get('/api/v1/analysis/history/feed/',
+                                   {'category': 'food', 'since': since.isoformat()})
+        self.assertEqual([item['id'] for item in response.json()['results']], [food[2], food[1]])
+
+        response = self.client.get('/api/v1/analysis/history/', {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+
+class AssetDeletionTests(TestCase):
+    """Deleting analyses queues their images; the drainer removes them in batches"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('liam', password='secret-pass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        fake_redis()
+        self.delete_resources = mock.patch(
+            'cloudinary.api.delete_resources',
+            side_effect=lambda ids: {'deleted': {public_id: 'deleted' for public_id in ids}}).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _save(self, public_id, user=None, category='food'):
+        return ingredient_analysis_service.save_analysis(
+            user or self.user, category, {'public_id': public_id, 'result': SAMPLE_RESULT})
+
+    def test_bulk_delete_makes_no_cloudinary_calls(self):
+        for index in range(30):
+            self._save(f'analysis/p{index}', category='food' if index % 3 else 'cosmetics')
+        self._save('analysis/other', user=User.objects.create_user('mia', password='secret-pass'))
+
+        # select, unlink jobs, delete; then one reference check and one outbox insert
+        with self.assertNumQueries(7), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete('/api/v1/analysis/history/purge/?category=food')
+
+        self.assertEqual(response.data['deleted'], 20)
+        self.assertEqual(IngredientAnalysis.objects.filter(user=self.user).count(), 10)
+        self.assertEqual(len(pending_deletions()), 20)
+        self.delete_resources.assert_not_called()
+        self.assertEqual(self.client.delete('/api/v1/analysis/history/purge/').status_code, 400)
+
+        call_command('drain_asset_deletions', '--burst', '--batch-size', '8', stdout=io.StringIO())
+        self.assertEqual(pending_deletions(), [])
+        self.assertEqual([len(call.args[0]) for call in self.delete_resources.call_args_list],
+                         [8, 8, 4])
+
+    def test_account_deletion_queues_images_but_keeps_shared_ones(self):
+        self._save('analysis/mine')
+        self._save('analysis/shared')
+        self._save('analysis/shared', user=User.objects.create_user('noah', password='secret-pass'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete('/api/v1/auth/delete-account/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(User.objects.filter(username='liam').exists())
+        self.assertEqual(pending_deletions(), ['analysis/mine'])
+
+    def test_failed_batches_are_retried_with_backoff(self):
+        PendingAssetDeletion.schedule(['analysis/a', 'analysis/b'])
+        self.delete_resources.side_effect = [
+            Exception('Rate limit exceeded'),
+            {'deleted': {'analysis/a': 'not_found', 'analysis/b': 'error'}},
+        ]
+
+        self.assertEqual(asset_deletion_service.drain(), (0, 2))
+        row = PendingAssetDeletion.objects.get(public_id='analysis/a')
+        self.assertEqual((row.attempts, row.last_error), (1, 'Rate limit exceeded'))
+        self.assertGreater(row.next_attempt_at, timezone.now())
+        self.assertEqual(asset_deletion_service.drain(), (0, 0))  # not due yet
+
+        PendingAssetDeletion.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(asset_deletion_service.drain(), (1, 1))
+        self.assertEqual(pending_deletions(), ['analysis/b'])
+        self.assertEqual(PendingAssetDeletion.objects.get().attempts, 2)
+
+    def test_drainer_keeps_assets_an_analysis_picked_up_again(self):
+        PendingAssetDeletion.schedule(['analysis/reused'])
+        self._save('analysis/reused')
+
+        self.assertEqual(asset_deletion_service.drain(), (0, 0))
+        self.assertEqual(pending_deletions(), [])
+        self.delete_resources.assert_not_called()
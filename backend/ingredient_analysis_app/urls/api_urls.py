@@ -1,6 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from ..view.api_views import IngredientAnalysisViewSet, AnalyzeIngredientsAPIView
+from ..view.api_views import (
+    IngredientAnalysisViewSet,
+    AnalyzeIngredientsAPIView,
+    AnalyzeIngredientsBatchAPIView,
+    AnalyzeIngredientsStreamAPIView,
+    AnalysisJobStatusAPIView
+)
+from ..view.async_views import AnalyzeIngredientsAsyncView
 
 # Create a router for ViewSets
 router = DefaultRouter()
@@ -9,6 +16,17 @@ router.register(r'history', IngredientAnalysisViewSet, basename='analysis')
 urlpatterns = [
     # Analysis endpoint
     path('analyze/', AnalyzeIngredientsAPIView.as_view(), name='api_analyze'),
+    path('analyze/batch/', AnalyzeIngredientsBatchAPIView.as_view(),
+         name='api_analyze_batch'),
+    # Native async analyze path; serve with uvicorn to benefit
+    path('analyze/async/', AnalyzeIngredientsAsyncView.as_view(),
+         name='api_analyze_async'),
+    path('analyze/stream/', AnalyzeIngredientsStreamAPIView.as_view(),
+         name='api_analyze_stream'),
+
+    # Status of analyses submitted with mode=async
+    path('jobs/<uuid:pk>/', AnalysisJobStatusAPIView.as_view(),
+         name='api_analysis_job'),
 
     # Include router URLs for history, detail, etc.
     path('', include(router.urls)),
@@ -0,0 +1,437 @@
+import asyncio
+import math
+import random
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+import redis
+
+from . import cache_utils
+from .metrics import GEMINI_ADMISSION_REJECTIONS, GEMINI_ADMISSION_WAIT_SECONDS
+from .timing import span
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import (
+    GEMINI_ADMISSION_ENABLED, GEMINI_RATE_PER_SECOND, GEMINI_BURST, GEMINI_MAX_CONCURRENCY,
+    GEMINI_QUEUE_MAX, GEMINI_QUEUE_MAX_PER_USER, GEMINI_QUEUE_WAIT_SECONDS,
+    GEMINI_SLOT_LEASE_SECONDS
+)
+
+# Who the Gemini calls made in this context are for; set by the analysis
+# service around each request so the admission queue can be fair per user
+_current_requester = ContextVar('gemini_requester', default=None)
+
+
+class GeminiBusy(Exception):
+    """The model is saturated (admission queue full, wait budget spent, or upstream quota hit)"""
+
+    def __init__(self, retry_after, reason='queue_full'):
+        self.retry_after = retry_after
+        self.reason = reason
+        super().__init__(f"The analysis service is busy, retry after {retry_after} s")
+
+
+@contextmanager
+def requester(user):
+    """Attribute the Gemini calls made inside the block to `user`"""
+    token = _current_requester.set(getattr(user, 'pk', None))
+    try:
+        yield
+    finally:
+        _current_requester.reset(token)
+
+
+def is_quota_error(error):
+    """True for an upstream 429 / RESOURCE_EXHAUSTED from the Gemini client"""
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    return code == 429 or type(error).__name__ in ('ResourceExhausted', 'TooManyRequests')
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class GeminiAdmission:
+    """
+    Cross-worker admission control in front of Gemini.
+
+    A call may start only when a global concurrency slot is free and the
+    shared token bucket (rate per second, with a burst allowance) holds a
+    token. Callers that cannot start wait in a bounded Redis queue ordered
+    by start-time fair queuing: each user's n-th waiting call sorts after
+    every other user's earlier calls, so one user's burst cannot starve the
+    rest. A full queue, or a wait longer than the budget, raises GeminiBusy
+    with a Retry-After estimate instead of piling more calls on the quota.
+
+    Slots are leases, so a worker that dies mid-call frees its slot when the
+    lease runs out; waiters refresh a short heartbeat, so tickets of dead
+    waiters drop out of the queue within seconds. All state changes are
+    WATCH/MULTI transactions (no server-side scripting needed). Times are
+    wall-clock seconds, which assumes the web hosts' clocks are in sync.
+    """
+
+    HEARTBEAT_SECONDS = 5
+
+    def __init__(self, client=None, async_client=None, prefix='gemini_admission',
+                 rate=GEMINI_RATE_PER_SECOND, burst=GEMINI_BURST,
+                 max_concurrency=GEMINI_MAX_CONCURRENCY, max_queue=GEMINI_QUEUE_MAX,
+                 max_queue_per_user=GEMINI_QUEUE_MAX_PER_USER,
+                 wait_seconds=GEMINI_QUEUE_WAIT_SECONDS,
+                 lease_seconds=GEMINI_SLOT_LEASE_SECONDS, enabled=GEMINI_ADMISSION_ENABLED):
+        self._client = client
+        self._async_client = async_client
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.wait_seconds = wait_seconds
+        self.lease_seconds = lease_seconds
+        self.enabled = enabled
+        self.bucket_key = f"{prefix}:bucket"
+        self.slots_key = f"{prefix}:slots"
+        self.queue_key = f"{prefix}:queue"
+        self.heartbeat_key = f"{prefix}:heartbeat"
+        self.clock_key = f"{prefix}:clock"
+
+    @property
+    def client(self):
+        return self._client or cache_utils.redis_client
+
+    @property
+    def async_client(self):
+        return self._async_client or cache_utils.get_async_redis_client()
+
+    @contextmanager
+    def slot(self):
+        """Hold an admission slot for one Gemini call made by the current requester"""
+        ticket = self.acquire_current()
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def aslot(self):
+        ticket = await self.aacquire_current()
+        try:
+            yield
+        finally:
+            await self.arelease(ticket)
+
+    def acquire_current(self):
+        """acquire() for the current requester, for callers that release the ticket elsewhere"""
+        with span('admission'):
+            return self.acquire(_current_requester.get())
+
+    async def aacquire_current(self):
+        with span('admission'):
+            return await self.aacquire(_current_requester.get())
+
+    def try_acquire_current(self):
+        """
+        A slot and a token for the current requester only if both are free
+        now and nobody is waiting (hedged requests never queue). Returns
+        (admitted, ticket to release).
+        """
+        if not self.enabled:
+            return True, None
+        ticket = f"{self._user_key(_current_requester.get())}:{uuid.uuid4().hex}"
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.queue_key, self.slots_key, self.bucket_key, self.clock_key)
+                now = time.time()
+                queue = [_text(member) for member in pipe.zrange(self.queue_key, 0, -1)]
+                stale = {_text(member) for member in pipe.zrangebyscore(
+                    self.heartbeat_key, '-inf', now)}
+                in_flight = pipe.zcount(self.slots_key, now, '+inf')
+                tokens, updated_at = pipe.hmget(self.bucket_key, 'tokens', 'updated_at')
+                clock = pipe.hget(self.clock_key, '_global')
+                plan = self._plan_immediate(ticket, queue, stale, in_flight, tokens, updated_at, clock, now)
+                if not plan['admit']:
+                    return False, None
+                pipe.multi()
+                self._write_admit(pipe, ticket, plan, now)
+                pipe.execute()
+                return True, ticket
+            except redis.WatchError:
+                return False, None
+
+    async def atry_acquire_current(self):
+        if not self.enabled:
+            return True, None
+        ticket = f"{self._user_key(_current_requester.get())}:{uuid.uuid4().hex}"
+        async with self.async_client.pipeline() as pipe:
+            try:
+                await pipe.watch(self.queue_key, self.slots_key, self.bucket_key, self.clock_key)
+                now = time.time()
+                queue = [_text(member) for member in await pipe.zrange(self.queue_key, 0, -1)]
+                stale = {_text(member) for member in await pipe.zrangebyscore(
+                    self.heartbeat_key, '-inf', now)}
+                in_flight = await pipe.zcount(self.slots_key, now, '+inf')
+                tokens, updated_at = await pipe.hmget(self.bucket_key, 'tokens', 'updated_at')
+                clock = await pipe.hget(self.clock_key, '_global')
+                plan = self._plan_immediate(ticket, queue, stale, in_flight, tokens, updated_at, clock, now)
+                if not plan['admit']:
+                    return False, None
+                pipe.multi()
+                self._write_admit(pipe, ticket, plan, now)
+                await pipe.execute()
+                return True, ticket
+            except redis.WatchError:
+                return False, None
+
+    def retry_after(self, queued):
+        """Seconds until a new call would likely get through a queue of `queued` waiters"""
+        return max(1, min(60, math.ceil((queued + 1) / self.rate)))
+
+    def quota_exceeded(self):
+        """GeminiBusy for an upstream 429: the quota is spent despite the bucket"""
+        return self._rejected(self.burst, 'upstream_quota')
+
+    def acquire(self, user_id):
+        """Wait for a slot and a token; returns the ticket to release, or raises GeminiBusy"""
+        if not self.enabled:
+            return None
+        started = time.monotonic()
+        ticket = self._enqueue(self._user_key(user_id))
+        try:
+            delay = 0.02
+            while True:
+                admitted, hint, queued = self._try_admit(ticket)
+                if admitted:
+                    GEMINI_ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started)
+                    return ticket
+                if time.monotonic() - started >= self.wait_seconds:
+                    raise self._rejected(queued, 'timeout')
+                time.sleep(self._pause(hint, delay))
+                delay = min(delay * 2, 0.25)
+        except BaseException:
+            self._leave(ticket)
+            raise
+
+    def release(self, ticket):
+        if ticket is not None:
+            self.client.zrem(self.slots_key, ticket)
+
+    async def aacquire(self, user_id):
+        """Async variant of acquire(); waits without blocking the event loop"""
+        if not self.enabled:
+            return None
+        started = time.monotonic()
+        ticket = await self._aenqueue(self._user_key(user_id))
+        try:
+            delay = 0.02
+            while True:
+                admitted, hint, queued = await self._atry_admit(ticket)
+                if admitted:
+                    GEMINI_ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started)
+                    return ticket
+                if time.monotonic() - started >= self.wait_seconds:
+                    raise self._rejected(queued, 'timeout')
+                await asyncio.sleep(self._pause(hint, delay))
+                delay = min(delay * 2, 0.25)
+        except BaseException:
+            await self._aleave(ticket)
+            raise
+
+    async def arelease(self, ticket):
+        if ticket is not None:
+            await self.async_client.zrem(self.slots_key, ticket)
+
+    def state(self):
+        """Current slots in use, queue length and tokens, for diagnostics"""
+        now = time.time()
+        tokens, updated_at = self.client.hmget(self.bucket_key, 'tokens', 'updated_at')
+        return {
+            'in_flight': self.client.zcount(self.slots_key, now, '+inf'),
+            'queued': self.client.zcard(self.queue_key),
+            'tokens': round(self._refill(tokens, updated_at, now), 2),
+        }
+
+    # Transactions. Each reads under WATCH, decides in Python (_plan_*) and
+    # writes in MULTI; a concurrent change makes the write fail and retry.
+
+    def _enqueue(self, user_key):
+        ticket = f"{user_key}:{uuid.uuid4().hex}"
+        while True:
+            with self.client.pipeline() as pipe:
+                try:
+                    pipe.watch(self.queue_key, self.heartbeat_key, self.clock_key)
+                    now = time.time()
+                    queue = [_text(member) for member in pipe.zrange(self.queue_key, 0, -1)]
+                    stale = {_text(member) for member in pipe.zrangebyscore(
+                        self.heartbeat_key, '-inf', now)}
+                    clock = pipe.hmget(self.clock_key, '_global', user_key)
+                    start = self._plan_enqueue(queue, stale, user_key, clock)
+                    pipe.multi()
+                    self._write_enqueue(pipe, ticket, user_key, start, stale, now)
+                    pipe.execute()
+                    return ticket
+                except redis.WatchError:
+                    continue
+
+    def _try_admit(self, ticket):
+        """(admitted, seconds worth waiting before the next try, queue length)"""
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.queue_key, self.slots_key, self.bucket_key, self.clock_key)
+                now = time.time()
+                queue = [(_text(member), score) for member, score in pipe.zrange(
+                    self.queue_key, 0, -1, withscores=True)]
+                stale = {_text(member) for member in pipe.zrangebyscore(
+                    self.heartbeat_key, '-inf', now)}
+                in_flight = pipe.zcount(self.slots_key, now, '+inf')
+                tokens, updated_at = pipe.hmget(self.bucket_key, 'tokens', 'updated_at')
+                clock = pipe.hget(self.clock_key, '_global')
+                plan = self._plan_admit(
+                    ticket, queue, stale, in_flight, tokens, updated_at, clock, now)
+                if plan['admit']:
+                    pipe.multi()
+                    self._write_admit(pipe, ticket, plan, now)
+                    pipe.execute()
+                    return True, 0, plan['queued']
+            except redis.WatchError:
+                return False, 0, len(queue)
+        self.client.zadd(self.heartbeat_key, {ticket: now + self.HEARTBEAT_SECONDS}, xx=True)
+        return False, plan['wait'], plan['queued']
+
+    def _leave(self, ticket):
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.zrem(self.queue_key, ticket)
+            pipe.zrem(self.heartbeat_key, ticket)
+            pipe.execute()
+
+    async def _aenqueue(self, user_key):
+        ticket = f"{user_key}:{uuid.uuid4().hex}"
+        while True:
+            async with self.async_client.pipeline() as pipe:
+                try:
+                    await pipe.watch(self.queue_key, self.heartbeat_key, self.clock_key)
+                    now = time.time()
+                    queue = [_text(member) for member in await pipe.zrange(self.queue_key, 0, -1)]
+                    stale = {_text(member) for member in await pipe.zrangebyscore(
+                        self.heartbeat_key, '-inf', now)}
+                    clock = await pipe.hmget(self.clock_key, '_global', user_key)
+                    start = self._plan_enqueue(queue, stale, user_key, clock)
+                    pipe.multi()
+                    self._write_enqueue(pipe, ticket, user_key, start, stale, now)
+                    await pipe.execute()
+                    return ticket
+                except redis.WatchError:
+                    continue
+
+    async def _atry_admit(self, ticket):
+        async with self.async_client.pipeline() as pipe:
+            try:
+                await pipe.watch(self.queue_key, self.slots_key, self.bucket_key, self.clock_key)
+                now = time.time()
+                queue = [(_text(member), score) for member, score in await pipe.zrange(
+                    self.queue_key, 0, -1, withscores=True)]
+                stale = {_text(member) for member in await pipe.zrangebyscore(
+                    self.heartbeat_key, '-inf', now)}
+                in_flight = await pipe.zcount(self.slots_key, now, '+inf')
+                tokens, updated_at = await pipe.hmget(self.bucket_key, 'tokens', 'updated_at')
+                clock = await pipe.hget(self.clock_key, '_global')
+                plan = self._plan_admit(
+                    ticket, queue, stale, in_flight, tokens, updated_at, clock, now)
+                if plan['admit']:
+                    pipe.multi()
+                    self._write_admit(pipe, ticket, plan, now)
+                    await pipe.execute()
+                    return True, 0, plan['queued']
+            except redis.WatchError:
+                return False, 0, len(queue)
+        await self.async_client.zadd(
+            self.heartbeat_key, {ticket: now + self.HEARTBEAT_SECONDS}, xx=True)
+        return False, plan['wait'], plan['queued']
+
+    async def _aleave(self, ticket):
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            pipe.zrem(self.queue_key, ticket)
+            pipe.zrem(self.heartbeat_key, ticket)
+            await pipe.execute()
+
+    # Decisions and writes shared by the sync and async transactions
+
+    def _plan_enqueue(self, queue, stale, user_key, clock):
+        """Virtual start time for a new ticket, or GeminiBusy if the queue is full"""
+        live = [member for member in queue if member not in stale]
+        if len(live) >= self.max_queue:
+            raise self._rejected(len(live), 'queue_full')
+        if sum(member.startswith(f"{user_key}:") for member in live) >= self.max_queue_per_user:
+            raise self._rejected(len(live), 'user_queue_full')
+        global_clock, user_clock = (float(_text(value) or 0) for value in clock)
+        return max(global_clock, user_clock)
+
+    def _write_enqueue(self, pipe, ticket, user_key, start, stale, now):
+        if stale:
+            pipe.zrem(self.queue_key, *stale)
+            pipe.zrem(self.heartbeat_key, *stale)
+        pipe.zadd(self.queue_key, {ticket: start})
+        pipe.zadd(self.heartbeat_key, {ticket: now + self.HEARTBEAT_SECONDS})
+        # The user's next call starts one unit of virtual time later
+        pipe.hset(self.clock_key, user_key, start + 1)
+        pipe.expire(self.clock_key, 3600)
+
+    def _plan_admit(self, ticket, queue, stale, in_flight, tokens, updated_at, clock, now):
+        live = [(member, score) for member, score in queue if member not in stale]
+        position = next((index for index, (member, _) in enumerate(live) if member == ticket), None)
+        if position is None:
+            # Dropped as stale (this worker stalled past its heartbeat)
+            raise self._rejected(len(live), 'timeout')
+        tokens = self._refill(tokens, updated_at, now)
+        # Virtual time only moves forward, so newcomers queue behind admitted calls
+        plan = {'admit': False, 'queued': len(live), 'stale': stale, 'tokens': tokens,
+                'clock': max(live[position][1], float(_text(clock) or 0)), 'wait': 0.05}
+        if position >= self.max_concurrency - in_flight:
+            return plan
+        if tokens < 1:
+            plan['wait'] = (1 - tokens) / self.rate
+            return plan
+        plan['admit'] = True
+        return plan
+
+    def _plan_immediate(self, ticket, queue, stale, in_flight, tokens, updated_at, clock, now):
+        """_plan_admit for a ticket that only goes ahead when no live waiter is ahead of it"""
+        if any(member not in stale for member in queue):
+            return {'admit': False}
+        return self._plan_admit(ticket, [(ticket, 0.0)], set(), in_flight, tokens, updated_at, clock, now)
+
+    def _write_admit(self, pipe, ticket, plan, now):
+        if plan['stale']:
+            pipe.zrem(self.queue_key, *plan['stale'])
+            pipe.zrem(self.heartbeat_key, *plan['stale'])
+        pipe.zremrangebyscore(self.slots_key, '-inf', now)
+        pipe.hset(self.bucket_key, mapping={'tokens': plan['tokens'] - 1, 'updated_at': now})
+        pipe.zrem(self.queue_key, ticket)
+        pipe.zrem(self.heartbeat_key, ticket)
+        pipe.zadd(self.slots_key, {ticket: now + self.lease_seconds})
+        pipe.hset(self.clock_key, '_global', plan['clock'])
+
+    def _refill(self, tokens, updated_at, now):
+        if tokens is None:
+            return float(self.burst)
+        elapsed = max(0.0, now - float(_text(updated_at)))
+        return min(float(self.burst), float(_text(tokens)) + elapsed * self.rate)
+
+    def _rejected(self, queued, reason):
+        GEMINI_ADMISSION_REJECTIONS.labels(reason).inc()
+        return GeminiBusy(self.retry_after(queued), reason)
+
+    @staticmethod
+    def _pause(hint, delay):
+        return min(max(hint, delay), 0.5) * random.uniform(0.8, 1.2)
+
+    @staticmethod
+    def _user_key(user_id):
+        return f"user{user_id}" if user_id is not None else 'anonymous'
+
+
+gemini_admission = GeminiAdmission()
@@ -0,0 +1,344 @@
+import json
+import logging
+import math
+
+from .metrics import AI_RESPONSE_PARSES, AI_RESPONSE_REPAIRS
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ('safe', 'caution', 'danger')
+LEVELS = ('low', 'medium', 'high')
+ALERT_TYPES = ('allergy_match', 'condition_risk', 'interaction_warning')
+VERDICTS = ('recommend', 'caution', 'avoid')
+
+# Object starts tried before giving up (prose before the JSON may contain braces)
+MAX_OBJECT_STARTS = 4
+# Text that may surround the object for the parse to still count as direct
+OPENING_FENCES = ('', '```', '```json')
+CLOSING_FENCES = ('', '```')
+
+# Stands in for an absent key, so fields can tell it from an explicit null
+MISSING = object()
+
+_decoder = json.JSONDecoder()
+
+
+class InvalidResponse(ValueError):
+    """The model's JSON lacks a field no useful result can be built without"""
+
+
+def _repaired(path):
+    AI_RESPONSE_REPAIRS.labels(path).inc()
+
+
+def _field(decode, nested=None, **schema):
+    """
+    Attach the Gemini response schema of a field to its decoder, and whether
+    it holds a record ('one') or a list of them ('many')
+    """
+    decode.schema = schema
+    decode.nested = nested
+    return decode
+
+
+def text(default='', nullable=False):
+    def decode(value, path):
+        if isinstance(value, str) or (nullable and value is None):
+            return value
+        _repaired(path)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return str(value)
+        return default
+    return _field(decode, type='STRING', **({'nullable': True} if nullable else {}))
+
+
+def choice(values, default):
+    """One of `values`, matched case-insensitively; anything else becomes `default`"""
+    def decode(value, path):
+        if value in values:
+            return value
+        if isinstance(value, str):
+            cleaned = value.strip().lower()
+            if cleaned in values:
+                return cleaned
+        _repaired(path)
+        return default
+    return _field(decode, type='STRING', format='enum', enum=list(values))
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        try:
+            value = float(value.strip().rstrip('%'))
+        except ValueError:
+            return None
+    if isinstance(value, float):
+        return round(value) if math.isfinite(value) else None
+    return value if isinstance(value, int) else None
+
+
+def integer(low, high=None, default=0, required=False):
+    """An int clamped to [low, high]; numeric strings and floats are rounded"""
+    def decode(value, path):
+        number = _number(value)
+        if number is None:
+            if required:
+                raise InvalidResponse(f"{path} is not a number: {value!r}")
+            _repaired(path)
+            return default
+        clamped = max(low, number if high is None else min(number, high))
+        if clamped != value or type(value) is not int:
+            _repaired(path)
+        return clamped
+    return _field(decode, type='INTEGER')
+
+
+def flag(default=False):
+    def decode(value, path):
+        if isinstance(value, bool):
+            return value
+        _repaired(path)
+        if isinstance(value, str) and value.strip().lower() in ('true', 'false'):
+            return value.strip().lower() == 'true'
+        return default
+    return _field(decode, type='BOOLEAN')
+
+
+def strings():
+    """A list of strings; other items are dropped"""
+    def decode(value, path):
+        if not isinstance(value, list):
+            _repaired(path)
+            return []
+        items = [item for item in value if isinstance(item, str)]
+        if len(items) != len(value):
+            _repaired(path)
+        return items
+    return _field(decode, type='ARRAY', items={'type': 'STRING'})
+
+
+def record(record_type, default=None):
+    """A nested object; without `default` the whole response is rejected when it is missing"""
+    def decode(value, path):
+        if isinstance(value, dict):
+            return record_type.decode(value, path)
+        if default is None:
+            raise InvalidResponse(f"{path} is not an object: {value!r}")
+        _repaired(path)
+        return record_type.decode(default, path)
+    return _field(decode, nested='one', **record_type.schema())
+
+
+def records(record_type):
+    """A list of nested objects; items that are not objects are dropped"""
+    def decode(value, path):
+        if not isinstance(value, list):
+            _repaired(path)
+            return []
+        items = [record_type.decode(item, path) for item in value if isinstance(item, dict)]
+        if len(items) != len(value):
+            _repaired(path)
+        return items
+    return _field(decode, nested='many', type='ARRAY', items=record_type.schema())
+
+
+class Record:
+    """
+    Typed view of one JSON object in a model response. Subclasses declare
+    FIELDS (key -> field decoder); decode() builds the record in one walk
+    over the parsed JSON, coercing or defaulting malformed values and
+    dropping unknown keys.
+    """
+
+    __slots__ = ()
+    FIELDS = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # path -> ((key, decoder, field path), ...), so decode() builds no strings
+        cls._layouts = {}
+        cls._nested = tuple((name, field.nested == 'many')
+                            for name, field in cls.FIELDS.items() if field.nested)
+
+    @classmethod
+    def decode(cls, data, path=''):
+        layout = cls._layouts.get(path)
+        if layout is None:
+            prefix = f"{path}." if path else ''
+            layout = cls._layouts[path] = tuple(
+                (name, field, prefix + name) for name, field in cls.FIELDS.items())
+        instance = cls.__new__(cls)
+        get = data.get
+        for name, field, field_path in layout:
+            setattr(instance, name, field(get(name, MISSING), field_path))
+        instance.finish()
+        return instance
+
+    @classmethod
+    def schema(cls):
+        """Gemini response_schema for this object"""
+        return {
+            'type': 'OBJECT',
+            'properties': {name: field.schema for name, field in cls.FIELDS.items()},
+            'required': list(cls.FIELDS),
+        }
+
+    def finish(self):
+        """Repairs that need several fields; called once they are all decoded"""
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        for name, many in self._nested:
+            value = data[name]
+            data[name] = [item.to_dict() for item in value] if many else value.to_dict()
+        return data
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class ExtractionResult(Record):
+    FIELDS = {
+        'no_valid_ingredients': flag(),
+        'ingredients': strings(),
+    }
+    __slots__ = tuple(FIELDS)
+
+
+class Ingredient(Record):
+    FIELDS = {
+        'name': text(),
+        'purpose': text(),
+        'status': choice(STATUSES, 'caution'),
+        'concern_level': choice(LEVELS, 'medium'),
+        'user_specific_risk': flag(),
+        'quick_summary': text(),
+        'why_flagged': text(default=None, nullable=True),
+    }
+    __slots__ = tuple(FIELDS)
+
+
+class IngredientGroup(Record):
+    FIELDS = {
+        'group_name': text(),
+        'ingredients': records(Ingredient),
+    }
+    __slots__ = tuple(FIELDS)
+
+
+class HealthAlert(Record):
+    FIELDS = {
+        'type': choice(ALERT_TYPES, 'condition_risk'),
+        'severity': choice(LEVELS, 'medium'),
+        'message': text(),
+        'ingredient': text(),
+        'action': text(),
+    }
+    __slots__ = tuple(FIELDS)
+
+
+class Recommendation(Record):
+    FIELDS = {
+        'verdict': choice(VERDICTS, 'caution'),
+        'confidence': choice(LEVELS, 'low'),
+        'reason': text(),
+        'safe_to_try': flag(),
+    }
+    __slots__ = tuple(FIELDS)
+
+
+class Alternative(Record):
+    FIELDS = {
+        'name': text(),
+        'why': text(),
+        'benefit': text(),
+    }
+    __slots__ = tuple(FIELDS)
+
+
+class AnalysisSummary(Record):
+    FIELDS = {
+        'safety_score': integer(0, 100, required=True),
+        # None until finish() derives it from the score
+        'safety_level': choice(STATUSES, None),
+        'should_use': flag(),
+        'main_verdict': text(),
+        'detailed_explanation': text(),
+        'nutritional_highlights': text(),
+        # None until AnalysisResult.finish() counts the flagged ingredients
+        'concern_count': integer(0, default=None),
+    }
+    __slots__ = tuple(FIELDS)
+
+    def finish(self):
+        if self.safety_level is None:
+            self.safety_level = ('safe' if self.safety_score >= 70
+                                 else 'caution' if self.safety_score >= 40 else 'danger')
+
+
+class AnalysisResult(Record):
+    FIELDS = {
+        'no_valid_ingredients': flag(),
+        'analysis_summary': record(AnalysisSummary),
+        'ingredient_groups': records(IngredientGroup),
+        'health_alerts': records(HealthAlert),
+        'recommendation': record(Recommendation, default={
+            'verdict': 'caution', 'confidence': 'low', 'reason': '', 'safe_to_try': False}),
+        'alternatives': records(Alternative),
+        'key_advice': text(),
+    }
+    __slots__ = tuple(FIELDS)
+
+    def finish(self):
+        if self.analysis_summary.concern_count is None:
+            self.analysis_summary.concern_count = sum(
+                ingredient.status != 'safe'
+                for group in self.ingredient_groups for ingredient in group.ingredients)
+
+
+EXTRACTION_SCHEMA = ExtractionResult.schema()
+SCORING_SCHEMA = AnalysisResult.schema()
+
+
+def load_object(response_text):
+    """
+    First JSON object in a model response and how it was found: 'direct'
+    when nothing but whitespace or a markdown fence surrounds it,
+    'brace_extract' when prose does; (None, 'failed') when there is none or
+    the answer was cut off.
+    The object is decoded in place, without copying the text around it.
+    """
+    start = response_text.find('{')
+    for _ in range(MAX_OBJECT_STARTS):
+        if start == -1:
+            break
+        try:
+            value, end = _decoder.raw_decode(response_text, start)
+        except json.JSONDecodeError as e:
+            if e.msg.startswith('Unterminated') or e.pos >= len(response_text.rstrip()):
+                # Cut off: every later brace is inside the unfinished object
+                break
+            start = response_text.find('{', start + 1)
+            continue
+        direct = (response_text[:start].strip().lower() in OPENING_FENCES
+                  and response_text[end:].strip() in CLOSING_FENCES)
+        return value, 'direct' if direct else 'brace_extract'
+    return None, 'failed'
+
+
+def decode_response(response_text, result_type):
+    """Typed `result_type` for a model response, or None when it holds nothing usable"""
+    value, outcome = load_object(response_text)
+    result = None
+    if value is None:
+        logger.error("No JSON object in the model response")
+    else:
+        try:
+            result = result_type.decode(value)
+        except InvalidResponse as e:
+            logger.error(f"Model response failed validation: {str(e)}")
+            outcome = 'invalid'
+    AI_RESPONSE_PARSES.labels(outcome).inc()
+    return result
@@ -1,7 +1,12 @@
+import contextvars
+import json
 import logging
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework.renderers import BaseRenderer
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 from rest_framework.views import exception_handler
 
 logger = logging.getLogger(__name__)
@@ -13,6 +18,19 @@ class StandardResultsSetPagination(PageNumberPagination):
     max_page_size = 100
 
 
+class HistoryCursorPagination(CursorPagination):
+    """
+    Keyset pagination for analysis history: each page seeks past the last
+    row seen on the (user, -timestamp, -id) index, so deep pages cost the
+    same as the first and rows inserted while scrolling never shift a page.
+    No COUNT(*) is issued.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = ('-timestamp', '-id')
+
+
 class CustomAPIResponse:
     """Standardized API response helper"""
 
@@ -31,6 +49,47 @@ class CustomAPIResponse:
         return Response(response_data, status=status_code)
 
 
+def format_sse(event, data):
+    """Encode one Server-Sent Event frame with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+class ServerSentEventRenderer(BaseRenderer):
+    """
+    Lets streaming views accept `Accept: text/event-stream`. Event streams
+    are written directly; only regular responses (e.g. validation errors)
+    pass through here, and are sent as a single error event.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return format_sse('error', data).encode(self.charset)
+
+
+async def iterate_in_thread(iterator):
+    """
+    Async iterator over a sync one, each item pulled through sync_to_async.
+    Under ASGI Django reads a sync StreamingHttpResponse iterator to the end
+    before sending anything; this sends each item as it is produced.
+    """
+    # One context for every step, so context variables the generator sets
+    # before a yield are still there when it resumes
+    context = contextvars.copy_context()
+    done = object()
+    try:
+        while True:
+            item = await sync_to_async(context.run)(next, iterator, done)
+            if item is done:
+                return
+            yield item
+    finally:
+        # The client went away mid-stream: let the generator clean up
+        if hasattr(iterator, 'close'):
+            await sync_to_async(context.run)(iterator.close)
+
+
 def custom_exception_handler(exc, context):
     """Custom exception handler for API"""
     response = exception_handler(exc, context)
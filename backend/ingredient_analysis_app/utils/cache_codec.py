@@ -0,0 +1,61 @@
+import json
+import zlib
+
+# Header byte identifying how a cached value was encoded. Legacy entries are
+# plain JSON text and start with a printable character, so they can never be
+# mistaken for one of these.
+CODEC_JSON = 0x00          # compact JSON, for values too small to be worth compressing
+CODEC_ZLIB_DICT_V1 = 0x01  # compact JSON, raw DEFLATE primed with ZDICT_V1
+
+# Values shorter than this are stored uncompressed
+MIN_COMPRESS_BYTES = 256
+COMPRESSION_LEVEL = 6
+
+# Preset dictionary: the key names and enum values every analysis repeats.
+# DEFLATE back-references into it from the first byte, which matters most for
+# small entries. Never edit it in place - add a new header byte with a new
+# dictionary instead, or existing entries stop decoding.
+ZDICT_V1 = json.dumps({
+    "ingredients": [],
+    "image_url": "https://res.cloudinary.com/",
+    "public_id": "",
+    "no_valid_ingredients": False,
+    "analysis_summary": {
+        "safety_score": 0, "safety_level": "safe caution danger unknown",
+        "should_use": True, "main_verdict": "", "detailed_explanation": "",
+        "nutritional_highlights": "", "concern_count": 0
+    },
+    "ingredient_groups": [{"group_name": "", "ingredients": [{
+        "name": "", "purpose": "", "status": "safe", "concern_level": "low",
+        "user_specific_risk": False, "quick_summary": "", "why_flagged": None
+    }]}],
+    "health_alerts": [{
+        "type": "allergy_match condition_risk interaction_warning",
+        "severity": "high", "message": "", "ingredient": "", "action": ""
+    }],
+    "recommendation": {"verdict": "recommend caution avoid", "confidence": "high medium low",
+                       "reason": "", "safe_to_try": False},
+    "alternatives": [{"name": "", "why": "", "benefit": ""}],
+    "key_advice": "",
+    "metadata": {"status": "completed"}
+}, separators=(',', ':')).encode()
+
+
+def encode_value(value):
+    """Serialize a cache value to compact JSON behind a one-byte codec header"""
+    payload = json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode()
+    if len(payload) < MIN_COMPRESS_BYTES:
+        return bytes([CODEC_JSON]) + payload
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=ZDICT_V1)
+    return bytes([CODEC_ZLIB_DICT_V1]) + compressor.compress(payload) + compressor.flush()
+
+
+def decode_value(data):
+    """Inverse of encode_value; entries written before the codec are read as plain JSON"""
+    header = data[0]
+    if header == CODEC_ZLIB_DICT_V1:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=ZDICT_V1)
+        return json.loads(decompressor.decompress(data[1:]) + decompressor.flush())
+    if header == CODEC_JSON:
+        return json.loads(data[1:])
+    return json.loads(data)
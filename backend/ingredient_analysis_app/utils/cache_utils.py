@@ -1,13 +1,40 @@
 import redis
+import redis.asyncio
+import asyncio
+import datetime
 import hashlib
+import io
 import json
+import logging
+import random
 import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
+import numpy as np
+from PIL import Image
+
+from .cache_codec import encode_value, decode_value
+from .metrics import BARCODE_SCANS, CACHE_REQUESTS
 
 # Add the parent directory to the path to import config module
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
 
-from config.configuration import REDIS_HOST, REDIS_PORT, REDIS_DB
+from config.configuration import (
+    REDIS_HOST, REDIS_PORT, REDIS_DB, ANALYSIS_CACHE_TTL_SECONDS,
+    PHASH_MAX_DISTANCE, SINGLE_FLIGHT_LEASE_SECONDS, SINGLE_FLIGHT_WAIT_SECONDS,
+    LOCAL_CACHE_MAX_ENTRIES, LOCAL_CACHE_MAX_BYTES, LOCAL_CACHE_TTL_SECONDS,
+    CACHE_INVALIDATION_CHANNEL, PROFILE_CACHE_TTL_SECONDS,
+    NEGATIVE_CACHE_TTL_SECONDS, NEGATIVE_CACHE_MAX_TTL_SECONDS,
+    NEGATIVE_CACHE_STRIKE_WINDOW_SECONDS, NEGATIVE_CACHE_PHASH_STRIKES,
+    NEGATIVE_CACHE_PHASH_MAX_DISTANCE, BARCODE_STATS_RETENTION_DAYS
+)
+
+logger = logging.getLogger(__name__)
 
 # Initialize Redis client
 redis_client = redis.StrictRedis(
@@ -17,6 +44,54 @@ redis_client = redis.StrictRedis(
     decode_responses=True
 )
 
+# Cached analyses and extractions are stored with the binary cache codec;
+# this client hands values back as raw bytes instead of decoding them to str
+binary_redis_client = redis.StrictRedis(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=REDIS_DB
+)
+
+# redis.asyncio connections belong to the event loop that opened them, so
+# each running loop gets its own client: a uvicorn worker has one long-lived
+# loop, async views served by WSGI and tests get a loop per call. A client is
+# closed when its loop shuts down
+_async_redis = weakref.WeakKeyDictionary()
+
+
+async def _close_with_loop(client):
+    """
+    Parked at its yield on the client's loop. asyncio.run() (used by uvicorn
+    and asgiref) closes pending async generators before closing the loop,
+    which runs the finally block while the loop can still await
+    """
+    try:
+        yield
+    finally:
+        _async_redis.pop(asyncio.get_running_loop(), None)
+        await client.aclose()
+
+
+def get_async_redis_client():
+    """redis.asyncio client bound to the running event loop (returns raw bytes)"""
+    loop = asyncio.get_running_loop()
+    entry = _async_redis.get(loop)
+    if entry is None:
+        # Loops closed without shutting down their async generators
+        for owner in [owner for owner in list(_async_redis) if owner.is_closed()]:
+            _async_redis.pop(owner, None)
+        client = redis.asyncio.StrictRedis(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=REDIS_DB
+        )
+        closer = _close_with_loop(client)
+        # Keep the generator referenced (the loop only holds it weakly) and
+        # run it to its yield
+        entry = _async_redis[loop] = (client, closer)
+        asyncio.ensure_future(closer.__anext__())
+    return entry[0]
+
 
 def generate_cache_key(identifier, category, allergies, diseases):
     """
@@ -46,3 +121,755 @@ def generate_image_cache_key(image_file):
         image_content = image_file.read()
         image_file.seek(0)
     return hashlib.sha256(image_content).hexdigest()
+
+
+@lru_cache(maxsize=4)
+def _dct_matrix(size):
+    """Orthonormal DCT-II basis used to compute 2-D DCTs with two matrix products"""
+    k = np.arange(size)
+    matrix = np.sqrt(2 / size) * np.cos(
+        np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def generate_perceptual_hash(image_file, hash_size=8, highfreq_factor=4):
+    """
+    Compute a 64-bit perceptual hash (pHash) of the image: the signs of the
+    lowest-frequency DCT coefficients of a 32x32 grayscale thumbnail relative
+    to their median. Re-photographs of the same label land within a few bits
+    of each other, unlike SHA-256 of the raw bytes.
+    Accepts bytes or a file-like object.
+    """
+    if isinstance(image_file, (bytes, bytearray)):
+        source = io.BytesIO(image_file)
+    else:
+        source = image_file
+        source.seek(0)
+
+    size = hash_size * highfreq_factor
+    with Image.open(source) as img:
+        # Let the JPEG decoder downscale while decoding instead of after
+        img.draft('L', (size * 4, size * 4))
+        small = img.convert('L').resize((size, size), Image.Resampling.LANCZOS)
+    source.seek(0)
+
+    dct = _dct_matrix(size)
+    coefficients = (dct @ np.asarray(small, dtype=np.float64) @ dct.T)[
+        :hash_size, :hash_size].flatten()
+    # The DC term only tracks overall brightness; keep it out of the median
+    bits = coefficients > np.median(coefficients[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming_distance(first, second):
+    return (first ^ second).bit_count()
+
+
+class PerceptualHashIndex:
+    """
+    Redis index of image fingerprints, per category, for near-duplicate lookup.
+
+    Each 64-bit fingerprint is split into eight 8-bit bands stored in sorted
+    sets (scored by insertion time). Two fingerprints within 7 bits of each
+    other must agree on at least one band, so a lookup only scores the
+    members of its own eight buckets rather than the whole index.
+    """
+
+    BANDS = 8
+    BAND_BITS = 8
+
+    def __init__(self, client=None, prefix='phash', max_distance=PHASH_MAX_DISTANCE,
+                 ttl=ANALYSIS_CACHE_TTL_SECONDS):
+        if not 0 <= max_distance < self.BANDS:
+            # Beyond BANDS - 1 differing bits a match may share no band and be missed
+            raise ValueError(f"pHash max distance must be between 0 and {self.BANDS - 1}, "
+                             f"got {max_distance}")
+        self._client = client
+        self.prefix = prefix
+        self.max_distance = max_distance
+        self.ttl = ttl
+
+    @property
+    def client(self):
+        return self._client or redis_client
+
+    def _bands(self, fingerprint):
+        mask = (1 << self.BAND_BITS) - 1
+        return [(fingerprint >> (i * self.BAND_BITS)) & mask for i in range(self.BANDS)]
+
+    def _band_key(self, category, band_index, band_value):
+        return f"{self.prefix}:{category}:b{band_index}:{band_value:02x}"
+
+    def _target_key(self, category, fingerprint):
+        return f"{self.prefix}:{category}:fp:{fingerprint:016x}"
+
+    def add(self, category, fingerprint, image_hash, pipeline=None, ttl=None):
+        """
+        Register `fingerprint` as pointing at the exact-hash entry `image_hash`;
+        `ttl` (at most the index TTL) can shorten how long it is found
+        """
+        now = time.time()
+        pipe = pipeline or self.client.pipeline(transaction=False)
+        member = f"{fingerprint:016x}"
+        for i, band in enumerate(self._bands(fingerprint)):
+            band_key = self._band_key(category, i, band)
+            pipe.zadd(band_key, {member: now})
+            # Drop fingerprints whose cache entries have expired
+            pipe.zremrangebyscore(band_key, '-inf', now - self.ttl)
+            pipe.expire(band_key, self.ttl)
+        pipe.set(self._target_key(category, fingerprint), image_hash, ex=ttl or self.ttl)
+        if pipeline is None:
+            pipe.execute()
+
+    def find(self, category, fingerprint):
+        """
+        Return (image_hash, distance) of the closest indexed fingerprint
+        within max_distance, or None.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        min_score = time.time() - self.ttl
+        for i, band in enumerate(self._bands(fingerprint)):
+            pipe.zrangebyscore(self._band_key(category, i, band), min_score, '+inf')
+
+        candidates = set()
+        for members in pipe.execute():
+            candidates.update(members)
+
+        matches = sorted(
+            (distance, candidate)
+            for candidate, distance in (
+                (int(member, 16), hamming_distance(int(member, 16), fingerprint))
+                for member in candidates
+            )
+            if distance <= self.max_distance
+        )
+        for distance, candidate in matches:
+            image_hash = self.client.get(self._target_key(category, candidate))
+            if image_hash:
+                return image_hash, distance
+        return None
+
+
+perceptual_hash_index = PerceptualHashIndex()
+
+
+class NegativeCache:
+    """
+    Short-lived memory of images the model could not read.
+
+    Resubmitting the same photo returns the stored failure instead of a new
+    upload and vision call. Each unreadable submission (including these
+    hits) is a strike against the user, forgotten after a quiet strike
+    window; entries live `ttl * 2^(strikes - 1)` seconds, up to `max_ttl`,
+    and users with `phash_strikes` strikes are also turned away for
+    near-duplicates of indexed junk images.
+    """
+
+    def __init__(self, client=None, async_client=None, prefix='unreadable',
+                 ttl=NEGATIVE_CACHE_TTL_SECONDS, max_ttl=NEGATIVE_CACHE_MAX_TTL_SECONDS,
+                 strike_window=NEGATIVE_CACHE_STRIKE_WINDOW_SECONDS,
+                 phash_strikes=NEGATIVE_CACHE_PHASH_STRIKES,
+                 phash_max_distance=NEGATIVE_CACHE_PHASH_MAX_DISTANCE):
+        self._client = client
+        self._async_client = async_client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.strike_window = strike_window
+        self.phash_strikes = phash_strikes
+        self.index = PerceptualHashIndex(
+            client=client, prefix=f'{prefix}:phash', max_distance=phash_max_distance, ttl=max_ttl)
+
+    @property
+    def client(self):
+        return self._client or redis_client
+
+    @property
+    def async_client(self):
+        return self._async_client or get_async_redis_client()
+
+    def _key(self, image_hash):
+        return f"{self.prefix}:{image_hash}"
+
+    def _strikes_key(self, user_id):
+        return f"{self.prefix}:strikes:{user_id}"
+
+    def ttl_for(self, strikes):
+        """Entry TTL for a user with `strikes` unreadable submissions in the window"""
+        return min(self.ttl * 2 ** max(strikes - 1, 0), self.max_ttl)
+
+    def get(self, image_hash):
+        """Stored failure for this exact image, or None"""
+        cached = self.client.get(self._key(image_hash))
+        CACHE_REQUESTS.labels('unreadable', 'exact', 'hit' if cached else 'miss').inc()
+        return json.loads(cached) if cached else None
+
+    def find_similar(self, category, fingerprint, user_id):
+        """
+        Stored failure for a near-duplicate of an unreadable image, or None.
+        Only consulted for users with enough strikes, so an honest retake of
+        a blurry label is not turned away.
+        """
+        if fingerprint is None or user_id is None:
+            return None
+        if int(self.client.get(self._strikes_key(user_id)) or 0) < self.phash_strikes:
+            return None
+        match = self.index.find(category, fingerprint)
+        cached = self.client.get(self._key(match[0])) if match else None
+        CACHE_REQUESTS.labels('unreadable', 'phash', 'hit' if cached else 'miss').inc()
+        return (match[0], json.loads(cached)) if cached else None
+
+    def add(self, image_hash, category, fingerprint, result, user_id):
+        """Remember an unreadable image and strike the user; returns the entry TTL"""
+        ttl = self.ttl_for(self._strike(user_id))
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(self._key(image_hash), json.dumps(result), ex=ttl)
+        if fingerprint is not None:
+            self.index.add(category, fingerprint, image_hash, pipeline=pipe, ttl=ttl)
+        pipe.execute()
+        return ttl
+
+    def hit(self, image_hash, user_id):
+        """Strike a user resubmitting a known unreadable image and extend its entry"""
+        if user_id is None:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incr(self._strikes_key(user_id))
+        pipe.expire(self._strikes_key(user_id), self.strike_window)
+        pipe.ttl(self._key(image_hash))
+        strikes, _, remaining = pipe.execute()
+        ttl = self.ttl_for(strikes)
+        # Never shorten an entry another user's strikes made longer
+        if ttl > remaining:
+            self.client.expire(self._key(image_hash), ttl)
+
+    def _strike(self, user_id):
+        if user_id is None:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incr(self._strikes_key(user_id))
+        pipe.expire(self._strikes_key(user_id), self.strike_window)
+        return pipe.execute()[0]
+
+    # Async variants of the lookups on every miss and hit; the perceptual
+    # index and add() run in threads on the async path
+
+    async def aget(self, image_hash):
+        cached = await self.async_client.get(self._key(image_hash))
+        CACHE_REQUESTS.labels('unreadable', 'exact', 'hit' if cached else 'miss').inc()
+        return json.loads(cached) if cached else None
+
+    async def ahit(self, image_hash, user_id):
+        if user_id is None:
+            return
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            pipe.incr(self._strikes_key(user_id))
+            pipe.expire(self._strikes_key(user_id), self.strike_window)
+            pipe.ttl(self._key(image_hash))
+            strikes, _, remaining = await pipe.execute()
+        ttl = self.ttl_for(strikes)
+        if ttl > remaining:
+            await self.async_client.expire(self._key(image_hash), ttl)
+
+
+unreadable_images = NegativeCache()
+
+
+class BarcodeScanStats:
+    """
+    Per-day counts of how photos fared at the barcode fast path, shared by all
+    workers so the served fraction can be reported for the whole deployment.
+    """
+
+    OUTCOMES = ('served', 'unknown', 'none')
+
+    def __init__(self, client=None, async_client=None, prefix='barcode_scans',
+                 retention_days=BARCODE_STATS_RETENTION_DAYS):
+        self._client = client
+        self._async_client = async_client
+        self.prefix = prefix
+        self.retention_days = retention_days
+
+    @property
+    def client(self):
+        return self._client or redis_client
+
+    @property
+    def async_client(self):
+        return self._async_client or get_async_redis_client()
+
+    def _key(self, day):
+        return f"{self.prefix}:{day.isoformat()}"
+
+    @staticmethod
+    def _today():
+        return datetime.datetime.now(datetime.timezone.utc).date()
+
+    def record(self, outcome):
+        BARCODE_SCANS.labels(outcome).inc()
+        key = self._key(self._today())
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.hincrby(key, outcome, 1)
+            pipe.expire(key, self.retention_days * 86400)
+            pipe.execute()
+
+    async def arecord(self, outcome):
+        BARCODE_SCANS.labels(outcome).inc()
+        key = self._key(self._today())
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            pipe.hincrby(key, outcome, 1)
+            pipe.expire(key, self.retention_days * 86400)
+            await pipe.execute()
+
+    def totals(self, days):
+        """Scans per outcome over the last `days` days, today included"""
+        today = self._today()
+        with self.client.pipeline(transaction=False) as pipe:
+            for offset in range(days):
+                pipe.hgetall(self._key(today - datetime.timedelta(days=offset)))
+            counts = pipe.execute()
+        return {outcome: sum(int(day.get(outcome, 0)) for day in counts)
+                for outcome in self.OUTCOMES}
+
+
+barcode_scans = BarcodeScanStats()
+
+
+def get_cached_json(key):
+    """Return the value cached under `key`, or None on a miss"""
+    cached = binary_redis_client.get(key)
+    if cached is None:
+        return None
+    return decode_value(cached)
+
+
+def set_cached_json(key, value, ttl=ANALYSIS_CACHE_TTL_SECONDS):
+    """Cache a JSON-serializable `value` under `key` with the given TTL in seconds"""
+    binary_redis_client.set(key, encode_value(value), ex=ttl)
+
+
+def mark_asset_deleted(public_id, ttl=ANALYSIS_CACHE_TTL_SECONDS):
+    """
+    Remember that a Cloudinary asset was destroyed so cached analyses
+    still pointing at it re-upload instead of serving a dead image URL.
+    """
+    redis_client.set(f"deleted_asset:{public_id}", 1, ex=ttl)
+
+
+def mark_assets_deleted(public_ids, ttl=ANALYSIS_CACHE_TTL_SECONDS):
+    """mark_asset_deleted for many assets in one round trip"""
+    pipe = redis_client.pipeline(transaction=False)
+    for public_id in public_ids:
+        pipe.set(f"deleted_asset:{public_id}", 1, ex=ttl)
+    pipe.execute()
+
+
+def is_asset_deleted(public_id):
+    return bool(redis_client.exists(f"deleted_asset:{public_id}"))
+
+
+async def aget_cached_json(key):
+    """Async variant of get_cached_json"""
+    cached = await get_async_redis_client().get(key)
+    if cached is None:
+        return None
+    return decode_value(cached)
+
+
+async def aset_cached_json(key, value, ttl=ANALYSIS_CACHE_TTL_SECONDS):
+    """Async variant of set_cached_json"""
+    await get_async_redis_client().set(key, encode_value(value), ex=ttl)
+
+
+async def ais_asset_deleted(public_id):
+    return bool(await get_async_redis_client().exists(f"deleted_asset:{public_id}"))
+
+
+class SingleFlight:
+    """
+    Cross-worker single-flight for cache misses.
+
+    The first worker to miss a key takes a Redis lock with a lease and
+    computes the value; concurrent workers missing the same key poll the
+    cache with exponential backoff and return the leader's result. If the
+    leader crashes its lease expires and a follower takes over; if it
+    finishes without caching anything (a failed analysis) the lock is
+    released and the next follower computes for itself.
+    """
+
+    def __init__(self, client=None, async_client=None,
+                 lease_seconds=SINGLE_FLIGHT_LEASE_SECONDS,
+                 wait_seconds=SINGLE_FLIGHT_WAIT_SECONDS):
+        self._client = client
+        self._async_client = async_client
+        self.lease_seconds = lease_seconds
+        self.wait_seconds = wait_seconds
+
+    @property
+    def client(self):
+        return self._client or redis_client
+
+    @property
+    def async_client(self):
+        return self._async_client or get_async_redis_client()
+
+    def acquire(self, cache_key):
+        """Try to become the leader for `cache_key`; returns a token or None"""
+        token = uuid.uuid4().hex
+        if self.client.set(f"lock:{cache_key}", token, nx=True, ex=self.lease_seconds):
+            return token
+        return None
+
+    def release(self, cache_key, token):
+        """Drop the lock only if this worker still holds it (compare-and-delete)"""
+        lock_key = f"lock:{cache_key}"
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(lock_key)
+                if pipe.get(lock_key) == token:
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    pipe.execute()
+            except redis.WatchError:
+                # Lease expired and another worker took over mid-release
+                pass
+
+    def wait(self, cache_key):
+        """
+        Follow the current leader: poll until the value is cached (returned)
+        or the lock disappears / the wait budget runs out (None).
+        """
+        deadline = time.monotonic() + self.wait_seconds
+        delay = 0.05
+        while time.monotonic() < deadline:
+            cached = get_cached_json(cache_key)
+            if cached is not None:
+                return cached
+            if not self.client.exists(f"lock:{cache_key}"):
+                # Leader gone without a result; one last look, then take over
+                return get_cached_json(cache_key)
+            time.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, 0.5)
+        return None
+
+    def run(self, cache_key, compute):
+        """
+        Return the cached value for `cache_key`, computing it at most once
+        across workers. `compute` must cache its result under `cache_key`
+        when it succeeds, and return it.
+        """
+        while True:
+            token = self.acquire(cache_key)
+            if token is not None:
+                try:
+                    # A previous leader may have finished since our miss
+                    cached = get_cached_json(cache_key)
+                    if cached is not None:
+                        return cached
+                    return compute()
+                finally:
+                    self.release(cache_key, token)
+
+            cached = self.wait(cache_key)
+            if cached is not None:
+                return cached
+            if self.client.exists(f"lock:{cache_key}"):
+                # Waited the full budget on a live leader; stop queueing behind it
+                return compute()
+
+    # Async variants for the ASGI path; same lock keys, so sync and async
+    # workers coalesce with each other
+
+    async def aacquire(self, cache_key):
+        token = uuid.uuid4().hex
+        if await self.async_client.set(f"lock:{cache_key}", token, nx=True, ex=self.lease_seconds):
+            return token
+        return None
+
+    async def arelease(self, cache_key, token):
+        lock_key = f"lock:{cache_key}"
+        async with self.async_client.pipeline() as pipe:
+            try:
+                await pipe.watch(lock_key)
+                if await pipe.get(lock_key) == token.encode():
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    await pipe.execute()
+            except redis.WatchError:
+                pass
+
+    async def await_result(self, cache_key):
+        """Async variant of wait(); sleeps without blocking the event loop"""
+        deadline = time.monotonic() + self.wait_seconds
+        delay = 0.05
+        while time.monotonic() < deadline:
+            cached = await aget_cached_json(cache_key)
+            if cached is not None:
+                return cached
+            if not await self.async_client.exists(f"lock:{cache_key}"):
+                return await aget_cached_json(cache_key)
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, 0.5)
+        return None
+
+    async def arun(self, cache_key, compute):
+        """Async variant of run(); `compute` is a coroutine function"""
+        while True:
+            token = await self.aacquire(cache_key)
+            if token is not None:
+                try:
+                    cached = await aget_cached_json(cache_key)
+                    if cached is not None:
+                        return cached
+                    return await compute()
+                finally:
+                    await self.arelease(cache_key, token)
+
+            cached = await self.await_result(cache_key)
+            if cached is not None:
+                return cached
+            if await self.async_client.exists(f"lock:{cache_key}"):
+                return await compute()
+
+
+single_flight = SingleFlight()
+
+
+class TwoTierCache:
+    """
+    Bounded in-process LRU (one per worker) in front of Redis.
+
+    Reads check the local tier first and fall back to Redis, keeping what
+    they find; writes go to both and publish the key on a pub/sub channel
+    so other workers drop their local copy. A listener thread applies those
+    invalidations; local entries also expire after `local_ttl` seconds,
+    which bounds staleness if a message is missed. The local tier holds the
+    encoded bytes, so each hit returns a fresh object and the byte budget
+    is exact. Hit/miss counters are kept per tier.
+    """
+
+    def __init__(self, namespace, ttl=ANALYSIS_CACHE_TTL_SECONDS,
+                 max_entries=LOCAL_CACHE_MAX_ENTRIES, max_bytes=LOCAL_CACHE_MAX_BYTES,
+                 local_ttl=LOCAL_CACHE_TTL_SECONDS, client=None, binary_client=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.local_ttl = local_ttl
+        self.channel = f"{CACHE_INVALIDATION_CHANNEL}:{namespace}"
+        self._client = client
+        self._binary_client = binary_client
+        self._origin = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._local = OrderedDict()  # key -> (expires_at, encoded bytes)
+        self._local_bytes = 0
+        self._listening_client = None
+        self._counters = dict.fromkeys(
+            ('local_hits', 'local_misses', 'redis_hits', 'redis_misses',
+             'evictions', 'invalidations'), 0)
+        # Bound Prometheus children, so counting a lookup is one increment
+        self._metrics = {
+            'local_hits': CACHE_REQUESTS.labels(namespace, 'local', 'hit'),
+            'local_misses': CACHE_REQUESTS.labels(namespace, 'local', 'miss'),
+            'redis_hits': CACHE_REQUESTS.labels(namespace, 'redis', 'hit'),
+            'redis_misses': CACHE_REQUESTS.labels(namespace, 'redis', 'miss'),
+        }
+
+    @property
+    def client(self):
+        return self._client or redis_client
+
+    @property
+    def binary_client(self):
+        return self._binary_client or binary_redis_client
+
+    def get(self, key):
+        """Return the cached value for `key` from the nearest tier, or None"""
+        data = self._get_local(key)
+        if data is None:
+            data = self.binary_client.get(key)
+            self._count('redis_hits' if data is not None else 'redis_misses')
+            if data is None:
+                return None
+            self._put_local(key, data)
+        return decode_value(data)
+
+    def set(self, key, value, ttl=None):
+        data = encode_value(value)
+        self.binary_client.set(key, data, ex=ttl or self.ttl)
+        self._put_local(key, data)
+        self._publish(key)
+
+    def get_or_set(self, key, compute, ttl=None):
+        """
+        Return the cached value, or compute and cache it. A fill stores the
+        current source value rather than changing it, so nothing is published.
+        A fill that raced an invalidate() is returned but not stored: it may
+        have read the source before the change the invalidation announces.
+        """
+        value = self.get(key)
+        if value is None:
+            generation_key = self._generation_key(key)
+            generation = self.binary_client.get(generation_key)
+            value = compute()
+            data = encode_value(value)
+            with self.binary_client.pipeline() as pipe:
+                try:
+                    pipe.watch(generation_key)
+                    if pipe.get(generation_key) != generation:
+                        return value
+                    pipe.multi()
+                    pipe.set(key, data, ex=ttl or self.ttl)
+                    pipe.execute()
+                except redis.WatchError:
+                    return value
+            self._put_local(key, data)
+        return value
+
+    def invalidate(self, key):
+        """Drop `key` from Redis and from every worker's local tier"""
+        pipe = self.binary_client.pipeline()
+        # Bumped first, so a fill already computing from the old source skips its write
+        pipe.incr(self._generation_key(key))
+        pipe.expire(self._generation_key(key), self.ttl)
+        pipe.delete(key)
+        pipe.execute()
+        self._drop_local(key)
+        self._publish(key)
+
+    @staticmethod
+    def _generation_key(key):
+        return f"{key}:generation"
+
+    async def aget(self, key):
+        """Async variant of get; only the Redis tier is awaited"""
+        data = self._get_local(key)
+        if data is None:
+            data = await get_async_redis_client().get(key)
+            self._count('redis_hits' if data is not None else 'redis_misses')
+            if data is None:
+                return None
+            self._put_local(key, data)
+        return decode_value(data)
+
+    async def aset(self, key, value, ttl=None):
+        data = encode_value(value)
+        client = get_async_redis_client()
+        await client.set(key, data, ex=ttl or self.ttl)
+        self._put_local(key, data)
+        if self.max_entries:
+            await client.publish(self.channel, self._message(key))
+
+    def stats(self):
+        """Counters per tier plus the local tier's current size"""
+        with self._lock:
+            return {**self._counters, 'local_entries': len(self._local),
+                    'local_bytes': self._local_bytes}
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+            self._local_bytes = 0
+
+    def _get_local(self, key):
+        if not self.max_entries:
+            return None
+        self._ensure_listener()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._local.move_to_end(key)
+                self._counters['local_hits'] += 1
+                self._metrics['local_hits'].inc()
+                return entry[1]
+            if entry is not None:
+                self._pop_local(key)
+            self._counters['local_misses'] += 1
+            self._metrics['local_misses'].inc()
+        return None
+
+    def _put_local(self, key, data):
+        if not self.max_entries or len(data) > self.max_bytes:
+            return
+        self._ensure_listener()
+        with self._lock:
+            self._pop_local(key)
+            self._local[key] = (time.monotonic() + self.local_ttl, data)
+            self._local_bytes += len(data)
+            while len(self._local) > self.max_entries or self._local_bytes > self.max_bytes:
+                oldest = next(iter(self._local))
+                self._pop_local(oldest)
+                self._counters['evictions'] += 1
+
+    def _drop_local(self, key):
+        with self._lock:
+            self._pop_local(key)
+
+    def _pop_local(self, key):
+        # Caller holds the lock
+        entry = self._local.pop(key, None)
+        if entry is not None:
+            self._local_bytes -= len(entry[1])
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+        if counter in self._metrics:
+            self._metrics[counter].inc()
+
+    def _message(self, key):
+        return json.dumps({'origin': self._origin, 'key': key})
+
+    def _publish(self, key):
+        if self.max_entries:
+            self.client.publish(self.channel, self._message(key))
+
+    def _ensure_listener(self):
+        """Subscribe to invalidations on the current client (restarted if the client changes)"""
+        client = self.client
+        if client is self._listening_client:
+            return
+        with self._lock:
+            if client is self._listening_client:
+                return
+            # Nothing in the local tier came from this client; start empty
+            self._local.clear()
+            self._local_bytes = 0
+            self._listening_client = client
+        threading.Thread(
+            target=self._listen, args=(client,),
+            name=f"cache-invalidation-{self.namespace}", daemon=True
+        ).start()
+
+    def _listen(self, client):
+        delay = 0.5
+        while client is self._listening_client:
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                delay = 0.5
+                while client is self._listening_client:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    payload = json.loads(message['data'])
+                    if payload['origin'] != self._origin:
+                        self._drop_local(payload['key'])
+                        self._count('invalidations')
+                pubsub.close()
+            except Exception as e:
+                # Invalidations may have been missed while disconnected
+                logger.warning(f"Cache invalidation listener error: {str(e)}")
+                self.clear_local()
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+
+# Extractions and scored analyses (popular products), and user medical profiles
+analysis_cache = TwoTierCache('analysis')
+profile_cache = TwoTierCache('profile', ttl=PROFILE_CACHE_TTL_SECONDS)
+
+
+def profile_cache_key(user_id):
+    return f"medical_profile:{user_id}"
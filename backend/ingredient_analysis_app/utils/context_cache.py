@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import sys
+import threading
+import time
+from pathlib import Path
+from google.genai import types
+
+from . import cache_utils
+from .gemini import GeminiModel, shared_client
+from .metrics import GEMINI_INPUT_TOKENS
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import (
+    GEMINI_API_KEY, GEMINI_CONTEXT_CACHE_ENABLED, GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+    GEMINI_CONTEXT_CACHE_REFRESH_SECONDS, GEMINI_CONTEXT_CACHE_RETRY_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+
+def is_missing_cache_error(error):
+    """True when Gemini no longer knows the cached content a request referenced"""
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    return code in (403, 404) or type(error).__name__ in ('NotFound', 'PermissionDenied')
+
+
+def record_token_usage(call, response):
+    """Count a response's input tokens and log how many the context cache served"""
+    usage = getattr(response, 'usage_metadata', None)
+    prompt_tokens = getattr(usage, 'prompt_token_count', None)
+    cached_tokens = getattr(usage, 'cached_content_token_count', None)
+    if not isinstance(prompt_tokens, int):
+        return
+    cached_tokens = cached_tokens if isinstance(cached_tokens, int) else 0
+    GEMINI_INPUT_TOKENS.labels(call, 'cached').inc(cached_tokens)
+    GEMINI_INPUT_TOKENS.labels(call, 'uncached').inc(prompt_tokens - cached_tokens)
+    if cached_tokens:
+        logger.info(f"Gemini {call}: {cached_tokens} of {prompt_tokens} input tokens "
+                    f"served from the context cache")
+
+
+class GeminiCachingClient:
+    """The SDK's cached-content calls; tests swap in a stub with the same methods"""
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or shared_client()
+
+    def create(self, model_name, system_instruction, ttl, display_name):
+        """Register the instruction; returns the cached content's name"""
+        return self.client.caches.create(model=model_name, config=types.CreateCachedContentConfig(
+            system_instruction=system_instruction, ttl=f"{ttl}s",
+            display_name=display_name)).name
+
+    def refresh(self, name, ttl):
+        self.client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{ttl}s"))
+
+    def delete(self, name):
+        self.client.caches.delete(name=name)
+
+    def model(self, model_name, name):
+        """Model answering with the cached instruction as its system instruction"""
+        return GeminiModel(self.client, model_name, cached_content=name)
+
+
+class ContextCache:
+    """
+    A static system instruction registered once with Gemini's cached-content
+    API, so requests only send their variable part.
+
+    The cache name and expiry are shared by all workers through Redis. The
+    first worker to need it creates it; whoever finds it within
+    `refresh_margin` seconds of expiry extends its TTL. When Gemini reports
+    it gone it is dropped and re-created on the next call. Any failure makes
+    model() return None for `retry_seconds`, and callers use the inline
+    prompt meanwhile.
+    """
+
+    def __init__(self, label, model_name, instruction, client=None, redis=None,
+                 enabled=GEMINI_CONTEXT_CACHE_ENABLED and bool(GEMINI_API_KEY),
+                 ttl=GEMINI_CONTEXT_CACHE_TTL_SECONDS,
+                 refresh_margin=GEMINI_CONTEXT_CACHE_REFRESH_SECONDS,
+                 retry_seconds=GEMINI_CONTEXT_CACHE_RETRY_SECONDS):
+        self.label = label
+        self.model_name = model_name
+        self.instruction = instruction
+        self._client = client
+        self._redis = redis
+        self.enabled = enabled
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_seconds = retry_seconds
+        # A changed prompt or model gets a cache of its own
+        digest = hashlib.sha256(f"{model_name}\n{instruction}".encode()).hexdigest()[:16]
+        self.key = f"gemini_context_cache:{label}:{digest}"
+        self._name = None
+        self._expires_at = 0.0
+        self._model = None
+        self._disabled_until = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        return self._client or default_caching_client
+
+    @property
+    def redis(self):
+        return self._redis or cache_utils.redis_client
+
+    @property
+    def name(self):
+        return self._name
+
+    def model(self):
+        """Model bound to the cached instruction, or None to use the inline prompt"""
+        if not self.enabled or time.time() < self._disabled_until:
+            return None
+        try:
+            with self._lock:
+                self._ensure()
+                return self._model
+        except Exception as e:
+            logger.warning(f"Gemini context cache '{self.label}' unavailable, "
+                           f"using the inline prompt: {str(e)}")
+            self._disabled_until = time.time() + self.retry_seconds
+            self._forget()
+            return None
+
+    def invalidate(self, model):
+        """Drop the cache behind `model` once Gemini no longer has it; the next call re-creates it"""
+        with self._lock:
+            if model is not self._model:
+                # Already replaced by another thread
+                return
+            stored = self._stored()
+            if stored and stored[0] == self._name:
+                self.redis.delete(self.key)
+            self._forget()
+
+    def _ensure(self):
+        now = time.time()
+        if self._name is None or self._expires_at - now < self.refresh_margin:
+            # Another worker may have created or extended it meanwhile
+            stored = self._stored()
+            if stored:
+                self._adopt(*stored)
+        if self._name is None:
+            self._create(now)
+        elif self._expires_at - now < self.refresh_margin:
+            self.client.refresh(self._name, self.ttl)
+            self._publish(self._name, now + self.ttl)
+
+    def _create(self, now):
+        name = self.client.create(self.model_name, self.instruction, self.ttl, self.key)
+        expires_at = now + self.ttl
+        if not self.redis.set(self.key, f"{name}|{expires_at}", nx=True, exat=int(expires_at)):
+            # Lost a creation race; use the winner's cache and drop ours
+            self.client.delete(name)
+            stored = self._stored()
+            if stored is None:
+                raise RuntimeError('cached content registration disappeared')
+            self._adopt(*stored)
+            return
+        logger.info(f"Created Gemini context cache '{self.label}' ({name})")
+        self._adopt(name, expires_at)
+
+    def _publish(self, name, expires_at):
+        self.redis.set(self.key, f"{name}|{expires_at}", exat=int(expires_at))
+        self._adopt(name, expires_at)
+
+    def _stored(self):
+        stored = self.redis.get(self.key)
+        if not stored:
+            return None
+        name, expires_at = stored.rsplit('|', 1)
+        return name, float(expires_at)
+
+    def _adopt(self, name, expires_at):
+        if name != self._name:
+            self._model = self.client.model(self.model_name, name)
+        self._name = name
+        self._expires_at = expires_at
+
+    def _forget(self):
+        self._name = None
+        self._model = None
+        self._expires_at = 0.0
+
+
+default_caching_client = GeminiCachingClient()
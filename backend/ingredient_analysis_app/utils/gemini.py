@@ -0,0 +1,50 @@
+import sys
+from pathlib import Path
+import google.genai as genai
+from google.genai import types
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import GEMINI_API_KEY
+
+_client = None
+
+
+def shared_client():
+    """The process's google-genai client, created on first use"""
+    global _client
+    if _client is None:
+        _client = genai.Client(api_key=GEMINI_API_KEY)
+    return _client
+
+
+class GeminiModel:
+    """
+    A Gemini model on a google-genai client. With `cached_content` the
+    requests answer from that cached instruction instead of an inline prompt.
+    """
+
+    def __init__(self, client, model_name, cached_content=None):
+        self.client = client
+        self.model_name = model_name
+        self.cached_content = cached_content
+
+    def _config(self, config):
+        config = config or types.GenerateContentConfig()
+        if self.cached_content is not None:
+            config = config.model_copy(update={'cached_content': self.cached_content})
+        return config
+
+    def generate_content(self, contents, config=None):
+        return self.client.models.generate_content(
+            model=self.model_name, contents=contents, config=self._config(config))
+
+    def generate_content_stream(self, contents, config=None):
+        """Response chunks as Gemini produces them"""
+        return self.client.models.generate_content_stream(
+            model=self.model_name, contents=contents, config=self._config(config))
+
+    async def generate_content_async(self, contents, config=None):
+        return await self.client.aio.models.generate_content(
+            model=self.model_name, contents=contents, config=self._config(config))
@@ -0,0 +1,191 @@
+import io
+import logging
+import math
+import sys
+import threading
+from pathlib import Path
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import (
+    IMAGE_MAX_DIMENSION, IMAGE_MAX_BYTES, IMAGE_JPEG_QUALITY, IMAGE_GRAYSCALE
+)
+
+logger = logging.getLogger(__name__)
+
+# Never re-encode below this quality; shrink the image further instead
+MIN_JPEG_QUALITY = 50
+EXIF_ORIENTATION_TAG = 0x0112
+
+# A barcode the detector locates but cannot read is tried again at these
+# reduced scales; a pass that locates nothing ends the search
+BARCODE_SEARCH_SCALES = (1.0, 0.5, 0.25)
+# libjpeg DCT scaling: decode straight to 1/2, 1/4 or 1/8 size
+REDUCED_GRAYSCALE_FLAGS = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                           (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                           (2, cv2.IMREAD_REDUCED_GRAYSCALE_2))
+# Retail product codes; other symbologies do not identify a product
+PRODUCT_BARCODE_TYPES = {'EAN_13', 'EAN_8', 'UPC_A', 'UPC_E'}
+
+# cv2 detectors are not safe to share between threads
+_detectors = threading.local()
+
+
+class PreparedImage:
+    """Re-encoded label photo plus the numbers needed to report the savings"""
+
+    def __init__(self, data, mime_type, size, original_bytes, original_size):
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+        self.original_bytes = original_bytes
+        self.original_size = original_size
+
+    @property
+    def file(self):
+        """Fresh file-like object for uploaders that expect one"""
+        return io.BytesIO(self.data)
+
+    @property
+    def bytes_saved(self):
+        return self.original_bytes - len(self.data)
+
+
+def prepare_image(image_file, max_dimension=IMAGE_MAX_DIMENSION, max_bytes=IMAGE_MAX_BYTES,
+                  quality=IMAGE_JPEG_QUALITY, grayscale=IMAGE_GRAYSCALE):
+    """
+    Downscale and re-encode a label photo to a text-legible JPEG within
+    `max_bytes`, so it is shipped once at a sensible size to both Gemini and
+    Cloudinary. JPEGs are decoded in draft mode (DCT scaling), EXIF
+    orientation is applied, and images already within budget pass through.
+    """
+    image_file.seek(0)
+    original = image_file.read()
+    image_file.seek(0)
+
+    with Image.open(io.BytesIO(original)) as img:
+        original_size = img.size
+        orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+        mime_type = Image.MIME.get(img.format, 'application/octet-stream')
+
+        if (len(original) <= max_bytes and max(img.size) <= max_dimension
+                and orientation == 1 and not grayscale
+                and mime_type in ('image/jpeg', 'image/png', 'image/webp')):
+            return PreparedImage(original, mime_type, img.size, len(original), original_size)
+
+        target_mode = 'L' if grayscale else 'RGB'
+        # Decode at the smallest 1/2, 1/4 or 1/8 scale still >= the target size;
+        # the request must keep the aspect ratio or draft() refuses to scale
+        scale = min(1.0, max_dimension / max(img.size))
+        img.draft(target_mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        img = ImageOps.exif_transpose(img)
+        img = img.convert(target_mode)
+
+    img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    data = _encode_within_budget(img, max_bytes, quality)
+
+    logger.info(
+        f"Prepared image {original_size[0]}x{original_size[1]} ({len(original)} B) -> "
+        f"{img.size[0]}x{img.size[1]} ({len(data)} B)")
+    return PreparedImage(data, 'image/jpeg', img.size, len(original), original_size)
+
+
+def _encode_within_budget(img, max_bytes, quality):
+    """Lower JPEG quality, then resolution, until the encoding fits `max_bytes`"""
+    while True:
+        for attempt_quality in range(quality, MIN_JPEG_QUALITY - 1, -10):
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=attempt_quality, optimize=True)
+            if buffer.tell() <= max_bytes:
+                return buffer.getvalue()
+        if max(img.size) <= 640:
+            # Legibility floor: accept going over budget rather than losing the text
+            return buffer.getvalue()
+        img = img.resize(
+            (int(img.width * 0.8), int(img.height * 0.8)), Image.Resampling.LANCZOS)
+
+
+def normalize_barcode(code):
+    """
+    GTIN for a scanned or catalog barcode, or None when it is not a valid
+    EAN/UPC. UPC-A and GTIN-14 with a leading zero are stored as EAN-13, so
+    the same product matches however its code was read.
+    """
+    code = str(code).strip()
+    if not code.isdigit() or len(code) not in (8, 12, 13, 14):
+        return None
+    if len(code) == 12:
+        code = '0' + code
+    elif len(code) == 14 and code.startswith('0'):
+        code = code[1:]
+    # GS1 check digit: weights 3 and 1 alternate leftwards from the digit before it
+    total = sum(int(digit) * (3 if index % 2 == 0 else 1)
+                for index, digit in enumerate(reversed(code[:-1])))
+    return code if (10 - total % 10) % 10 == int(code[-1]) else None
+
+
+def detect_barcode(image_file, max_dimension=IMAGE_MAX_DIMENSION):
+    """
+    Product barcode (EAN/UPC) shown in a label photo, normalized with
+    normalize_barcode, or None. Leaves the file rewound.
+    """
+    image_file.seek(0)
+    data = image_file.read()
+    image_file.seek(0)
+
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            longest = max(img.size)
+    except OSError:
+        # Not for PIL; OpenCV decodes it in full if it can
+        longest = 0
+    # Skip the full-resolution decode: the smallest reduction still at least
+    # max_dimension long
+    flag = next((flag for factor, flag in REDUCED_GRAYSCALE_FLAGS
+                 if longest // factor >= max_dimension), cv2.IMREAD_GRAYSCALE)
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if image is None:
+        return None
+    if max(image.shape) > max_dimension:
+        factor = max_dimension / max(image.shape)
+        image = cv2.resize(image, None, fx=factor, fy=factor, interpolation=cv2.INTER_AREA)
+
+    detector = getattr(_detectors, 'barcode', None)
+    if detector is None:
+        detector = _detectors.barcode = cv2.barcode.BarcodeDetector()
+    for scale in BARCODE_SEARCH_SCALES:
+        scaled = image if scale == 1.0 else cv2.resize(
+            image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        found, codes, types, points = detector.detectAndDecodeWithType(scaled)
+        if points is None:
+            # Nothing barcode-like here; most label photos stop after one pass
+            return None
+        if not found:
+            continue
+        for code, code_type in zip(codes, types):
+            if code_type == 'UPC_E':
+                code = _expand_upc_e(code)
+            barcode = normalize_barcode(code) if code_type in PRODUCT_BARCODE_TYPES else None
+            if barcode:
+                return barcode
+    return None
+
+
+def _expand_upc_e(code):
+    """UPC-A form of a zero-suppressed UPC-E code (number system, 6 digits, check digit)"""
+    if len(code) != 8 or not code.isdigit():
+        return code
+    digits, last = code[1:7], code[6]
+    if last in '012':
+        body = digits[:2] + last + '0000' + digits[2:5]
+    elif last == '3':
+        body = digits[:3] + '00000' + digits[3:5]
+    elif last == '4':
+        body = digits[:4] + '00000' + digits[4]
+    else:
+        body = digits[:5] + '0000' + last
+    return code[0] + body + code[7]
@@ -0,0 +1,131 @@
+import json
+from collections import namedtuple
+
+# kind is 'field' (a top-level value completed) or 'item' (an element of one
+# of the streamed top-level arrays completed; index is its position)
+JSONStreamEvent = namedtuple('JSONStreamEvent', ['kind', 'key', 'value', 'index'])
+
+WHITESPACE = ' \t\r\n'
+
+
+class IncrementalJSONParser:
+    """
+    Incremental parser for one streamed JSON object.
+
+    Feed it text chunks as they arrive; it yields an event as soon as each
+    top-level field's value is complete, and for the keys in `item_keys`
+    (arrays) also as soon as each element is complete, without waiting for
+    the rest of the document. Text before the opening brace (e.g. a
+    markdown code fence) is ignored. Each character is scanned once; only
+    completed values are handed to json.loads.
+    """
+
+    def __init__(self, item_keys=()):
+        self.item_keys = set(item_keys)
+        self.text = ''
+        self.pos = 0
+        self.depth = 0
+        self.started = False
+        self.finished = False
+        self.in_string = False
+        self.escaped = False
+        self.string_start = None
+        # Top-level key/value tracking (depth 1)
+        self.expect_key = False
+        self.key = None
+        self.value_start = None
+        # Element tracking inside a streamed array (depth 2)
+        self.item_start = None
+        self.item_index = 0
+
+    def feed(self, chunk):
+        """Consume a chunk of text and return the events it completed"""
+        events = []
+        self.text += chunk
+        text = self.text
+        while self.pos < len(text) and not self.finished:
+            char = text[self.pos]
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.expect_key:
+                        self.key = json.loads(text[self.string_start:self.pos + 1])
+                        self.expect_key = False
+                self.pos += 1
+                continue
+
+            if not self.started:
+                if char == '{':
+                    self.started = True
+                    self.depth = 1
+                    self.expect_key = True
+                self.pos += 1
+                continue
+
+            if char == '"':
+                self.in_string = True
+                self.string_start = self.pos
+                self._mark_value_start()
+            elif char in '{[':
+                self._mark_value_start()
+                self.depth += 1
+            elif char in '}]':
+                self._end_scalar_item(events)
+                self.depth -= 1
+                if self.depth == 2 and self._streaming_items():
+                    self._emit_item(events, self.pos + 1)
+                elif self.depth == 1:
+                    self._emit_field(events, self.pos + 1)
+                elif self.depth == 0:
+                    self._emit_field(events, self.pos)
+                    self.finished = True
+            elif char == ',':
+                if self.depth == 1:
+                    self._emit_field(events, self.pos)
+                    self.expect_key = True
+                elif self.depth == 2 and self._streaming_items():
+                    self._emit_item(events, self.pos)
+            elif char == ':':
+                pass
+            elif char not in WHITESPACE:
+                self._mark_value_start()
+            self.pos += 1
+        return events
+
+    def _streaming_items(self):
+        return self.key in self.item_keys and self.text[self.value_start] == '['
+
+    def _mark_value_start(self):
+        """Record where the current top-level value or array element begins"""
+        if self.depth == 1 and not self.expect_key and self.value_start is None:
+            self.value_start = self.pos
+            self.item_start = None
+            self.item_index = 0
+        elif self.depth == 2 and self.item_start is None and self._streaming_items():
+            self.item_start = self.pos
+
+    def _end_scalar_item(self, events):
+        # Scalar elements end at ',' or, for the last one, at the closing bracket
+        if self.depth == 2 and self._streaming_items():
+            self._emit_item(events, self.pos)
+
+    def _emit_item(self, events, end):
+        if self.item_start is None:
+            return
+        value = json.loads(self.text[self.item_start:end])
+        events.append(JSONStreamEvent('item', self.key, value, self.item_index))
+        self.item_index += 1
+        self.item_start = None
+
+    def _emit_field(self, events, end):
+        if self.key is None or self.value_start is None:
+            return
+        value = json.loads(self.text[self.value_start:end])
+        events.append(JSONStreamEvent('field', self.key, value, None))
+        self.key = None
+        self.value_start = None
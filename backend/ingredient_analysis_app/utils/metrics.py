@@ -0,0 +1,120 @@
+import os
+import time
+from contextlib import contextmanager
+
+# Under gunicorn set PROMETHEUS_MULTIPROC_DIR: every worker then writes its
+# samples to memory-mapped files in that directory and /metrics aggregates
+# them, so a scrape sees all workers rather than whichever one answered.
+MULTIPROCESS = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+if MULTIPROCESS:
+    # Only gunicorn's on_starting creates it; the queue worker, management
+    # commands and uvicorn would otherwise fail opening their metric files
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+)
+from prometheus_client import multiprocess
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 20, 40)
+BYTES_BUCKETS = (16e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6, 16e6)
+
+CACHE_REQUESTS = Counter(
+    'ingredientai_cache_requests_total', 'Cache lookups by cache, tier and result',
+    ['cache', 'tier', 'result'])
+GEMINI_SECONDS = Histogram(
+    'ingredientai_gemini_request_seconds', 'Gemini call latency', ['call'],
+    buckets=LATENCY_BUCKETS)
+GEMINI_FAILURES = Counter(
+    'ingredientai_gemini_failures_total', 'Failed Gemini calls by error type',
+    ['call', 'error_type'])
+GEMINI_ADMISSION_WAIT_SECONDS = Histogram(
+    'ingredientai_gemini_admission_wait_seconds',
+    'Time Gemini calls waited in the admission queue before starting', buckets=LATENCY_BUCKETS)
+GEMINI_ADMISSION_REJECTIONS = Counter(
+    'ingredientai_gemini_admission_rejections_total',
+    'Gemini calls answered as busy (queue_full, user_queue_full, timeout, upstream_quota, '
+    'upstream_unavailable, circuit_open)',
+    ['reason'])
+GEMINI_RETRIES = Counter(
+    'ingredientai_gemini_retries_total', 'Gemini attempts retried, by call and error class',
+    ['call', 'error_class'])
+GEMINI_HEDGES = Counter(
+    'ingredientai_gemini_hedged_requests_total',
+    'Hedged second Gemini requests, by call and which request answered first',
+    ['call', 'winner'])
+GEMINI_CIRCUIT_STATE = Gauge(
+    'ingredientai_gemini_circuit_state',
+    'Gemini circuit breaker as last seen by the worker (0 closed, 1 half-open, 2 open)',
+    multiprocess_mode='livemax')
+GEMINI_INPUT_TOKENS = Counter(
+    'ingredientai_gemini_input_tokens_total',
+    'Gemini input tokens by call, split into those served from the context cache and the rest',
+    ['call', 'source'])
+BARCODE_SCANS = Counter(
+    'ingredientai_barcode_scans_total',
+    'Photos checked for a product barcode (served by the fast path, unknown barcode, none found)',
+    ['outcome'])
+AI_RESPONSE_PARSES = Counter(
+    'ingredientai_ai_response_parse_total',
+    'Model responses by how they were parsed (direct, brace_extract fallback, failed, '
+    'invalid: JSON that failed validation)',
+    ['outcome'])
+AI_RESPONSE_REPAIRS = Counter(
+    'ingredientai_ai_response_repairs_total',
+    'Model response fields the validating decoder coerced or replaced with a default, by field',
+    ['field'])
+CLOUDINARY_SECONDS = Histogram(
+    'ingredientai_cloudinary_request_seconds', 'Cloudinary API latency', ['operation'],
+    buckets=LATENCY_BUCKETS)
+ASSET_DELETIONS = Counter(
+    'ingredientai_asset_deletions_total',
+    'Outbox assets processed by the drainer (deleted, kept because still referenced, retry, '
+    'abandoned after the last attempt)',
+    ['outcome'])
+IMAGE_BYTES = Histogram(
+    'ingredientai_image_bytes', 'Image size as received and as uploaded', ['stage'],
+    buckets=BYTES_BUCKETS)
+REQUEST_SECONDS = Histogram(
+    'ingredientai_http_request_seconds', 'Request latency by endpoint',
+    ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS)
+DB_QUERY_SECONDS = Histogram(
+    'ingredientai_db_query_seconds', 'Database query latency', ['alias'],
+    buckets=LATENCY_BUCKETS)
+
+
+@contextmanager
+def gemini_call(call):
+    """Time a Gemini request and count it as failed if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        GEMINI_FAILURES.labels(call, type(e).__name__).inc()
+        raise
+    finally:
+        GEMINI_SECONDS.labels(call).observe(time.perf_counter() - start)
+
+
+def record_gemini_failure(call, error_type):
+    GEMINI_FAILURES.labels(call, error_type).inc()
+
+
+def time_db_query(execute, sql, params, many, context):
+    """connection.execute_wrappers hook timing every query on the connection"""
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_SECONDS.labels(context['connection'].alias).observe(
+            time.perf_counter() - start)
+
+
+def render_metrics():
+    """Prometheus text exposition for this process, or all workers in multiprocess mode"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
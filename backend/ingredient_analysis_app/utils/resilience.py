@@ -0,0 +1,512 @@
+import asyncio
+import math
+import queue
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from . import cache_utils
+from .admission import GeminiBusy, gemini_admission, is_quota_error
+from .metrics import (
+    gemini_call, GEMINI_ADMISSION_REJECTIONS, GEMINI_CIRCUIT_STATE, GEMINI_HEDGES, GEMINI_RETRIES
+)
+from .timing import span
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import (
+    GEMINI_ATTEMPT_TIMEOUT_SECONDS, GEMINI_DEADLINE_SECONDS, GEMINI_MAX_ATTEMPTS,
+    GEMINI_RETRY_BASE_SECONDS, GEMINI_RETRY_MAX_SECONDS, GEMINI_HEDGE_ENABLED,
+    GEMINI_HEDGE_PERCENTILE, GEMINI_BREAKER_FAILURE_THRESHOLD, GEMINI_BREAKER_COOLDOWN_SECONDS,
+    GEMINI_MAX_CONCURRENCY
+)
+
+# Error classes worth another attempt; anything else (a rejected request, a
+# bug) fails the same way every time
+RETRYABLE = ('timeout', 'rate_limited', 'server', 'connection')
+# Error classes that say the upstream is unhealthy and count toward the breaker
+UPSTREAM_FAILURES = ('timeout', 'server', 'connection')
+
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+
+def classify(error):
+    """Error class of a failed Gemini call: timeout, rate_limited, server, connection or fatal"""
+    name = type(error).__name__
+    if isinstance(error, TimeoutError) or name in ('DeadlineExceeded', 'ReadTimeout', 'Timeout'):
+        return 'timeout'
+    if is_quota_error(error):
+        return 'rate_limited'
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    if (isinstance(code, int) and 500 <= code < 600) or name in (
+            'InternalServerError', 'ServiceUnavailable', 'ServerError', 'BadGateway'):
+        return 'server'
+    if isinstance(error, ConnectionError) or name in ('ConnectError', 'RemoteDisconnected'):
+        return 'connection'
+    return 'fatal'
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker whose state lives in Redis, so every worker trips and
+    recovers together.
+
+    Closed: calls go through; each upstream failure increments a shared
+    counter and any success clears it. Once `threshold` failures pile up
+    without a success in between, the breaker opens for `cooldown` seconds
+    and calls fail fast. After the cooldown it is half-open: one worker at
+    a time gets to probe; a successful probe closes the breaker, a failed
+    one opens it again.
+    """
+
+    def __init__(self, client=None, async_client=None, prefix='gemini_breaker',
+                 threshold=GEMINI_BREAKER_FAILURE_THRESHOLD,
+                 cooldown=GEMINI_BREAKER_COOLDOWN_SECONDS, probe_timeout=GEMINI_DEADLINE_SECONDS):
+        self._client = client
+        self._async_client = async_client
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_timeout = math.ceil(probe_timeout)
+        self.failures_key = f"{prefix}:failures"
+        self.open_key = f"{prefix}:open"
+        self.probe_key = f"{prefix}:probe"
+
+    @property
+    def client(self):
+        return self._client or cache_utils.redis_client
+
+    @property
+    def async_client(self):
+        return self._async_client or cache_utils.get_async_redis_client()
+
+    def state(self):
+        """CLOSED, HALF_OPEN or OPEN"""
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(self.failures_key)
+            pipe.pttl(self.open_key)
+            return self._state(*pipe.execute())
+
+    def before_call(self):
+        """
+        Admit a call or raise GeminiBusy while open. Returns what the call
+        runs under, to hand back to record_success/record_failure.
+        """
+        with self.client.pipeline(transaction=False) as pipe:
+            pipe.get(self.failures_key)
+            pipe.pttl(self.open_key)
+            failures, open_ms = pipe.execute()
+        state = self._state(failures, open_ms)
+        if state == HALF_OPEN and not self.client.set(
+                self.probe_key, 1, nx=True, ex=self.probe_timeout):
+            state = OPEN
+        return self._admit(state, failures, open_ms)
+
+    def record_success(self, admitted):
+        state, failures = admitted
+        if state != CLOSED or failures:
+            self.client.delete(self.failures_key, self.probe_key)
+        GEMINI_CIRCUIT_STATE.set(CLOSED)
+
+    def record_failure(self, admitted):
+        with self.client.pipeline(transaction=False) as pipe:
+            self._write_failure(pipe, admitted[0])
+            failures = pipe.execute()[0]
+        if self._trips(admitted[0], failures):
+            self.client.set(self.open_key, 1, nx=True, ex=self.cooldown)
+
+    async def abefore_call(self):
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            pipe.get(self.failures_key)
+            pipe.pttl(self.open_key)
+            failures, open_ms = await pipe.execute()
+        state = self._state(failures, open_ms)
+        if state == HALF_OPEN and not await self.async_client.set(
+                self.probe_key, 1, nx=True, ex=self.probe_timeout):
+            state = OPEN
+        return self._admit(state, failures, open_ms)
+
+    async def arecord_success(self, admitted):
+        state, failures = admitted
+        if state != CLOSED or failures:
+            await self.async_client.delete(self.failures_key, self.probe_key)
+        GEMINI_CIRCUIT_STATE.set(CLOSED)
+
+    async def arecord_failure(self, admitted):
+        async with self.async_client.pipeline(transaction=False) as pipe:
+            self._write_failure(pipe, admitted[0])
+            failures = (await pipe.execute())[0]
+        if self._trips(admitted[0], failures):
+            await self.async_client.set(self.open_key, 1, nx=True, ex=self.cooldown)
+
+    # Shared by the sync and async variants
+
+    def _state(self, failures, open_ms):
+        if open_ms is not None and int(open_ms) > 0:
+            return OPEN
+        if int(_text(failures) or 0) >= self.threshold:
+            return HALF_OPEN
+        return CLOSED
+
+    def _admit(self, state, failures, open_ms):
+        GEMINI_CIRCUIT_STATE.set(state)
+        if state == OPEN:
+            GEMINI_ADMISSION_REJECTIONS.labels('circuit_open').inc()
+            # Open key still counting down, or another worker is probing
+            retry_after = math.ceil(int(open_ms) / 1000) if open_ms and int(open_ms) > 0 else 1
+            raise GeminiBusy(max(1, retry_after), 'circuit_open')
+        return state, int(_text(failures) or 0)
+
+    def _write_failure(self, pipe, state):
+        pipe.incr(self.failures_key)
+        # Failures far apart (no traffic in between) do not add up to an outage
+        pipe.expire(self.failures_key, max(60, self.cooldown * 2))
+        if state == HALF_OPEN:
+            # The probe failed: back to open for another cooldown
+            pipe.set(self.open_key, 1, ex=self.cooldown)
+            pipe.delete(self.probe_key)
+
+    def _trips(self, state, failures):
+        """Whether this failure opens the breaker (a failed probe already has)"""
+        if state == HALF_OPEN or failures >= self.threshold:
+            GEMINI_CIRCUIT_STATE.set(OPEN)
+        return state == CLOSED and failures >= self.threshold
+
+
+class GeminiResilience:
+    """
+    Deadlines, classified retries, optional hedging and the shared circuit
+    breaker around every Gemini request.
+
+    A call makes up to `max_attempts` attempts within `deadline` seconds.
+    Each attempt passes the breaker and the admission limiter, then runs
+    with its own timeout. Timeouts, 429s, 5xx and connection errors are
+    retried after a full-jitter exponential backoff; other errors (bad
+    requests, parse errors in the caller) are not. When retries run out
+    on an upstream problem the call raises GeminiBusy, which the views
+    report as 503 with Retry-After.
+
+    With hedging on, an attempt still running after the `hedge_percentile`
+    latency of recent successful attempts gets a second, identical request
+    if a slot and a token are free right now; whichever answers first is
+    used.
+
+    Sync attempts and streams run on a small thread pool so the caller can
+    stop waiting at the timeout; a hung request keeps its pool thread, and
+    its admission slot, until it returns, but no longer holds the worker.
+    Requests still queued for a pool thread when their caller stops waiting
+    are cancelled instead.
+    """
+
+    def __init__(self, breaker=None, admission=None,
+                 attempt_timeout=GEMINI_ATTEMPT_TIMEOUT_SECONDS, deadline=GEMINI_DEADLINE_SECONDS,
+                 max_attempts=GEMINI_MAX_ATTEMPTS, backoff_base=GEMINI_RETRY_BASE_SECONDS,
+                 backoff_max=GEMINI_RETRY_MAX_SECONDS, hedge=GEMINI_HEDGE_ENABLED,
+                 hedge_percentile=GEMINI_HEDGE_PERCENTILE, hedge_min_samples=20,
+                 pool_size=GEMINI_MAX_CONCURRENCY * 2):
+        self.breaker = breaker or CircuitBreaker()
+        self.admission = admission or gemini_admission
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.pool_size = pool_size
+        self._executor = None
+        self._lock = threading.Lock()
+        self._latencies = {}
+
+    def call(self, call, request):
+        """Run `request()` (one blocking Gemini request) with the full policy"""
+        started = time.monotonic()
+        attempt = 1
+        while True:
+            admitted = self.breaker.before_call()
+            try:
+                # Released by the pool thread once the request returns
+                ticket = self.admission.acquire_current()
+                response = self._timed(call, request, self._attempt_timeout(started), ticket)
+            except GeminiBusy:
+                raise
+            except Exception as e:
+                error_class = classify(e)
+                if error_class in UPSTREAM_FAILURES:
+                    self.breaker.record_failure(admitted)
+                else:
+                    # Gemini answered (a 429 or a rejected request): it is up
+                    self.breaker.record_success(admitted)
+                delay = self._retry_delay(error_class, attempt, started)
+                if delay is None:
+                    raise self._give_up(e, error_class)
+                GEMINI_RETRIES.labels(call, error_class).inc()
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success(admitted)
+            return response
+
+    async def acall(self, call, request):
+        """Async variant of call(); `request()` returns an awaitable"""
+        started = time.monotonic()
+        attempt = 1
+        while True:
+            admitted = await self.breaker.abefore_call()
+            try:
+                async with self.admission.aslot():
+                    response = await self._atimed(call, request, self._attempt_timeout(started))
+            except GeminiBusy:
+                raise
+            except Exception as e:
+                error_class = classify(e)
+                if error_class in UPSTREAM_FAILURES:
+                    await self.breaker.arecord_failure(admitted)
+                else:
+                    await self.breaker.arecord_success(admitted)
+                delay = self._retry_delay(error_class, attempt, started)
+                if delay is None:
+                    raise self._give_up(e, error_class)
+                GEMINI_RETRIES.labels(call, error_class).inc()
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            await self.breaker.arecord_success(admitted)
+            return response
+
+    def stream(self, call, request):
+        """
+        Chunks of a streamed request (`request()` returns the chunk
+        iterator), under the breaker, admission and metrics. Each chunk must
+        arrive within the attempt timeout and the whole stream within the
+        deadline; otherwise it fails as a timeout, which counts toward the
+        breaker. A stream is not retried: chunks may already be on their way
+        to the client.
+        """
+        started = time.monotonic()
+        admitted = self.breaker.before_call()
+        ticket = self.admission.acquire_current()
+        # One chunk of read-ahead, so the model is read as fast as the client is served
+        chunks = queue.Queue(maxsize=1)
+        stopped = threading.Event()
+        pump = None
+        try:
+            pump = self._submit(self._pump, ticket, request, chunks, stopped)
+            with gemini_call(call):
+                while True:
+                    try:
+                        kind, value = chunks.get(timeout=self._attempt_timeout(started))
+                    except queue.Empty:
+                        raise TimeoutError(f"Gemini {call} stream stalled") from None
+                    if kind == 'error':
+                        raise value
+                    if kind == 'end':
+                        break
+                    yield value
+        except GeminiBusy:
+            raise
+        except Exception as e:
+            error_class = classify(e)
+            if error_class in UPSTREAM_FAILURES:
+                self.breaker.record_failure(admitted)
+            raise self._give_up(e, error_class)
+        finally:
+            # Also when the reader stops early; the pool thread then drops the stream
+            stopped.set()
+            if pump is not None:
+                self._cancel([pump], {pump: ticket})
+        self.breaker.record_success(admitted)
+
+    def _pump(self, request, chunks, stopped):
+        """Pool thread side of stream(): reads the stream into `chunks` until it ends or the reader leaves"""
+        try:
+            for chunk in request():
+                if not self._offer(chunks, ('chunk', chunk), stopped):
+                    return
+            self._offer(chunks, ('end', None), stopped)
+        except Exception as e:
+            self._offer(chunks, ('error', e), stopped)
+
+    @staticmethod
+    def _offer(chunks, item, stopped):
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    # Attempts
+
+    def _timed(self, call, request, timeout, ticket):
+        start = time.perf_counter()
+        with gemini_call(call), span('model'):
+            response = self._run(call, request, timeout, ticket)
+        self._observe(call, time.perf_counter() - start)
+        return response
+
+    def _submit(self, function, ticket, *args):
+        """Run `function(*args)` on the pool; `ticket`'s admission slot is held until it returns"""
+        def run():
+            try:
+                return function(*args)
+            finally:
+                self.admission.release(ticket)
+        try:
+            return self._get_executor().submit(run)
+        except BaseException:
+            self.admission.release(ticket)
+            raise
+
+    def _run(self, call, request, timeout, ticket):
+        """One attempt on the pool, with a hedge if it outlives the hedge delay"""
+        first = self._submit(request, ticket)
+        pending = {first}
+        tickets = {first: ticket}
+        hedge_at = self._hedge_delay(call, timeout)
+        deadline = time.monotonic() + timeout
+        hedged = False
+        error = None
+        try:
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait_for = min(remaining, hedge_at) if not hedged and hedge_at is not None else remaining
+                done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if hedged:
+                            GEMINI_HEDGES.labels(call, 'first' if future is first else 'hedge').inc()
+                        return future.result()
+                    error = future.exception()
+                if not done and not hedged and hedge_at is not None:
+                    # The hedge is a call of its own: it needs a free slot and a token
+                    hedged = True
+                    admitted, hedge_ticket = self.admission.try_acquire_current()
+                    if admitted:
+                        hedge = self._submit(request, hedge_ticket)
+                        pending.add(hedge)
+                        tickets[hedge] = hedge_ticket
+            if error is not None and not pending:
+                raise error
+            raise TimeoutError(f"Gemini {call} request timed out after {timeout:.1f} s")
+        finally:
+            self._cancel(pending, tickets)
+
+    def _cancel(self, futures, tickets):
+        """
+        Drop requests still queued for a pool thread, so they never reach
+        Gemini with nobody waiting. Only those free their slot here; one
+        already running frees it when it returns.
+        """
+        for future in futures:
+            if future.cancel():
+                self.admission.release(tickets[future])
+
+    async def _atimed(self, call, request, timeout):
+        start = time.perf_counter()
+        with gemini_call(call), span('model'):
+            response = await self._arun(call, request, timeout)
+        self._observe(call, time.perf_counter() - start)
+        return response
+
+    async def _arun(self, call, request, timeout):
+        hedge_at = self._hedge_delay(call, timeout)
+        first = asyncio.ensure_future(request())
+        tasks = {first}
+        deadline = time.monotonic() + timeout
+        hedged = False
+        hedge_ticket = None
+        error = None
+        try:
+            while tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait_for = min(remaining, hedge_at) if not hedged and hedge_at is not None else remaining
+                done, tasks = await asyncio.wait(tasks, timeout=wait_for,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if hedged:
+                            GEMINI_HEDGES.labels(call, 'first' if task is first else 'hedge').inc()
+                        return task.result()
+                    error = task.exception()
+                if not done and not hedged and hedge_at is not None:
+                    hedged = True
+                    admitted, hedge_ticket = await self.admission.atry_acquire_current()
+                    if admitted:
+                        tasks.add(asyncio.ensure_future(request()))
+            if error is not None and not tasks:
+                raise error
+            raise TimeoutError(f"Gemini {call} request timed out after {timeout:.1f} s")
+        finally:
+            # Unlike threads, the losing or timed-out request can be cancelled;
+            # the slots are freed once the cancelled requests have returned
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.admission.arelease(hedge_ticket)
+
+    # Policy
+
+    def _attempt_timeout(self, started):
+        return max(0.0, min(self.attempt_timeout, self.deadline - (time.monotonic() - started)))
+
+    def _retry_delay(self, error_class, attempt, started):
+        """Full-jitter backoff before the next attempt, or None to give up"""
+        if error_class not in RETRYABLE or attempt >= self.max_attempts:
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        # Not worth a retry that could not get a useful share of the deadline
+        if time.monotonic() - started + delay >= self.deadline - 1:
+            return None
+        return delay
+
+    def _give_up(self, error, error_class):
+        """The exception a call ends with once it stops retrying"""
+        if error_class == 'rate_limited':
+            busy = self.admission.quota_exceeded()
+        elif error_class in UPSTREAM_FAILURES:
+            GEMINI_ADMISSION_REJECTIONS.labels('upstream_unavailable').inc()
+            busy = GeminiBusy(max(1, math.ceil(self.backoff_max)), 'upstream_unavailable')
+        else:
+            return error
+        busy.__cause__ = error
+        return busy
+
+    def _observe(self, call, seconds):
+        with self._lock:
+            self._latencies.setdefault(call, deque(maxlen=200)).append(seconds)
+
+    def _hedge_delay(self, call, timeout):
+        """Seconds after which an attempt is hedged, or None (off, too few samples)"""
+        if not self.hedge:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies.get(call, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        delay = samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile / 100))]
+        return delay if delay < timeout else None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size, thread_name_prefix='gemini-call')
+            return self._executor
+
+
+gemini_resilience = GeminiResilience()
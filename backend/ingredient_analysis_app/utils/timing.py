@@ -0,0 +1,97 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+# Staff users send this header (any non-empty value) to profile one request
+TIMING_REQUEST_HEADER = 'X-Request-Timing'
+
+_current_timer = ContextVar('request_timer', default=None)
+
+
+class RequestTimer:
+    """
+    Per-request stage timings. Repeated spans with the same name (two cache
+    lookups, two model calls) accumulate into one entry with a count.
+    Spans may be recorded from threads the request hands work to, as long
+    as they run in a copy of the request's context (asyncio.to_thread,
+    sync_to_async).
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.spans = {}
+
+    def add(self, name, seconds):
+        total, count = self.spans.get(name, (0.0, 0))
+        self.spans[name] = (total + seconds, count + 1)
+
+    def total_ms(self):
+        return (time.perf_counter() - self.started_at) * 1000
+
+    def server_timing(self):
+        """Server-Timing header value: one metric per stage, plus the total"""
+        metrics = [f"{name};dur={total * 1000:.1f}" for name, (total, _) in self.spans.items()]
+        metrics.append(f"total;dur={self.total_ms():.1f}")
+        return ", ".join(metrics)
+
+    def as_dict(self):
+        return {
+            name: {'ms': round(total * 1000, 1), 'count': count}
+            for name, (total, count) in self.spans.items()
+        }
+
+
+def timing_requested(request, user):
+    return bool(user is not None and user.is_staff and request.headers.get(TIMING_REQUEST_HEADER))
+
+
+@contextmanager
+def request_timing(request, user):
+    """
+    Collect spans for the duration of the block if the caller asked for
+    timing; yields the RequestTimer, or None when timing is off.
+    """
+    if not timing_requested(request, user):
+        yield None
+        return
+    timer = RequestTimer()
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+
+
+@contextmanager
+def span(name):
+    """Time a stage of the current request; a no-op unless timing is on"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def finish_timing(timer, request, user, response):
+    """Attach the Server-Timing header and write the request's JSON log line"""
+    if timer is None:
+        return response
+    response['Server-Timing'] = timer.server_timing()
+    logger.info(json.dumps({
+        'event': 'request_timing',
+        'method': request.method,
+        'path': request.path,
+        'user_id': user.pk,
+        'status': response.status_code,
+        'total_ms': round(timer.total_ms(), 1),
+        'spans': timer.as_dict(),
+    }))
+    return response
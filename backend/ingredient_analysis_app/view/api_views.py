@@ -1,23 +1,40 @@
-import json
 import logging
+import time
 from rest_framework import generics, status, viewsets, mixins
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.renderers import JSONRenderer
 from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.urls import reverse
 from drf_spectacular.utils import extend_schema, OpenApiExample
 
-from ..models import IngredientAnalysis
+from ..models import IngredientAnalysis, AnalysisJob
 from ..serializers import (
     UserRegistrationSerializer,
     UserLoginSerializer,
     UserSerializer,
     IngredientAnalysisSerializer,
-    AnalyzeRequestSerializer
+    IngredientAnalysisListSerializer,
+    HistoryFilterSerializer,
+    HistoryPurgeSerializer,
+    AnalyzeRequestSerializer,
+    AnalyzeBatchRequestSerializer,
+    AnalysisJobSerializer
 )
+from ..service.asset_service import asset_deletion_service
 from ..service.ingredient_service import ingredient_analysis_service
+from ..service.job_service import analysis_job_service
+from ..utils.admission import GeminiBusy
+from ..utils.api_utils import (
+    HistoryCursorPagination, ServerSentEventRenderer, format_sse, iterate_in_thread
+)
+from ..utils.timing import request_timing, finish_timing, span
 
 logger = logging.getLogger(__name__)
 
@@ -116,16 +133,31 @@ class AnalyzeIngredientsAPIView(APIView):
     @extend_schema(
         request=AnalyzeRequestSerializer,
         summary="Analyze ingredients from image",
-        description="Upload image and get immediate ingredient analysis"
+        description="Upload image and get immediate ingredient analysis. "
+                    "With mode=async the analysis is queued and a job id is returned "
+                    "with 202 Accepted; poll /analysis/jobs/{id}/ for the result. "
+                    "When the model is saturated the answer is 503 with a Retry-After header. "
+                    "Staff users can send X-Request-Timing: 1 to get a Server-Timing "
+                    "header with per-stage durations."
     )
     def post(self, request):
-        serializer = AnalyzeRequestSerializer(data=request.data)
-        if not serializer.is_valid():
+        with request_timing(request, request.user) as timer:
+            response = self._analyze(request)
+        return finish_timing(timer, request, request.user, response)
+
+    def _analyze(self, request):
+        with span('validate'):
+            serializer = AnalyzeRequestSerializer(data=request.data)
+            is_valid = serializer.is_valid()
+        if not is_valid:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
         image = serializer.validated_data['image']
         category = serializer.validated_data['category']
 
+        if serializer.validated_data.get('mode') == 'async':
+            return self._submit_job(request, image, category)
+
         try:
             # Use service layer for analysis
             analysis_result = ingredient_analysis_service.analyze_image(
@@ -142,25 +174,24 @@ class AnalyzeIngredientsAPIView(APIView):
                 }, status=status.HTTP_400_BAD_REQUEST)
 
             # Create database entry only after successful analysis
-            analysis = IngredientAnalysis.objects.create(
-                user=request.user,
-                category=category,
-                image=f"v1/{analysis_result['public_id']}",
-                result=json.dumps(analysis_result['result'])
-            )
+            analysis = ingredient_analysis_service.save_analysis(
+                request.user, category, analysis_result)
 
             # Return successful response
             return Response({
                 'status': 'successful',
                 'message': 'Analysis completed successfully',
-                'analysis': {
-                    'id': analysis.id,
-                    'category': analysis.category,
-                    'created_at': analysis.timestamp,
-                    'result': analysis_result['result']
-                }
+                'analysis': ingredient_analysis_service.serialize_analysis(
+                    analysis, analysis_result['result'])
             }, status=status.HTTP_200_OK)
 
+        except GeminiBusy as e:
+            # The model is saturated: tell the client when to come back
+            return Response({
+                'status': 'busy',
+                'error': str(e),
+                'retry_after': e.retry_after
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': str(e.retry_after)})
         except Exception as e:
             logger.error(f"Analysis API error: {str(e)}")
             return Response({
@@ -168,6 +199,175 @@ class AnalyzeIngredientsAPIView(APIView):
                 'error': f'Processing failed: {str(e)}'
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def _submit_job(self, request, image, category):
+        """Queue the analysis for a worker and answer immediately"""
+        try:
+            job = analysis_job_service.submit(
+                image_file=image,
+                category=category,
+                user=request.user
+            )
+        except Exception as e:
+            logger.error(f"Analysis job submission error: {str(e)}")
+            return Response({
+                'status': 'failed',
+                'error': f'Could not queue analysis: {str(e)}'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return Response({
+            'status': 'accepted',
+            'message': 'Analysis queued',
+            'job': {
+                'id': str(job.id),
+                'status': job.status,
+                'status_url': reverse('api_analysis_job', args=[job.id])
+            }
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class AnalyzeIngredientsBatchAPIView(APIView):
+    """Analyze several product images in one request"""
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser]
+
+    @extend_schema(
+        request=AnalyzeBatchRequestSerializer,
+        summary="Analyze ingredients from several images",
+        description="Upload repeated `images` fields with matching `categories` (or one "
+                    "category for all). Images are analyzed concurrently; the response "
+                    "reports success or failure and timings for each item, in order."
+    )
+    def post(self, request):
+        serializer = AnalyzeBatchRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        items = serializer.validated_data['items']
+        started_at = time.perf_counter()
+        try:
+            analysis_results = ingredient_analysis_service.analyze_batch(
+                items, user=request.user)
+
+            succeeded = [
+                (index, category, analysis_result)
+                for index, ((_, category), analysis_result) in enumerate(zip(items, analysis_results))
+                if analysis_result['success']
+            ]
+            # One INSERT for every successful item
+            analyses = ingredient_analysis_service.save_analyses(
+                request.user,
+                [(category, analysis_result) for _, category, analysis_result in succeeded])
+        except Exception as e:
+            logger.error(f"Batch analysis API error: {str(e)}")
+            return Response({
+                'status': 'failed',
+                'error': f'Processing failed: {str(e)}'
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        saved = {index: analysis for (index, _, _), analysis in zip(succeeded, analyses)}
+        results = []
+        for index, analysis_result in enumerate(analysis_results):
+            item = {
+                'index': index,
+                'duplicate_of': analysis_result['duplicate_of'],
+                'timings': analysis_result['timings']
+            }
+            if index in saved:
+                item['status'] = 'successful'
+                item['analysis'] = ingredient_analysis_service.serialize_analysis(
+                    saved[index], analysis_result['result'])
+            else:
+                item['status'] = 'failed'
+                item['error'] = analysis_result['error']
+                if 'retry_after' in analysis_result:
+                    item['retry_after'] = analysis_result['retry_after']
+            results.append(item)
+
+        return Response({
+            'status': 'successful' if len(saved) == len(items) else 'partial' if saved else 'failed',
+            'message': f'{len(saved)} of {len(items)} analyses completed successfully',
+            'total_ms': round((time.perf_counter() - started_at) * 1000, 1),
+            'results': results
+        }, status=status.HTTP_200_OK)
+
+
+class AnalyzeIngredientsStreamAPIView(APIView):
+    """Analyze ingredients and push each part of the result as Server-Sent Events"""
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser]
+    renderer_classes = [JSONRenderer, ServerSentEventRenderer]
+
+    @extend_schema(
+        request=AnalyzeRequestSerializer,
+        summary="Analyze ingredients with a streamed response",
+        description="Returns text/event-stream: analysis_summary, one ingredient_group "
+                    "event per group, health_alerts, then complete (with the saved "
+                    "analysis) or error."
+    )
+    def post(self, request):
+        serializer = AnalyzeRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        events = self._event_stream(
+            request.user,
+            serializer.validated_data['image'],
+            serializer.validated_data['category']
+        )
+        if isinstance(request._request, ASGIRequest):
+            events = iterate_in_thread(events)
+        response = StreamingHttpResponse(events, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the stream
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def _event_stream(self, user, image, category):
+        for event, data in ingredient_analysis_service.analyze_image_stream(
+                image_file=image, category=category, user=user):
+            if event == 'error':
+                if 'retry_after' in data:
+                    yield format_sse('error', {'status': 'busy', 'error': data['error'],
+                                               'retry_after': data['retry_after']})
+                else:
+                    yield format_sse('error', {'status': 'failed', 'error': data['error']})
+            elif event == 'result':
+                try:
+                    analysis = ingredient_analysis_service.save_analysis(
+                        user, category, data)
+                except Exception as e:
+                    logger.error(f"Analysis stream save error: {str(e)}")
+                    yield format_sse('error', {
+                        'status': 'failed',
+                        'error': f'Processing failed: {str(e)}'
+                    })
+                    return
+                yield format_sse('complete', {
+                    'status': 'successful',
+                    'message': 'Analysis completed successfully',
+                    'analysis': ingredient_analysis_service.serialize_analysis(
+                        analysis, data['result'])
+                })
+            else:
+                yield format_sse(event, data)
+
+
+class AnalysisJobStatusAPIView(generics.RetrieveAPIView):
+    """Poll the state of a queued analysis; includes the result once completed"""
+    serializer_class = AnalysisJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return AnalysisJob.objects.filter(
+            user=self.request.user).select_related('analysis')
+
+    @extend_schema(
+        summary="Get analysis job status",
+        description="Returns pending/processing/completed/failed and, when completed, the analysis"
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
 
 class IngredientAnalysisViewSet(
     mixins.ListModelMixin,
@@ -179,7 +379,74 @@ class IngredientAnalysisViewSet(
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return IngredientAnalysis.objects.filter(user=self.request.user)
+        queryset = IngredientAnalysis.objects.filter(user=self.request.user)
+        if self.action in ('list', 'feed'):
+            # Cards only need the summary columns; the result JSON is loaded on retrieve
+            queryset = self._apply_filters(queryset.defer('result'))
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action in ('list', 'feed'):
+            return IngredientAnalysisListSerializer
+        return IngredientAnalysisSerializer
+
+    def _apply_filters(self, queryset, serializer_class=HistoryFilterSerializer):
+        """category / since / until query parameters; ranges use the per-user timestamp index"""
+        filters = serializer_class(data=self.request.query_params)
+        filters.is_valid(raise_exception=True)
+        if 'ids' in filters.validated_data:
+            queryset = queryset.filter(pk__in=filters.validated_data['ids'])
+        if 'category' in filters.validated_data:
+            queryset = queryset.filter(category=filters.validated_data['category'])
+        if 'since' in filters.validated_data:
+            queryset = queryset.filter(timestamp__gte=filters.validated_data['since'])
+        if 'until' in filters.validated_data:
+            queryset = queryset.filter(timestamp__lt=filters.validated_data['until'])
+        return queryset
+
+    @extend_schema(
+        parameters=[HistoryFilterSerializer],
+        summary="List analysis history",
+        description="Page-numbered summaries, newest first. Prefer /history/feed/ for "
+                    "infinite scroll: it does not count rows and deep pages stay fast."
+    )
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @extend_schema(
+        parameters=[HistoryFilterSerializer],
+        summary="Analysis history feed",
+        description="Cursor-paginated summaries, newest first. Follow `next` to scroll; "
+                    "pages are stable while new analyses are added."
+    )
+    @action(detail=False, pagination_class=HistoryCursorPagination)
+    def feed(self, request):
+        return self.list(request)
+
+    @extend_schema(
+        parameters=[HistoryPurgeSerializer],
+        summary="Delete analysis history in bulk",
+        description="Deletes the user's analyses matching the filters (all of them when no "
+                    "filter is given) in one query. Images are removed from Cloudinary "
+                    "in the background."
+    )
+    @action(detail=False, methods=['delete'])
+    def purge(self, request):
+        queryset = self._apply_filters(
+            IngredientAnalysis.objects.filter(user=request.user), HistoryPurgeSerializer)
+        try:
+            deleted = asset_deletion_service.purge(queryset)
+            return Response({
+                "success": True,
+                "deleted": deleted,
+                "message": f"Deleted {deleted} analyses"
+            }, status=status.HTTP_200_OK)
+        except Exception as e:
+            logger.error(f"Error deleting analysis history: {str(e)}")
+            return Response({
+                "success": False,
+                "message": f"Failed to delete analysis history: {str(e)}"
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     def destroy(self, request, *args, **kwargs):
         try:
@@ -208,7 +475,8 @@ class DeleteOwnAccountAPIView(APIView):
         user = request.user
         username = user.username
         try:
-            user.delete()
+            # Images are queued for background deletion instead of one Cloudinary call per scan
+            asset_deletion_service.delete_user(user)
             return Response({"message": f"User '{username}' deleted successfully."}, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({"error": f"Account deletion failed: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
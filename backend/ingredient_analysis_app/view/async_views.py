@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from ..serializers import AnalyzeRequestSerializer
+from ..service.ingredient_service import ingredient_analysis_service
+from ..utils.admission import GeminiBusy
+from ..utils.timing import request_timing, finish_timing, span
+
+logger = logging.getLogger(__name__)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AnalyzeIngredientsAsyncView(View):
+    """
+    Native async analyze endpoint for the ASGI (uvicorn) deployment.
+
+    DRF 3.14 views are synchronous, so this is a plain Django async view
+    with the same authentication classes, validation and response shape as
+    AnalyzeIngredientsAPIView. While Gemini is working the request holds no
+    thread, so one worker can keep hundreds of analyses in flight.
+    """
+    http_method_names = ['post']
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES
+
+    async def post(self, request):
+        try:
+            user = await self._authenticate(request)
+        except APIException as e:
+            # Same body DRF's exception handler would produce
+            detail = e.detail if isinstance(e.detail, dict) else {'detail': e.detail}
+            return JsonResponse(detail, status=e.status_code)
+        if user is None:
+            return JsonResponse(
+                {'detail': 'Authentication credentials were not provided.'}, status=401)
+
+        with request_timing(request, user) as timer:
+            response = await self._analyze(request, user)
+        return finish_timing(timer, request, user, response)
+
+    async def _analyze(self, request, user):
+        # Multipart parsing and Pillow's image verification are blocking
+        with span('validate'):
+            serializer = await asyncio.to_thread(self._validate, request)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=400)
+
+        image = serializer.validated_data['image']
+        category = serializer.validated_data['category']
+
+        try:
+            analysis_result = await ingredient_analysis_service.analyze_image_async(
+                image_file=image,
+                category=category,
+                user=user
+            )
+
+            if not analysis_result['success']:
+                return JsonResponse({
+                    'status': 'failed',
+                    'error': analysis_result['error']
+                }, status=400)
+
+            analysis = await ingredient_analysis_service.asave_analysis(
+                user, category, analysis_result)
+
+            return JsonResponse({
+                'status': 'successful',
+                'message': 'Analysis completed successfully',
+                'analysis': ingredient_analysis_service.serialize_analysis(
+                    analysis, analysis_result['result'])
+            }, status=200)
+
+        except GeminiBusy as e:
+            response = JsonResponse({
+                'status': 'busy',
+                'error': str(e),
+                'retry_after': e.retry_after
+            }, status=503)
+            response['Retry-After'] = str(e.retry_after)
+            return response
+        except Exception as e:
+            logger.error(f"Async analysis API error: {str(e)}")
+            return JsonResponse({
+                'status': 'failed',
+                'error': f'Processing failed: {str(e)}'
+            }, status=500)
+
+    async def _authenticate(self, request):
+        """
+        DRF's authenticators (JWT bearer token or session, as for the sync
+        views); the user lookup is an ORM query
+        """
+        drf_request = Request(
+            request, authenticators=[auth() for auth in self.authentication_classes])
+        user = await sync_to_async(lambda: drf_request.user)()
+        return user if user.is_authenticated else None
+
+    @staticmethod
+    def _validate(request):
+        data = request.POST.copy()
+        data.update(request.FILES)
+        serializer = AnalyzeRequestSerializer(data=data)
+        serializer.is_valid()
+        return serializer
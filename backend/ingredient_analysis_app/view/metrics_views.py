@@ -0,0 +1,21 @@
+import hmac
+import sys
+from pathlib import Path
+from django.http import HttpResponse
+
+from ..utils.metrics import render_metrics
+
+# Add the parent directory to the path to import config module
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from config.configuration import METRICS_AUTH_TOKEN
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; requires `Authorization: Bearer <METRICS_AUTH_TOKEN>` when set"""
+    if METRICS_AUTH_TOKEN:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied, f"Bearer {METRICS_AUTH_TOKEN}"):
+            return HttpResponse(status=401)
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
@@ -1,3 +1,18 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import MedicalTerm, MedicalTermAlias
+
+
+class MedicalTermAliasInline(admin.TabularInline):
+    model = MedicalTermAlias
+    extra = 1
+    fields = ['name']
+
+
+@admin.register(MedicalTerm)
+class MedicalTermAdmin(admin.ModelAdmin):
+    list_display = ['name', 'kind']
+    list_filter = ['kind']
+    search_fields = ['name', 'aliases__name']
+    inlines = [MedicalTermAliasInline]
+
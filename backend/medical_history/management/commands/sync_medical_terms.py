@@ -0,0 +1,66 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from ...models import MedicalHistory, MedicalTerm, MedicalTermAlias, term_key
+
+
+class Command(BaseCommand):
+    help = ("Link every medical history to the canonical term vocabulary, parsing its "
+            "comma-separated allergies, diseases, medications, diets and goals; optionally "
+            "load synonyms first")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--aliases', help='JSON file of {kind: {canonical name: [aliases]}}')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if options['aliases']:
+            aliases = self._load_aliases(Path(options['aliases']))
+            self.stdout.write(f"Loaded {aliases} aliases")
+
+        synced = 0
+        last_pk = 0
+        while True:
+            batch = list(MedicalHistory.objects.filter(pk__gt=last_pk).order_by('pk')[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            with transaction.atomic():
+                for history in batch:
+                    # Parsed from the text fields, not normalized_profile: rows saved
+                    # before that column existed have it empty
+                    history.sync_terms(history.build_profile())
+            synced += len(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Linked {synced} medical histories to {MedicalTerm.objects.count()} terms"))
+
+    @staticmethod
+    def _load_aliases(path):
+        try:
+            vocabulary = json.loads(path.read_text())
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read {path}: {str(e)}")
+        kinds = dict(MedicalTerm.KIND_CHOICES)
+        loaded = 0
+        with transaction.atomic():
+            for kind, terms in vocabulary.items():
+                if kind not in kinds:
+                    raise CommandError(f"Unknown term kind '{kind}' (expected one of {', '.join(kinds)})")
+                for name, alias_names in terms.items():
+                    term = MedicalTerm.objects.filter(kind=kind, key=term_key(name)).first()
+                    if term is None:
+                        term = MedicalTerm.objects.create(kind=kind, name=name)
+                    for alias_name in alias_names:
+                        key = term_key(alias_name)
+                        if key == term.key:
+                            continue
+                        # Saving the alias merges a term created earlier from this
+                        # spelling into the canonical one
+                        MedicalTermAlias.objects.update_or_create(
+                            kind=kind, key=key, defaults={'term': term, 'name': alias_name})
+                        loaded += 1
+        return loaded
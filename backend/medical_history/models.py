@@ -1,6 +1,117 @@
-from django.db import models
+import hashlib
+import json
+from django.db import models, transaction
 from django.contrib.auth.models import User
 
+# Longest term or alias name; list items beyond it are not linked to a term
+TERM_MAX_LENGTH = 100
+
+
+def term_key(name):
+    """Lookup key for a term or alias: case-folded with whitespace collapsed"""
+    return ' '.join(name.split()).casefold()
+
+
+class MedicalTerm(models.Model):
+    """
+    Canonical vocabulary entry (an allergen, condition, medication, diet or
+    goal) that medical histories link to, so "who is allergic to sesame?"
+    is an indexed join instead of a LIKE scan over free text.
+    """
+    KIND_CHOICES = [
+        ('allergy', 'Allergy'),
+        ('disease', 'Disease'),
+        ('medication', 'Medication'),
+        ('dietary_preference', 'Dietary preference'),
+        ('health_goal', 'Health goal'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    name = models.CharField(max_length=TERM_MAX_LENGTH)
+    key = models.CharField(max_length=TERM_MAX_LENGTH, editable=False)
+
+    class Meta:
+        ordering = ['kind', 'key']
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='medical_term_kind_key_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()}: {self.name}"
+
+    def save(self, *args, **kwargs):
+        self.name = ' '.join(self.name.split())
+        self.key = term_key(self.name)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def lookup(cls, kind, name):
+        """The term a name refers to, through its aliases; None if unknown"""
+        key = term_key(name)
+        alias = MedicalTermAlias.objects.filter(kind=kind, key=key).select_related('term').first()
+        if alias is not None:
+            return alias.term
+        return cls.objects.filter(kind=kind, key=key).first()
+
+    @classmethod
+    def resolve(cls, kind, names):
+        """
+        Ids of the terms the given names refer to, creating a term for each
+        name that is neither a known term nor an alias. Names too long for
+        a term are skipped rather than failing the profile save.
+        """
+        names_by_key = {term_key(name): ' '.join(name.split()) for name in names}
+        names_by_key = {key: name for key, name in names_by_key.items()
+                        if len(key) <= TERM_MAX_LENGTH and len(name) <= TERM_MAX_LENGTH}
+        ids = dict(MedicalTermAlias.objects.filter(
+            kind=kind, key__in=names_by_key).values_list('key', 'term_id'))
+        missing = {key: name for key, name in names_by_key.items() if key not in ids}
+        if missing:
+            ids.update(cls.objects.filter(kind=kind, key__in=missing).values_list('key', 'id'))
+            new = [cls(kind=kind, name=name, key=key)
+                   for key, name in missing.items() if key not in ids]
+            if new:
+                # A concurrent save may create the same term; re-read rather than fail
+                cls.objects.bulk_create(new, ignore_conflicts=True)
+                ids.update(cls.objects.filter(
+                    kind=kind, key__in=[term.key for term in new]).values_list('key', 'id'))
+        return set(ids.values())
+
+
+class MedicalTermAlias(models.Model):
+    """Another spelling or synonym of a term (e.g. "Groundnut" for Peanut)"""
+    term = models.ForeignKey(MedicalTerm, on_delete=models.CASCADE, related_name='aliases')
+    # Copied from the term so the alias key is unique within its kind
+    kind = models.CharField(max_length=20, choices=MedicalTerm.KIND_CHOICES, editable=False)
+    name = models.CharField(max_length=TERM_MAX_LENGTH)
+    key = models.CharField(max_length=TERM_MAX_LENGTH, editable=False)
+
+    class Meta:
+        verbose_name_plural = 'medical term aliases'
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='medical_alias_kind_key_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} -> {self.term.name}"
+
+    def save(self, *args, **kwargs):
+        self.kind = self.term.kind
+        self.name = ' '.join(self.name.split())
+        self.key = term_key(self.name)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.merge_standalone_term()
+
+    def merge_standalone_term(self):
+        """
+        Fold a term created earlier from this spelling into the alias's term:
+        its histories link to the canonical term instead, and it is deleted.
+        """
+        for standalone in MedicalTerm.objects.filter(kind=self.kind, key=self.key).exclude(pk=self.term_id):
+            self.term.histories.add(*standalone.histories.all())
+            standalone.delete()
+
 
 class MedicalHistory(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -28,5 +139,75 @@ class MedicalHistory(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # Derived on every save: the profile the analysis pipeline reads, and its
+    # hash, which versions the profile in analysis cache keys
+    normalized_profile = models.JSONField(default=dict, blank=True, editable=False)
+    profile_hash = models.CharField(max_length=64, blank=True, editable=False)
+
+    # Vocabulary links for the list fields, kept in step with them on save
+    terms = models.ManyToManyField(MedicalTerm, blank=True, related_name='histories', editable=False)
+
+    LIST_FIELDS = ['allergies', 'diseases', 'dietary_preferences', 'medications', 'health_goals']
+    TERM_KINDS = {
+        'allergies': 'allergy',
+        'diseases': 'disease',
+        'medications': 'medication',
+        'dietary_preferences': 'dietary_preference',
+        'health_goals': 'health_goal',
+    }
+
     def __str__(self):
         return f"Medical History - {self.user.username}"
+
+    def save(self, *args, **kwargs):
+        self.normalized_profile = self.build_profile()
+        self.profile_hash = self.hash_profile(self.normalized_profile)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'normalized_profile', 'profile_hash'}
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if update_fields is None or set(update_fields) & set(self.LIST_FIELDS):
+                self.sync_terms(self.normalized_profile)
+
+    def sync_terms(self, profile):
+        """Point the term links at the items of the profile's list fields"""
+        term_ids = set()
+        for field, kind in self.TERM_KINDS.items():
+            if profile.get(field):
+                term_ids |= MedicalTerm.resolve(kind, profile[field])
+        self.terms.set(term_ids)
+
+    def build_profile(self):
+        """The user's full medical profile with the comma-separated fields split into lists"""
+        profile = {
+            field: [item.strip() for item in getattr(self, field).split(',') if item.strip()]
+            for field in self.LIST_FIELDS
+        }
+        profile.update({
+            "age": self.age,
+            "life_stage": self.life_stage,
+            "skin_type": self.skin_type,
+            "region": self.region
+        })
+        return profile
+
+    @staticmethod
+    def default_profile():
+        """Profile used for users without a medical history"""
+        return {
+            "allergies": ["No allergies specified"],
+            "diseases": ["No diseases specified"],
+            "age": None,
+            "life_stage": "",
+            "dietary_preferences": [],
+            "medications": [],
+            "skin_type": "",
+            "health_goals": [],
+            "region": ""
+        }
+
+    @staticmethod
+    def hash_profile(profile):
+        return hashlib.sha256(
+            json.dumps(profile, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
@@ -1,5 +1,6 @@
+from django.contrib.auth.models import User
 from rest_framework import serializers
-from .models import MedicalHistory
+from .models import MedicalHistory, MedicalTerm
 
 
 class MedicalHistorySerializer(serializers.ModelSerializer):
@@ -44,3 +45,17 @@ class MedicalHistoryCreateUpdateSerializer(serializers.ModelSerializer):
 
     def validate_health_goals(self, value):
         return self._clean_comma_separated_list(value)
+
+
+class MedicalTermSerializer(serializers.ModelSerializer):
+    aliases = serializers.SlugRelatedField(many=True, read_only=True, slug_field='name')
+
+    class Meta:
+        model = MedicalTerm
+        fields = ['id', 'kind', 'name', 'aliases']
+
+
+class AffectedUserSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'email']
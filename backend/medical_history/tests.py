@@ -1,3 +1,89 @@
+import io
+import json
+import tempfile
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import TestCase
+from rest_framework.test import APIClient
+
+from .models import MedicalHistory, MedicalTerm, MedicalTermAlias
+
+
+class MedicalTermTests(TestCase):
+    """Medical histories link to a canonical, alias-aware term vocabulary"""
+
+    def setUp(self):
+        self.staff = User.objects.create_user('nora', password='secret-pass', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def test_terms_follow_the_text_fields_and_resolve_aliases(self):
+        peanut = MedicalTerm.objects.create(kind='allergy', name='Peanut')
+        MedicalTermAlias.objects.create(term=peanut, name='Groundnut')
+        ana = User.objects.create_user('ana', password='secret-pass')
+        ben = User.objects.create_user('ben', password='secret-pass')
+        history = MedicalHistory.objects.create(user=ana, allergies='groundnut,  Sesame ', diseases='Asthma')
+        MedicalHistory.objects.create(user=ben, allergies='SESAME', medications='Asthma')
+
+        sesame = MedicalTerm.objects.get(kind='allergy', key='sesame')
+        self.assertEqual({term.name for term in history.terms.all()}, {'Peanut', 'Sesame', 'Asthma'})
+        self.assertEqual(MedicalTerm.objects.filter(key='asthma').count(), 2)
+
+        response = self.client.get(f'/api/v1/medical/terms/{sesame.pk}/users/')
+        self.assertEqual([user['username'] for user in response.data['results']], ['ana', 'ben'])
+
+        history.allergies = 'Sesame'
+        history.save(update_fields=['allergies'])
+        response = self.client.get(f'/api/v1/medical/terms/{peanut.pk}/users/')
+        self.assertEqual(response.data['results'], [])
+
+        response = self.client.get('/api/v1/medical/terms/lookup/', {'kind': 'allergy', 'name': 'GROUNDNUT'})
+        self.assertEqual(response.data['id'], peanut.pk)
+        response = self.client.get(f'/api/v1/medical/users/{ben.pk}/terms/')
+        self.assertEqual(sorted((term['kind'], term['name']) for term in response.data),
+                         [('allergy', 'Sesame'), ('medication', 'Asthma')])
+
+    def test_lookups_are_staff_only(self):
+        self.client.force_authenticate(User.objects.create_user('cai', password='secret-pass'))
+        self.assertEqual(self.client.get('/api/v1/medical/terms/').status_code, 403)
+
+    def test_sync_command_merges_synonyms_into_canonical_terms(self):
+        user = User.objects.create_user('dev', password='secret-pass')
+        MedicalHistory.objects.create(user=user, allergies='Groundnut, Milk')
+        # Rows saved before the vocabulary existed have no links
+        MedicalHistory.objects.get(user=user).terms.clear()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / 'aliases.json'
+            path.write_text(json.dumps({'allergy': {'Peanut': ['Groundnut', 'Peanuts']}}))
+            call_command('sync_medical_terms', aliases=str(path), stdout=io.StringIO())
+
+        linked = MedicalHistory.objects.get(user=user).terms.all()
+        self.assertEqual({term.name for term in linked}, {'Peanut', 'Milk'})
+        self.assertFalse(MedicalTerm.objects.filter(kind='allergy', key='groundnut').exists())
+
+    def test_aliases_saved_outside_the_command_merge_the_standalone_term(self):
+        user = User.objects.create_user('fay', password='secret-pass')
+        MedicalHistory.objects.create(user=user, allergies='Groundnut')
+        peanut = MedicalTerm.objects.create(kind='allergy', name='Peanut')
+
+        MedicalTermAlias.objects.create(term=peanut, name='Groundnut')
+
+        self.assertFalse(MedicalTerm.objects.filter(kind='allergy', key='groundnut').exists())
+        self.assertEqual([history.user for history in peanut.histories.all()], [user])
+        response = self.client.get(f'/api/v1/medical/terms/{peanut.pk}/users/')
+        self.assertEqual([row['username'] for row in response.data['results']], ['fay'])
+
+    def test_over_long_items_are_saved_but_skipped_by_the_vocabulary(self):
+        long_item = 'Reaction to ' + 'x' * 120
+        user = User.objects.create_user('eli', password='secret-pass')
+        self.client.force_authenticate(user)
+
+        response = self.client.post('/api/v1/medical/', {'allergies': f'Milk, {long_item}'})
+        self.assertEqual(response.status_code, 201)
 
-# Create your tests here.
+        history = MedicalHistory.objects.get(user=user)
+        self.assertEqual([term.name for term in history.terms.all()], ['Milk'])
+        self.assertEqual(history.normalized_profile['allergies'], ['Milk', long_item])
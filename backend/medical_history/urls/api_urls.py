@@ -1,7 +1,11 @@
 from django.urls import path
 from ..views.api_views import (
     MedicalHistoryAPIView,
-    CheckMedicalHistoryAPIView
+    CheckMedicalHistoryAPIView,
+    MedicalTermListAPIView,
+    MedicalTermLookupAPIView,
+    MedicalTermUsersAPIView,
+    UserMedicalTermsAPIView
 )
 
 urlpatterns = [
@@ -10,4 +14,11 @@ urlpatterns = [
 
     # Endpoint to quickly check if the user already has a medical history record.
     path('check/', CheckMedicalHistoryAPIView.as_view(), name='api_check_medical'),
+
+    # Staff-only vocabulary lookups: search terms, resolve aliases, and fan out
+    # from a term to affected users or from a user to their terms.
+    path('terms/', MedicalTermListAPIView.as_view(), name='api_medical_terms'),
+    path('terms/lookup/', MedicalTermLookupAPIView.as_view(), name='api_medical_term_lookup'),
+    path('terms/<int:pk>/users/', MedicalTermUsersAPIView.as_view(), name='api_medical_term_users'),
+    path('users/<int:user_id>/terms/', UserMedicalTermsAPIView.as_view(), name='api_user_medical_terms'),
 ]
@@ -1,11 +1,29 @@
+from django.contrib.auth.models import User
+from django.db.models import Q
+from django.http import Http404
+from django.shortcuts import get_object_or_404
 from rest_framework import generics, status
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.views import APIView
-from drf_spectacular.utils import extend_schema, OpenApiExample
+from drf_spectacular.utils import extend_schema, OpenApiExample, OpenApiParameter
 
-from ..models import MedicalHistory
-from ..serializers import MedicalHistorySerializer, MedicalHistoryCreateUpdateSerializer
+from ..models import MedicalHistory, MedicalTerm, term_key
+from ..serializers import (
+    AffectedUserSerializer,
+    MedicalHistorySerializer,
+    MedicalHistoryCreateUpdateSerializer,
+    MedicalTermSerializer
+)
+
+
+class AffectedUsersPagination(CursorPagination):
+    """Large keyset pages over user ids, for fanning a recall out to every affected user"""
+    page_size = 500
+    page_size_query_param = 'page_size'
+    max_page_size = 5000
+    ordering = 'id'
 
 
 class MedicalHistoryAPIView(generics.RetrieveUpdateAPIView):
@@ -187,3 +205,105 @@ class CheckMedicalHistoryAPIView(APIView):
             'has_medical_history': has_medical_history,
             'message': 'Medical history exists' if has_medical_history else 'No medical history found'
         }, status=status.HTTP_200_OK)
+
+
+class MedicalTermListAPIView(generics.ListAPIView):
+    """
+    Staff-only search over the medical vocabulary, by kind and by name or
+    alias prefix.
+    """
+
+    serializer_class = MedicalTermSerializer
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(
+        summary="Search medical terms",
+        description="List canonical terms with their aliases, optionally filtered by kind and name prefix",
+        parameters=[
+            OpenApiParameter('kind', str, enum=[kind for kind, _ in MedicalTerm.KIND_CHOICES]),
+            OpenApiParameter('q', str, description='Prefix of the term name or one of its aliases'),
+        ]
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        queryset = MedicalTerm.objects.prefetch_related('aliases')
+        kind = self.request.query_params.get('kind')
+        if kind:
+            queryset = queryset.filter(kind=kind)
+        query = self.request.query_params.get('q', '').strip()
+        if query:
+            prefix = term_key(query)
+            queryset = queryset.filter(
+                Q(key__startswith=prefix) | Q(aliases__key__startswith=prefix)).distinct()
+        return queryset
+
+
+class MedicalTermLookupAPIView(APIView):
+    """Resolve a name (or any alias of it) to its canonical term"""
+
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(
+        summary="Look up a medical term",
+        description="Resolve a name or alias of the given kind to its canonical term",
+        parameters=[
+            OpenApiParameter('kind', str, required=True,
+                             enum=[kind for kind, _ in MedicalTerm.KIND_CHOICES]),
+            OpenApiParameter('name', str, required=True),
+        ],
+        responses={200: MedicalTermSerializer}
+    )
+    def get(self, request):
+        kind = request.query_params.get('kind', '')
+        name = request.query_params.get('name', '').strip()
+        if not kind or not name:
+            return Response({'error': 'Both kind and name are required'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        term = MedicalTerm.lookup(kind, name)
+        if term is None:
+            raise Http404('No term matches this name')
+        return Response(MedicalTermSerializer(term).data, status=status.HTTP_200_OK)
+
+
+class MedicalTermUsersAPIView(generics.ListAPIView):
+    """
+    Users whose medical history lists a term, e.g. everyone allergic to
+    sesame when a product is recalled. Served from the term's index on the
+    history-term link table, paged by user id.
+    """
+
+    serializer_class = AffectedUserSerializer
+    permission_classes = [IsAdminUser]
+    pagination_class = AffectedUsersPagination
+
+    @extend_schema(
+        summary="Users affected by a medical term",
+        description="Cursor-paginated users whose medical history lists the term"
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        term = get_object_or_404(MedicalTerm, pk=self.kwargs['pk'])
+        return User.objects.filter(medicalhistory__terms=term).only('id', 'username', 'email')
+
+
+class UserMedicalTermsAPIView(generics.ListAPIView):
+    """The canonical terms a user's medical history links to"""
+
+    serializer_class = MedicalTermSerializer
+    permission_classes = [IsAdminUser]
+    pagination_class = None
+
+    @extend_schema(
+        summary="Medical terms of a user",
+        description="List the canonical terms linked to a user's medical history"
+    )
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        user = get_object_or_404(User, pk=self.kwargs['user_id'])
+        return MedicalTerm.objects.filter(histories__user=user).prefetch_related('aliases')
@@ -28,34 +28,12 @@ const Dashboard = () => {
     riskWarnings: 0,
   });
 
-  const parseAnalysisResult = useCallback((result) => {
-    if (!result) return { status: "safe" };
-    if (typeof result === "string") {
-      try {
-        const parsed = JSON.parse(result);
-        return parseAnalysisResult(parsed);
-      } catch {
-        const lower = result.toLowerCase();
-        if (
-          lower.includes("avoid") ||
-          lower.includes("danger") ||
-          lower.includes("not recommended")
-        ) {
-          return { status: "danger" };
-        }
-        if (lower.includes("caution") || lower.includes("moderate")) {
-          return { status: "caution" };
-        }
-        return { status: "safe" };
-      }
-    }
-    if (typeof result === "object") {
-      const verdict = result.recommendation?.verdict;
-      if (verdict === "avoid") return { status: "danger" };
-      if (verdict === "caution") return { status: "caution" };
-      return { status: "safe" };
-    }
-    return { status: "safe" };
+  // Status of a history list entry, from its summary columns
+  const analysisStatus = useCallback((analysis) => {
+    const verdict = analysis.verdict || analysis.safety_level;
+    if (verdict === "avoid" || verdict === "danger") return "danger";
+    if (verdict === "caution") return "caution";
+    return "safe";
   }, []);
 
   const loadDashboardData = useCallback(async () => {
@@ -81,7 +59,7 @@ const Dashboard = () => {
 
         // Calculate risk warnings based on parsed status
         const riskWarningsCount = analyses.filter((a) => {
-          const { status } = parseAnalysisResult(a.result);
+          const status = analysisStatus(a);
           return status === "danger" || status === "caution";
         }).length;
 
@@ -96,7 +74,7 @@ const Dashboard = () => {
     } finally {
       setLoading(false);
     }
-  }, [parseAnalysisResult]);
+  }, [analysisStatus]);
 
   useEffect(() => {
     loadDashboardData();
@@ -361,10 +339,7 @@ const Dashboard = () => {
                               </div>
                             </div>
                             <div className="flex items-center">
-                              {analysis.result &&
-                              analysis.result
-                                .toLowerCase()
-                                .includes("warning") ? (
+                              {analysisStatus(analysis) !== "safe" ? (
                                 <div className="w-8 h-8 bg-amber-100 rounded-full flex items-center justify-center">
                                   <AlertTriangle className="h-4 w-4 text-amber-600" />
                                 </div>
@@ -113,83 +113,36 @@ const History = () => {
     });
   };
 
-  // FIXED: Enhanced analysis result parser with correct status mapping
-  const parseAnalysisResult = (result) => {
-    if (!result)
-      return { status: "safe", summary: "Analysis completed", details: null };
+  // Status and card metrics from the summary columns of a history list entry
+  const parseAnalysisSummary = (analysis) => {
+    const {
+      verdict,
+      safety_level: safetyLevel,
+      safety_score: safetyScore,
+      concern_count: concernCount,
+      main_verdict: mainVerdict,
+    } = analysis;
 
-    // Handle string format that contains JSON
-    if (typeof result === "string") {
-      try {
-        const parsedResult = JSON.parse(result);
-        return parseAnalysisResult(parsedResult);
-      } catch {
-        const resultLower = result.toLowerCase();
-        if (
-          resultLower.includes("not recommended") ||
-          resultLower.includes("avoid") ||
-          resultLower.includes("danger")
-        ) {
-          return { status: "danger", summary: result, details: null };
-        }
-        if (
-          resultLower.includes("caution") ||
-          resultLower.includes("moderate")
-        ) {
-          return { status: "caution", summary: result, details: null };
-        }
-        return { status: "safe", summary: result, details: null };
-      }
+    // Rows saved before the summary columns existed (until backfilled)
+    if (!verdict && !safetyLevel && safetyScore == null) {
+      return { status: "safe", summary: "Analysis completed", hasSummary: false };
     }
 
-    // Handle object format
-    if (typeof result === "object") {
-      const {
-        no_valid_ingredients,
-        analysis_summary,
-        recommendation,
-        health_alerts = [],
-        ingredients = [],
-      } = result;
-
-      if (no_valid_ingredients) {
-        return {
-          status: "unknown",
-          summary: "No ingredients detected",
-          details: result,
-          safetyScore: 0,
-          concerns: 0,
-        };
-      }
-
-      let status = "safe"; // default
-      if (recommendation?.verdict === "avoid") {
-        status = "danger";
-      } else if (recommendation?.verdict === "caution") {
-        status = "caution";
-      } else if (
-        recommendation?.verdict === "recommend" ||
-        recommendation?.verdict === "safe"
-      ) {
-        status = "safe";
-      }
-
-      return {
-        status,
-        summary:
-          analysis_summary?.main_verdict ||
-          recommendation?.reason ||
-          "Analysis completed",
-        details: result,
-        safetyScore: analysis_summary?.safety_score || 0,
-        concerns: health_alerts.length,
-        ingredientCount: ingredients.length,
-        confidence: recommendation?.confidence,
-        verdict: recommendation?.verdict,
-      };
+    let status = "safe"; // default
+    if (verdict === "avoid" || (!verdict && safetyLevel === "danger")) {
+      status = "danger";
+    } else if (verdict === "caution" || (!verdict && safetyLevel === "caution")) {
+      status = "caution";
     }
 
-    return { status: "safe", summary: "Analysis completed", details: null };
+    return {
+      status,
+      summary: mainVerdict || "Analysis completed",
+      hasSummary: true,
+      safetyScore: safetyScore || 0,
+      concerns: concernCount || 0,
+      verdict,
+    };
   };
 
   // Enhanced status badge with correct status display
@@ -251,7 +204,7 @@ const History = () => {
 
   // Enhanced filtering logic
   const filteredAnalyses = analyses.filter((analysis) => {
-    const analysisData = parseAnalysisResult(analysis.result);
+    const analysisData = parseAnalysisSummary(analysis);
     // Filter by status
     if (filterStatus !== "all" && analysisData.status !== filterStatus) {
       return false;
@@ -271,7 +224,7 @@ const History = () => {
   // FIXED: Enhanced stats calculation with correct counting
   const stats = analyses.reduce(
     (acc, analysis) => {
-      const data = parseAnalysisResult(analysis.result);
+      const data = parseAnalysisSummary(analysis);
       acc.total++;
       // Count based on the status
       switch (data.status) {
@@ -465,7 +418,7 @@ const History = () => {
           {filteredAnalyses.length > 0 ? (
             <div className="space-y-6">
               {filteredAnalyses.map((analysis) => {
-                const analysisData = parseAnalysisResult(analysis.result);
+                const analysisData = parseAnalysisSummary(analysis);
                 return (
                   <div
                     key={analysis.id}
@@ -518,7 +471,7 @@ const History = () => {
                             {getStatusBadge(analysisData)}
                           </div>
                           {/* Metrics */}
-                          {analysisData.details && (
+                          {analysisData.hasSummary && (
                             <div
                               className="flex items-center gap-6 mb-4 text-sm cursor-pointer"
                               onClick={() =>
@@ -533,19 +486,11 @@ const History = () => {
                                   </span>
                                 </div>
                               )}
-                              {analysisData.ingredientCount > 0 && (
-                                <div className="flex items-center gap-2">
-                                  <Sparkles className="h-4 w-4 text-purple-500" />
-                                  <span className="font-medium text-gray-600">
-                                    {analysisData.ingredientCount} ingredients
-                                  </span>
-                                </div>
-                              )}
-                              {analysisData.confidence && (
+                              {analysisData.concerns > 0 && (
                                 <div className="flex items-center gap-2">
-                                  <Target className="h-4 w-4 text-yellow-500" />
+                                  <AlertTriangle className="h-4 w-4 text-amber-500" />
                                   <span className="font-medium text-gray-600">
-                                    {analysisData.confidence} confidence
+                                    {analysisData.concerns} concerns
                                   </span>
                                 </div>
                               )}
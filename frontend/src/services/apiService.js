@@ -266,6 +266,22 @@ export const apiService = {
     }
   },
 
+  // Cursor-paginated history for infinite scroll: pass the previous page's
+  // `next` URL to continue, or filters ({ category, since, until }) to start
+  getAnalysisFeed: async (next = null, filters = {}) => {
+    try {
+      const response = next
+        ? await api.get(next)
+        : await api.get('/analysis/history/feed/', { params: filters });
+      return { success: true, data: response.data };
+    } catch (error) {
+      return { 
+        success: false, 
+        error: error.response?.data?.message || 'Failed to fetch analysis history' 
+      };
+    }
+  },
+
   getAnalysisDetails: async (id) => {
     try {
       const response = await api.get(`/analysis/history/${id}/`);